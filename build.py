@@ -178,6 +178,13 @@ def update_versions(version):
         version_info_file.truncate()
 
 
+def precompress_static():
+    """ writes the .gz and .br files of src/static that are served to browsers that accept them """
+    from src.modules.compression import ENCODINGS, precompress_folder
+    precompress_folder(SRC_DIR / 'static')
+    print(f'Precompressed static assets ({", ".join(ENCODINGS)})')
+
+
 def local_install():
     exe = os.getenv('LOCALAPPDATA') + '/Programs/Music Caster/Music Caster.exe'
     cmd = [
@@ -460,6 +467,7 @@ if __name__ == '__main__':
             additional_args += ' --clean'
         # build frontend
         # check_call('yarn build', cwd=SRC_FRONTEND, shell=True)
+        precompress_static()
         if platform.system() == 'Windows':
             s1 = Popen(
                 f'{sys.executable} -O -m PyInstaller -y {additional_args} {PORTABLE_SPEC}',
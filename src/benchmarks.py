@@ -0,0 +1,204 @@
+"""
+Benchmarks for hot paths, run with `python benchmarks.py [name ...]`
+Each benchmark compares the current implementation with the one it replaced
+"""
+import io
+import logging
+import sys
+import time
+import tracemalloc
+from base64 import b64decode, b64encode
+
+from PIL import Image
+
+
+def measure(func, repeat=20):
+    """ :return: (seconds per call, peak bytes allocated by one call) """
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def report(name, old, new):
+    (old_time, old_peak), (new_time, new_peak) = old, new
+    print(f'{name}: {old_time * 1000:.1f} ms -> {new_time * 1000:.1f} ms, '
+          f'peak {old_peak / 2 ** 20:.1f} MiB -> {new_peak / 2 ** 20:.1f} MiB')
+
+
+def bench_art():
+    """ embedded cover (4 MB JPEG) to Tk thumbnail and to /file/?thumbnail_only bytes """
+    from meta import COVER_NORMAL
+    from utils import resize_art, resize_img
+
+    img = Image.effect_noise((2000, 2000), 64).convert('RGB')
+    data = io.BytesIO()
+    img.save(data, format='jpeg', quality=95)
+    cover = data.getvalue()
+    bg = '#121212'
+
+    def base64_pipeline():
+        # get_album_art encoded the cover, resize_img decoded it and encoded the PNG, api_get_file decoded that
+        art = b64encode(cover).decode()
+        return b64decode(resize_img(art, bg, COVER_NORMAL))
+
+    def bytes_pipeline():
+        return resize_art(cover, bg, COVER_NORMAL)
+
+    print(f'cover: {len(cover) / 2 ** 20:.1f} MiB')
+    report('art', measure(base64_pipeline), measure(bytes_pipeline))
+
+
+def bench_file(clients=16, requests_per_client=20, chunk=2 ** 20):
+    """ concurrent ranged requests (like cast devices seeking) of a 64 MB file served by waitress with 4 threads """
+    import os
+    import random
+    import socket
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Thread
+
+    import requests
+    import waitress
+    from flask import Flask, request, send_file
+
+    from modules.file_response import send_local_file
+
+    file_path = os.path.join(tempfile.mkdtemp(), 'track.mp3')
+    with open(file_path, 'wb') as f:
+        f.write(os.urandom(64 * 2 ** 20))
+    app = Flask(__name__)
+    app.add_url_rule('/old', 'old', lambda: send_file(file_path, conditional=True, as_attachment=True, max_age=360000))
+    app.add_url_rule('/new', 'new', lambda: send_local_file(request, file_path))
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server_kwargs = {'host': '127.0.0.1', 'port': port, 'threads': 4, '_quiet': True}
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # the queue is meant to be deep
+    Thread(target=waitress.serve, args=(app,), kwargs=server_kwargs, daemon=True).start()
+    time.sleep(0.5)
+
+    def load(endpoint):
+        def client(seed):
+            rng, session = random.Random(seed), requests.Session()
+            for _ in range(requests_per_client):
+                start = rng.randrange(64 * 2 ** 20 - chunk)
+                headers = {'Range': f'bytes={start}-{start + chunk - 1}'}
+                assert len(session.get(f'http://127.0.0.1:{port}/{endpoint}', headers=headers).content) == chunk
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(clients) as executor:
+            list(executor.map(client, range(clients)))
+        return clients * requests_per_client * chunk / 2 ** 20 / (time.perf_counter() - start_time)
+
+    load('new')  # warm up
+    print(f'file: send_file {load("old"):.0f} MiB/s -> send_local_file {load("new"):.0f} MiB/s '
+          f'({clients} clients, {chunk // 2 ** 10} KiB ranges)')
+    os.remove(file_path)
+
+
+def bench_dz(megabytes=16):
+    """ CPU time per MB of decrypting a Deezer stream for /dz/ """
+    import os
+
+    from Cryptodome.Cipher import Blowfish
+
+    from modules.dz_cache import CHUNK_SIZE, IV, SEGMENT_SIZE, decrypt_segment
+
+    bf_key = os.urandom(16)
+    data = os.urandom(megabytes * 2 ** 20)
+
+    def cbc_per_chunk():
+        # api_get_dz built a CBC cipher for every third 2048 byte chunk
+        chunks = []
+        for i in range(0, len(data), CHUNK_SIZE):
+            chunk = data[i:i + CHUNK_SIZE]
+            if (i // CHUNK_SIZE) % 3 == 0 and len(chunk) == CHUNK_SIZE:
+                chunk = Blowfish.new(bf_key, Blowfish.MODE_CBC, IV).decrypt(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def ecb_per_segment():
+        return b''.join(decrypt_segment(bf_key, data[i:i + SEGMENT_SIZE]) for i in range(0, len(data), SEGMENT_SIZE))
+
+    assert cbc_per_chunk() == ecb_per_segment()
+    results = []
+    for func in (cbc_per_chunk, ecb_per_segment):
+        start = time.process_time()
+        for _ in range(3):
+            func()
+        results.append((time.process_time() - start) / 3 / megabytes * 1000)
+    print(f'dz: {results[0]:.2f} -> {results[1]:.2f} CPU ms per MB')
+
+
+def bench_track_change(tracks=10):
+    """ the file work of changing to a local track with a 4 MB embedded cover, without and with prefetch_upcoming """
+    import os
+    import statistics
+    import tempfile
+
+    from mutagen.id3 import APIC, ID3, TIT2, TPE1
+
+    from meta import COVER_NORMAL, COVER_WEB
+    from modules.db import ArtworkStore
+    from utils import ThumbnailCache, get_audio_length, get_metadata, probe
+
+    folder = tempfile.mkdtemp()
+    file_path = os.path.join(folder, 'track.mp3')
+    with open(file_path, 'wb') as f:
+        # 26 seconds of silent MPEG-1 Layer III frames (128 kbps, 44.1 kHz)
+        f.write((b'\xff\xfb\x90\x64' + bytes(413)) * 1000)
+    cover = io.BytesIO()
+    Image.effect_noise((2000, 2000), 64).convert('RGB').save(cover, format='jpeg', quality=95)
+    tags = ID3()
+    tags.add(TIT2(text='Title'))
+    tags.add(TPE1(text='Artist'))
+    tags.add(APIC(mime='image/jpeg', type=3, data=cover.getvalue()))
+    tags.save(file_path)
+    thumbnail_cache, bg = ThumbnailCache(ArtworkStore(os.path.join(folder, 'bench.db'))), '#121212'
+    mtime = time.time_ns()
+
+    def next_track():
+        # a new mtime means that neither probe nor thumbnail_cache has seen the file
+        nonlocal mtime
+        mtime += 1
+        os.utime(file_path, ns=(mtime, mtime))
+
+    def change_track():
+        # what play() does and the thumbnail the GUI shows once the track started
+        get_metadata(file_path)
+        get_audio_length(file_path)
+        thumbnail_cache.get_hash(file_path, COVER_WEB, bg)
+        thumbnail_cache.get(file_path, COVER_NORMAL, bg)
+
+    def prefetch():
+        # what prefetch_upcoming does while the previous track plays
+        probe(file_path)
+        for size in (COVER_NORMAL, COVER_WEB):
+            thumbnail_cache.get(file_path, size, bg)
+
+    results = {'cold': [], 'prefetched': []}
+    for _ in range(tracks):
+        for name in results:
+            next_track()
+            if name == 'prefetched':
+                prefetch()
+            start = time.perf_counter()
+            change_track()
+            results[name].append(time.perf_counter() - start)
+    cold, prefetched = (statistics.median(times) * 1000 for times in results.values())
+    print(f'track change: {cold:.1f} ms -> {prefetched:.1f} ms (median of {tracks}, '
+          f'{os.path.getsize(file_path) / 2 ** 20:.1f} MiB mp3 with an embedded cover)')
+
+
+BENCHMARKS = {'art': bench_art, 'file': bench_file, 'dz': bench_dz, 'track_change': bench_track_change}
+
+if __name__ == '__main__':
+    for benchmark in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[benchmark]()
@@ -253,13 +253,17 @@ def LibraryTab(music_lib, listbox_height, alternate_bg, vertical_gui: bool, show
         library_height = 15 - 4 * (vertical_gui or not show_album_art)
         col_widths = [20, 15, 15]
 
-    library_layout = [[Sg.Table(values=lib_data, headings=lib_headings, row_height=30, auto_size_columns=False,
-                                col_widths=col_widths, bind_return_key=True, justification='right',
-                                size=(10, 1), selected_row_colors=(GuiContext.bg, GuiContext.accent_color), num_rows=library_height,
-                                right_click_menu=['', ['Play::library', 'Play Next::library',
-                                                       'Queue::library', 'Locate::library']],
-                                header_text_color=GuiContext.fg, header_background_color=GuiContext.bg,
-                                alternating_row_color=alternate_bg, key='library')]]
+    library_filter = [Sg.Input('', key='library_filter', size=(30, 1), font=FONT_NORMAL, border_width=1,
+                               enable_events=True, tooltip=t('filter library'))]
+    # the filter box takes the place of one row
+    library_table = [Sg.Table(values=lib_data, headings=lib_headings, row_height=30, auto_size_columns=False,
+                              col_widths=col_widths, bind_return_key=True, justification='right',
+                              size=(10, 1), selected_row_colors=(GuiContext.bg, GuiContext.accent_color), num_rows=library_height - 1,
+                              right_click_menu=['', ['Play::library', 'Play Next::library',
+                                                     'Queue::library', 'Locate::library']],
+                              header_text_color=GuiContext.fg, header_background_color=GuiContext.bg,
+                              alternating_row_color=alternate_bg, key='library')]
+    library_layout = [library_filter, library_table]
     return Sg.Tab(t('Library'), library_layout, key='tab_library')
 
 
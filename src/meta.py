@@ -67,6 +67,7 @@ FONT_TAB = 'Meiryo UI', 10
 LINK_COLOR = '#3ea6ff'
 COVER_MINI = (127, 127)
 COVER_NORMAL = (255, 255)
+COVER_WEB = (512, 512)
 PL_COMBO_W = 37
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:12.0) Gecko/20100101 Firefox/591'
 SUN_VALLEY_TCL = 'theme/sun-valley.tcl'
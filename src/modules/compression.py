@@ -0,0 +1,133 @@
+"""
+gzip and brotli compression of web GUI responses, and the static assets served under content hashed urls
+brotli is optional, without it everything is gzipped
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from pathlib import Path
+from threading import Lock
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                      'application/json', 'application/manifest+json', 'image/svg+xml'}
+# smaller responses fit in a single packet anyway
+MIN_SIZE = 1024
+HASHED_NAME = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{12})(?P<suffix>\.[^./]+)$')
+
+
+def compress(data: bytes, encoding: str, fast=True) -> bytes:
+    """ fast for responses that are compressed on every request, else the smallest output for files built once """
+    if encoding == 'br':
+        return brotli.compress(data, quality=5 if fast else 11)
+    return gzip.compress(data, compresslevel=6 if fast else 9, mtime=0)
+
+
+def is_compressible(file_path) -> bool:
+    return mimetypes.guess_type(str(file_path))[0] in COMPRESSIBLE_TYPES
+
+
+def compress_response(response, accept_encodings, min_size=MIN_SIZE):
+    """
+    Compresses the body of a buffered Flask response in place if the client accepts one of ENCODINGS
+    Files, streams (e.g. /dz/), and already encoded responses are left alone
+    """
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(ENCODINGS)
+    if encoding is None or response.content_length is not None and response.content_length < min_size:
+        return response
+    data = response.get_data()
+    if len(data) >= min_size and len(compressed := compress(data, encoding)) < len(data):
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def precompress_folder(folder):
+    """ writes the .br (if brotli is installed) and .gz of every compressible file in folder that StaticAssets serves """
+    for file_path in Path(folder).rglob('*'):
+        if file_path.is_file() and is_compressible(file_path):
+            data = file_path.read_bytes()
+            for encoding in ENCODINGS:
+                compressed_file = file_path.with_name(file_path.name + EXTENSIONS[encoding])
+                compressed_file.write_bytes(compress(data, encoding, fast=False))
+
+
+class StaticAssets:
+    """
+    Files of folder kept in memory and served under urls with their content hash (/static/style.0123456789ab.css)
+        so that browsers can cache them forever yet fetch a file again as soon as it changes
+    Compressed variants are read from the .br and .gz files written by precompress_folder at build time,
+        or compressed in memory the first time a file is requested if they are missing or out of date
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self._assets = {}  # name: (mtime_ns, hash, mimetype, {encoding: data}), '' is the encoding of the file itself
+        self._lock = Lock()
+
+    def _load(self, name):
+        file_path = self.folder / name
+        try:
+            stat = file_path.stat()
+        except OSError:
+            return None
+        with self._lock:
+            asset = self._assets.get(name)
+        if asset is not None and asset[0] == stat.st_mtime_ns:
+            return asset
+        data = file_path.read_bytes()
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        variants = {'': data}
+        if mimetype in COMPRESSIBLE_TYPES:
+            for encoding in ENCODINGS:
+                compressed_file = file_path.with_name(file_path.name + EXTENSIONS[encoding])
+                try:
+                    if compressed_file.stat().st_mtime_ns < stat.st_mtime_ns:
+                        raise FileNotFoundError(compressed_file)
+                    compressed = compressed_file.read_bytes()
+                except OSError:
+                    compressed = compress(data, encoding, fast=False)
+                if len(compressed) < len(data):
+                    variants[encoding] = compressed
+        asset = stat.st_mtime_ns, hashlib.sha256(data).hexdigest()[:12], mimetype, variants
+        with self._lock:
+            self._assets[name] = asset
+        return asset
+
+    def url(self, name: str) -> str:
+        """ :return: the content hashed url of folder/name, or the plain url if the file does not exist """
+        asset = self._load(name)
+        if asset is None:
+            return f'/static/{name}'
+        stem, suffix = os.path.splitext(name)
+        return f'/static/{stem}.{asset[1]}{suffix}'
+
+    def get(self, filename: str, accept_encodings) -> tuple | None:
+        """
+        :param filename: the path after /static/, with or without a content hash
+        :return: (data, mimetype, encoding or None, etag, immutable) or None if there is no such file
+            immutable is True if filename has the hash of the current content
+        """
+        name, content_hash = filename, None
+        if match := HASHED_NAME.match(filename):
+            name, content_hash = match['stem'] + match['suffix'], match['hash']
+        if '..' in Path(name).parts or Path(name).is_absolute() or name.endswith(tuple(EXTENSIONS.values())):
+            return None
+        asset = self._load(name)
+        if asset is None:
+            return None
+        _, asset_hash, mimetype, variants = asset
+        encoding = accept_encodings.best_match(tuple(variants)[1:])
+        return variants[encoding or ''], mimetype, encoding, f'{asset_hash}{encoding or ""}', content_hash == asset_hash
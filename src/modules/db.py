@@ -1,5 +1,12 @@
+import hashlib
+import json
+import re
 import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import closing, suppress
 from pathlib import Path
+from threading import Lock
 
 DATABASE_FILE = Path('music_caster.db').absolute()
 
@@ -9,6 +16,8 @@ class DatabaseConnection:
     def create_connection():
         conn = sqlite3.connect(DATABASE_FILE)
         conn.row_factory = sqlite3.Row
+        # so that INSERT OR REPLACE fires the delete trigger that keeps library_search in sync
+        conn.execute('PRAGMA recursive_triggers = ON')
         return conn
 
     def __init__(self):
@@ -22,6 +31,65 @@ class DatabaseConnection:
         self.conn.close()
 
 
+class BatchWriter:
+    """
+    Buffers upserts and deletes and writes them with executemany on its own WAL-mode connection
+    A commit happens when batch_size statements are pending or flush_interval seconds have passed since the last one
+    Consecutive statements with the same SQL are executed together so that operations stay in order
+    Meant to be used by one thread at a time, e.g. the library indexer
+    """
+
+    def __init__(self, batch_size=2000, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = DatabaseConnection.create_connection()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode, NORMAL is still safe from corruption and avoids an fsync per commit
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.pending = []  # [(sql, [params, ...]), ...]
+        self.pending_count = 0
+        self.last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def execute(self, sql: str, params: tuple):
+        if self.pending and self.pending[-1][0] == sql:
+            self.pending[-1][1].append(params)
+        else:
+            self.pending.append((sql, [params]))
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size or time.monotonic() - self.last_commit >= self.flush_interval:
+            self.flush()
+
+    def upsert(self, table: str, row: dict):
+        columns = ','.join(row.keys())
+        placeholders = ','.join('?' * len(row))
+        params = tuple(int(v) if isinstance(v, bool) else v for v in row.values())
+        self.execute(f'INSERT OR REPLACE INTO {table}({columns}) VALUES({placeholders})', params)
+
+    def delete(self, table: str, column: str, value):
+        self.execute(f'DELETE FROM {table} WHERE {column} = ?', (value,))
+
+    def flush(self):
+        if self.pending:
+            with self.conn:
+                for sql, params in self.pending:
+                    self.conn.executemany(sql, params)
+            self.pending.clear()
+            self.pending_count = 0
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+
 METADATA_SCHEMA = '''
 CREATE TABLE IF NOT EXISTS file_metadata (
     file_path TEXT PRIMARY KEY NOT NULL,
@@ -32,7 +100,8 @@ CREATE TABLE IF NOT EXISTS file_metadata (
     explicit BOOLEAN DEFAULT 0 NOT NULL CHECK (explicit IN (0, 1)),
     track_number INTEGER UNSIGNED DEFAULT 1 NOT NULL,
     sort_key TEXT DEFAULT file_path NOT NULL,
-    time_modified REAL
+    time_modified REAL,
+    size INTEGER
 );
 
 CREATE TABLE IF NOT EXISTS url_metadata (
@@ -48,14 +117,293 @@ CREATE TABLE IF NOT EXISTS url_metadata (
     expiry REAL,
     id TEXT,
     pl_src TEXT,
-    live BOOLEAN DEFAULT 0 NOT NULL CHECK (live IN (0, 1))
+    live BOOLEAN DEFAULT 0 NOT NULL CHECK (live IN (0, 1)),
+    extra TEXT,
+    last_used REAL
+);
+'''
+
+# full-text index of file_metadata, rowids match file_metadata's rowids
+# file_name is the base name of file_path without its extension
+SEARCH_FILE_NAME = '''
+CASE WHEN instr(BASE_NAME, '.') THEN rtrim(rtrim(BASE_NAME, replace(BASE_NAME, '.', '')), '.') ELSE BASE_NAME END
+'''.strip().replace('BASE_NAME', "replace(new.file_path, rtrim(new.file_path, replace(new.file_path, '/', '')), '')")
+SEARCH_SCHEMA = f'''
+CREATE VIRTUAL TABLE IF NOT EXISTS library_search USING fts5(
+    title, artist, album, file_name, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3'
 );
+
+CREATE TRIGGER IF NOT EXISTS library_search_insert AFTER INSERT ON file_metadata BEGIN
+    INSERT INTO library_search(rowid, title, artist, album, file_name)
+    VALUES (new.rowid, new.title, new.artist, new.album, {SEARCH_FILE_NAME});
+END;
+
+CREATE TRIGGER IF NOT EXISTS library_search_delete AFTER DELETE ON file_metadata BEGIN
+    DELETE FROM library_search WHERE rowid = old.rowid;
+END;
+
+CREATE TRIGGER IF NOT EXISTS library_search_update AFTER UPDATE ON file_metadata BEGIN
+    DELETE FROM library_search WHERE rowid = old.rowid;
+    INSERT INTO library_search(rowid, title, artist, album, file_name)
+    VALUES (new.rowid, new.title, new.artist, new.album, {SEARCH_FILE_NAME});
+END;
 '''
+# title matches are worth more than artist matches which are worth more than album and file name matches
+SEARCH_RANK = 'bm25(library_search, 10.0, 5.0, 2.0, 1.0)'
+
+
+def search_query(text: str) -> str:
+    """ converts what a user typed into an FTS5 query where every word is a prefix that has to match """
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_library(conn: sqlite3.Connection, text: str, limit=50) -> list:
+    """ :return: the best matching file_metadata rows for text """
+    query = search_query(text)
+    if not query:
+        return []
+    # every match is ranked so that the best ones are found, but only the best limit rows are joined
+    sql = (f'SELECT file_metadata.* FROM (SELECT rowid, {SEARCH_RANK} AS score FROM library_search'
+           ' WHERE library_search MATCH ? ORDER BY score LIMIT ?) AS matches'
+           ' JOIN file_metadata ON file_metadata.rowid = matches.rowid ORDER BY matches.score')
+    return conn.execute(sql, (query, limit)).fetchall()
 
 
 def init_db(reset=False):
     with DatabaseConnection() as connection:
+        # persistent, lets the UI read while the library is being written
+        connection.execute('PRAGMA journal_mode=WAL')
         if reset:
-            connection.executescript('DROP TABLE file_metadata;DROP TABLE url_metadata;')
+            connection.executescript('DROP TABLE file_metadata;DROP TABLE url_metadata;DROP TABLE IF EXISTS library_search;')
         connection.executescript(METADATA_SCHEMA)
+        # migrate databases created before file sizes were stored
+        columns = {row['name'] for row in connection.execute('PRAGMA table_info(file_metadata)')}
+        if 'size' not in columns:
+            connection.execute('ALTER TABLE file_metadata ADD COLUMN size INTEGER')
+        # migrate databases created before url_metadata stored every key of the metadata
+        columns = {row['name'] for row in connection.execute('PRAGMA table_info(url_metadata)')}
+        if 'extra' not in columns:
+            connection.execute('ALTER TABLE url_metadata ADD COLUMN extra TEXT')
+        # migrate databases created before unused urls were pruned
+        if 'last_used' not in columns:
+            connection.execute('ALTER TABLE url_metadata ADD COLUMN last_used REAL')
+            connection.execute('UPDATE url_metadata SET last_used = ?', (time.time(),))
+        search_exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'library_search'").fetchone()
+        connection.executescript(SEARCH_SCHEMA)
+        if not search_exists:
+            # index the rows of databases created before library_search existed
+            file_name = SEARCH_FILE_NAME.replace('new.', '')
+            connection.execute('INSERT INTO library_search(rowid, title, artist, album, file_name)'
+                               f' SELECT rowid, title, artist, album, {file_name} FROM file_metadata')
         connection.commit()
+
+
+ARTWORK_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artwork (
+    hash TEXT PRIMARY KEY NOT NULL,
+    mime TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS artwork_refs (
+    key TEXT PRIMARY KEY NOT NULL,
+    hash TEXT NOT NULL,
+    last_used REAL NOT NULL DEFAULT 0
+);
+'''
+
+
+class ArtworkStore:
+    """
+    Stores images once in the artwork table by the sha256 of their bytes,
+        e.g. the thumbnails of every track of an album are the same image
+    artwork_refs maps keys (e.g. a file, its mtime, and a thumbnail size) to the hash of an image
+        Keys of an edited file or an old theme are never used again, so prune() forgets the keys that were not used
+        for a while and deletes the images that no key refers to
+    The most recently used images are also kept in memory
+    """
+    # last_used of a key is only updated by lookup() once it is older than this, so that reads rarely write
+    TOUCH_INTERVAL = 24 * 3600
+
+    def __init__(self, database=DATABASE_FILE, max_items=64):
+        self.database = database
+        self.max_items = max_items
+        self._memory = OrderedDict()  # hash: (mime, data)
+        self._lock = Lock()
+        with closing(sqlite3.connect(self.database)) as conn, conn:
+            conn.executescript(ARTWORK_SCHEMA)
+            # migrate databases created before keys had a last_used time
+            if 'last_used' not in {row[1] for row in conn.execute('PRAGMA table_info(artwork_refs)')}:
+                conn.execute('ALTER TABLE artwork_refs ADD COLUMN last_used REAL NOT NULL DEFAULT 0')
+                conn.execute('UPDATE artwork_refs SET last_used = ?', (time.time(),))
+
+    @staticmethod
+    def hash(data: bytes | memoryview) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _remember(self, art_hash, mime, data):
+        with self._lock:
+            self._memory[art_hash] = mime, data
+            self._memory.move_to_end(art_hash)
+            if len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def put(self, data: bytes | memoryview, mime: str, key: str | None = None) -> str:
+        """ stores data if it is not stored yet, refers to it by key if given, and returns its hash """
+        data = bytes(data)
+        art_hash = self.hash(data)
+        with closing(sqlite3.connect(self.database)) as conn, conn:
+            if art_hash not in self._memory:
+                conn.execute('INSERT OR IGNORE INTO artwork (hash, mime, data) VALUES (?, ?, ?)', (art_hash, mime, data))
+            if key is not None:
+                conn.execute('INSERT OR REPLACE INTO artwork_refs (key, hash, last_used) VALUES (?, ?, ?)',
+                             (key, art_hash, time.time()))
+        self._remember(art_hash, mime, data)
+        return art_hash
+
+    def get(self, art_hash: str) -> tuple | None:
+        """ :return: (mime, data) or None if art_hash is not stored """
+        with self._lock:
+            with suppress(KeyError):
+                self._memory.move_to_end(art_hash)
+                return self._memory[art_hash]
+        with closing(sqlite3.connect(self.database)) as conn:
+            row = conn.execute('SELECT mime, data FROM artwork WHERE hash = ?', (art_hash,)).fetchone()
+        if row is None:
+            return None
+        self._remember(art_hash, *row)
+        return row[0], row[1]
+
+    def lookup(self, key: str) -> str | None:
+        """ :return: the hash that key refers to """
+        with closing(sqlite3.connect(self.database)) as conn, conn:
+            row = conn.execute('SELECT hash, last_used FROM artwork_refs WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[1] < time.time() - self.TOUCH_INTERVAL:
+                conn.execute('UPDATE artwork_refs SET last_used = ? WHERE key = ?', (time.time(), key))
+        return None if row is None else row[0]
+
+    def prune(self, max_age=90 * 24 * 3600) -> int:
+        """
+        forgets the keys that were not used for max_age seconds and deletes the images that no key refers to
+        :return: the number of images deleted
+        """
+        with closing(sqlite3.connect(self.database)) as conn, conn:
+            conn.execute('DELETE FROM artwork_refs WHERE last_used < ?', (time.time() - max_age,))
+            return conn.execute('DELETE FROM artwork WHERE hash NOT IN (SELECT hash FROM artwork_refs)').rowcount
+
+
+# url_metadata column: metadata key, the keys without a column are stored as JSON in the extra column
+URL_METADATA_COLUMNS = {'src': 'src', 'title': 'title', 'artist': 'artist', 'album': 'album', 'length': 'length',
+                        'url': 'url', 'audio_url': 'audio_url', 'ext': 'ext', 'art': 'art', 'expiry': 'expiry',
+                        'id': 'id', 'pl_src': 'pl_src', 'live': 'is_live'}
+# keys that a loaded metadata always has, even if they are NULL
+URL_METADATA_KEYS = ('title', 'artist', 'album', 'length', 'expiry')
+# keys that are out of date once the metadata expires, the other keys are kept when a url is resolved again
+URL_STREAM_KEYS = ('url', 'audio_url', 'ext', 'expiry', 'file_url', 'bf_key')
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {'$bytes': value.hex()}
+    return str(value)
+
+
+def _json_object_hook(obj):
+    if obj.keys() == {'$bytes'}:
+        return bytes.fromhex(obj['$bytes'])
+    return obj
+
+
+def url_metadata_to_row(src: str, metadata: dict) -> tuple:
+    """ :return: the values of URL_METADATA_COLUMNS and extra for the url_metadata row of src """
+    metadata = dict(metadata)  # may be changed by another thread while it is serialized
+    # metadata without an expiry (e.g. a Spotify track that was not matched yet) is resolved when it is played
+    metadata.setdefault('expiry', 0)
+    values = [src] + [metadata.pop(key, None) for column, key in URL_METADATA_COLUMNS.items() if column != 'src']
+    values = [value if value is None or isinstance(value, (str, int, float)) else str(value) for value in values]
+    values[-1] = int(bool(values[-1]))
+    if metadata.get('src') == src:
+        del metadata['src']  # otherwise (e.g. the short url of a video) the src of the metadata is kept in extra
+    extra = json.dumps(metadata, default=_json_default) if metadata else None
+    return *values, extra
+
+
+def url_metadata_from_row(row) -> dict:
+    metadata = {key: row[column] for column, key in URL_METADATA_COLUMNS.items()
+                if row[column] is not None or key in URL_METADATA_KEYS}
+    metadata['is_live'] = bool(metadata['is_live'])
+    if row['extra']:
+        metadata.update(json.loads(row['extra'], object_hook=_json_object_hook))
+    return metadata
+
+
+class UrlMetadataCache(dict):
+    """
+    {url: metadata} of resolved urls, written through to the url_metadata table and loaded back at startup
+        so that the queue does not need to resolve every url again
+    Setting a url marks it dirty and flush() writes every dirty url in one transaction,
+        since resolving a playlist sets hundreds of urls at once
+    Metadata is serialized when it is flushed, so changes made to it after it was set (e.g. art_hash) are included
+    Every url ever resolved (e.g. each track of an expanded playlist) would be kept forever,
+        so prune() deletes the urls that were not set or touched for a while and are not in use
+    """
+
+    def __init__(self, database=DATABASE_FILE, transient=('SYSTEM_AUDIO',)):
+        super().__init__()
+        self.database = database
+        self.transient = set(transient)  # keys that are not written
+        self._dirty = set()
+        self._lock = Lock()
+
+    def __setitem__(self, src, metadata):
+        super().__setitem__(src, metadata)
+        self.touch(src)
+
+    def touch(self, src):
+        """ marks src dirty after its metadata was changed in place """
+        if src in self and src not in self.transient:
+            with self._lock:
+                self._dirty.add(src)
+
+    def load(self) -> int:
+        """ loads the url_metadata table, :return: the number of urls loaded """
+        with closing(sqlite3.connect(self.database)) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute('SELECT * FROM url_metadata').fetchall()
+        for row in rows:
+            with suppress(ValueError):
+                super().__setitem__(row['src'], url_metadata_from_row(row))
+        return len(rows)
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        rows = [(*url_metadata_to_row(src, metadata), now) for src in dirty if (metadata := self.get(src)) is not None]
+        if not rows:
+            return
+        columns = ','.join((*URL_METADATA_COLUMNS, 'extra', 'last_used'))
+        placeholders = ','.join('?' * (len(URL_METADATA_COLUMNS) + 2))
+        try:
+            with closing(sqlite3.connect(self.database)) as conn, conn:
+                conn.executemany(f'INSERT OR REPLACE INTO url_metadata({columns}) VALUES({placeholders})', rows)
+        except sqlite3.Error:
+            with self._lock:
+                self._dirty |= dirty  # retried by the next flush
+
+    def prune(self, keep=(), max_age=30 * 24 * 3600) -> int:
+        """
+        deletes the urls that were not set or touched for max_age seconds unless they or their playlist are in keep
+            (e.g. the urls in the queues and playlists)
+        :return: the number of urls deleted
+        """
+        keep = set(keep)
+        with closing(sqlite3.connect(self.database)) as conn, conn:
+            rows = conn.execute('SELECT src, pl_src FROM url_metadata WHERE last_used IS NULL OR last_used < ?',
+                                (time.time() - max_age,)).fetchall()
+            stale = [(src,) for src, pl_src in rows if src not in keep and pl_src not in keep]
+            conn.executemany('DELETE FROM url_metadata WHERE src = ?', stale)
+        for src, in stale:
+            self.pop(src, None)
+        return len(stale)
@@ -0,0 +1,154 @@
+"""
+Decryption of Deezer streams and a disk cache of the decrypted segments that /dz/ serves byte ranges from
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import suppress
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+
+app_log = logging.getLogger('music_caster')
+
+CHUNK_SIZE = 2048
+# only the first chunk of every stripe is encrypted, with Blowfish CBC and the same iv for every chunk
+STRIPE_SIZE = 3 * CHUNK_SIZE
+SEGMENT_SIZE = 32 * STRIPE_SIZE
+IV = b'\x00\x01\x02\x03\x04\x05\x06\x07'
+CACHE_FOLDER = Path('dz_cache').absolute()
+
+
+@lru_cache(maxsize=16)
+def get_cipher(bf_key: bytes):
+    """ the key schedule of Blowfish is expensive, so one ECB cipher is built per track instead of a CBC one per chunk """
+    from Cryptodome.Cipher import Blowfish
+    return Blowfish.new(bf_key, Blowfish.MODE_ECB)
+
+
+def decrypt_segment(bf_key: bytes, data: bytes) -> bytes:
+    """
+    :param data: bytes of the stream starting at a multiple of STRIPE_SIZE
+    CBC decryption is ECB decryption XOR the previous ciphertext block (the iv for the first block),
+        so every encrypted chunk of data is decrypted with one call to the ECB cipher and one XOR
+    A chunk shorter than CHUNK_SIZE (the end of the stream) is not encrypted
+    """
+    starts = range(0, len(data) - CHUNK_SIZE + 1, STRIPE_SIZE)
+    if not starts:
+        return data
+    ciphertext = b''.join(data[i:i + CHUNK_SIZE] for i in starts)
+    previous = b''.join(IV + data[i:i + CHUNK_SIZE - 8] for i in starts)
+    plaintext = int.from_bytes(get_cipher(bf_key).decrypt(ciphertext)) ^ int.from_bytes(previous)
+    plaintext = plaintext.to_bytes(len(ciphertext))
+    decrypted = bytearray(data)
+    for n, i in enumerate(starts):
+        decrypted[i:i + CHUNK_SIZE] = plaintext[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE]
+    return bytes(decrypted)
+
+
+class DzCache:
+    """
+    Decrypted Deezer streams stored on disk in segments of SEGMENT_SIZE bytes, so that any byte range that was
+        streamed before (seeks, replays, cast devices re-requesting the track) is read locally
+    Every track is a folder named by the hash of its url with the segments that have been downloaded
+        and a file with the size and content type of the whole stream
+    The least recently used segments are deleted once the segments take up more than max_bytes
+    """
+
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=512 * 2 ** 20):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self._segments = None  # OrderedDict of segment path: size, least recently used first
+        self._size = 0
+        self._lock = Lock()
+
+    def _load(self):
+        """ lists the segments on disk the first time the cache is used, ordered by when they were last read """
+        if self._segments is not None:
+            return
+        segments = []
+        with suppress(OSError):
+            for segment in self.folder.glob('*/*.seg'):
+                with suppress(OSError):
+                    stat = segment.stat()
+                    segments.append((stat.st_mtime, segment, stat.st_size))
+        segments.sort(key=lambda item: item[0])
+        self._segments = OrderedDict((segment, size) for _, segment, size in segments)
+        self._size = sum(self._segments.values())
+
+    def _track_folder(self, url) -> Path:
+        return self.folder / hashlib.sha1(url.encode()).hexdigest()
+
+    def get_info(self, url) -> tuple | None:
+        """ :return: (size, content_type) of the stream of url if a segment of it has been cached """
+        with suppress(OSError, ValueError):
+            size, content_type = (self._track_folder(url) / 'info').read_text().split('\n', 1)
+            return int(size), content_type
+        return None
+
+    def set_info(self, url, size: int, content_type: str):
+        track_folder = self._track_folder(url)
+        with suppress(OSError):
+            track_folder.mkdir(parents=True, exist_ok=True)
+            (track_folder / 'info').write_text(f'{size}\n{content_type}')
+
+    def get(self, url, index: int) -> bytes | None:
+        """ :return: the decrypted bytes of segment index (starting at index * SEGMENT_SIZE) or None if not cached """
+        segment = self._track_folder(url) / f'{index}.seg'
+        with self._lock:
+            self._load()
+            if segment not in self._segments:
+                return None
+            self._segments.move_to_end(segment)
+        try:
+            data = segment.read_bytes()
+            os.utime(segment)  # keeps the order of use across restarts
+            return data
+        except OSError:
+            with self._lock:
+                self._size -= self._segments.pop(segment, 0)
+            return None
+
+    def put(self, url, index: int, data: bytes):
+        track_folder = self._track_folder(url)
+        segment = track_folder / f'{index}.seg'
+        temp_file = None
+        try:
+            track_folder.mkdir(parents=True, exist_ok=True)
+            # unique per writer, since requests for the same range can download the same segment at once
+            fd, temp_file = tempfile.mkstemp(suffix='.tmp', prefix=f'{index}.', dir=track_folder)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, segment)
+        except OSError as e:
+            app_log.warning(f'could not cache segment {index} of {url}: {e!r}')
+            if temp_file is not None:
+                with suppress(OSError):
+                    os.remove(temp_file)
+            return
+        with self._lock:
+            self._load()
+            self._size += len(data) - self._segments.pop(segment, 0)
+            self._segments[segment] = len(data)
+            while self._size > self.max_bytes and len(self._segments) > 1:
+                old_segment, size = self._segments.popitem(last=False)
+                self._size -= size
+                with suppress(OSError):
+                    old_segment.unlink()
+                    if not any(old_segment.parent.glob('*.seg')):
+                        shutil.rmtree(old_segment.parent)
+
+    @property
+    def size(self):
+        """ total bytes of the cached segments """
+        with self._lock:
+            self._load()
+            return self._size
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self._segments, self._size = OrderedDict(), 0
@@ -0,0 +1,126 @@
+"""
+Pushes player events to the Server-Sent Events subscribers of /events/
+"""
+import json
+import logging
+from threading import Event, Lock, Thread
+
+from waitress.channel import ClientDisconnected
+from waitress.task import ThreadedTaskDispatcher
+
+app_log = logging.getLogger('music_caster')
+
+
+def encode_event(event: str, data) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+
+class EventBroker:
+    """
+    Streams events to the subscribers of /events/ on the I/O loop of waitress instead of a thread per subscriber,
+        so that any number of subscribers leaves every thread of the web server to requests
+    EventDispatcher hands the connections of /events/ to subscribe(), publish(event, data) can be called from any
+        thread and encodes data once for all subscribers, and one thread sends keep-alives every heartbeat seconds
+    New subscribers first receive every event of snapshot(), which returns {event: data} of the current state
+    A subscriber that has more than max_buffered bytes waiting to be sent is disconnected,
+        and receives the current state again once its EventSource reconnects
+    """
+
+    def __init__(self, snapshot=None, heartbeat=15, max_buffered=256 * 2 ** 10):
+        self.snapshot = snapshot
+        self.heartbeat = heartbeat  # seconds between keep-alives, which also keep proxies from closing the stream
+        self.max_buffered = max_buffered
+        self._channels = set()
+        self._lock = Lock()
+        self._heartbeat_thread = None
+        self._stop_event = Event()
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return sum(channel.connected for channel in self._channels)
+
+    def subscribe(self, channel):
+        """ sends the response head and the snapshot to the waitress channel of a request to /events/ """
+        request = channel.requests[0]
+        # the request is answered here, not by a task, and the connection stays readable so that a close is noticed
+        channel.requests.clear()
+        head = (f'HTTP/{request.version} 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                # nginx would buffer the stream
+                'X-Accel-Buffering: no\r\nConnection: close\r\n\r\nretry: 3000\n\n').encode()
+        snapshot = {} if self.snapshot is None else self.snapshot()
+        if self._send(channel, head + b''.join(encode_event(event, data) for event, data in snapshot.items())):
+            with self._lock:
+                self._channels.add(channel)
+                if self._heartbeat_thread is None:
+                    self._heartbeat_thread = Thread(target=self._send_heartbeats, name='EventHeartbeat', daemon=True)
+                    self._heartbeat_thread.start()
+
+    def publish(self, event: str, data):
+        with self._lock:
+            channels = tuple(self._channels)
+        if channels:
+            self._broadcast(channels, encode_event(event, data))
+
+    def _broadcast(self, channels, message: bytes):
+        gone = [channel for channel in channels if not self._send(channel, message)]
+        if gone:
+            with self._lock:
+                self._channels.difference_update(gone)
+
+    def _send(self, channel, message: bytes) -> bool:
+        """ queues message on channel and wakes the I/O loop to send it, :return: whether channel is subscribed """
+        if not channel.connected:
+            return False
+        if channel.total_outbufs_len > self.max_buffered:
+            # the client is not reading
+            channel.will_close = True
+            channel.server.pull_trigger()
+            return False
+        try:
+            channel.write_soon(message)
+        except ClientDisconnected:
+            return False
+        # write_soon leaves small writes for the next time the I/O loop wakes up
+        channel.server.pull_trigger()
+        return True
+
+    def stop(self):
+        """ stops sending keep-alives and closes the connections of the subscribers """
+        self._stop_event.set()
+        with self._lock:
+            channels, self._channels = self._channels, set()
+        for channel in channels:
+            channel.will_close = True
+            channel.server.pull_trigger()
+
+    def _send_heartbeats(self):
+        while not self._stop_event.wait(self.heartbeat):
+            with self._lock:
+                channels = tuple(self._channels)
+            self._broadcast(channels, b': keep-alive\n\n')
+
+
+class EventDispatcher(ThreadedTaskDispatcher):
+    """
+    The task dispatcher of a waitress server (waitress.serve(app, _dispatcher=...)) that hands GET requests of path
+        to broker instead of to a thread, every other request is served by one of threads like waitress does
+    """
+
+    def __init__(self, broker: EventBroker, threads=4, path='/events/'):
+        super().__init__()
+        self.broker = broker
+        self.path = path
+        self.set_thread_count(threads)
+
+    def add_task(self, task):
+        request = task.requests[0] if getattr(task, 'requests', None) else None
+        if request is not None and request.command == 'GET' and request.path == self.path and not request.error:
+            try:
+                self.broker.subscribe(task)
+            except Exception as e:
+                app_log.error(f'EventDispatcher: could not subscribe: {e!r}')
+                task.will_close = True
+                task.server.pull_trigger()
+            return
+        super().add_task(task)
@@ -0,0 +1,120 @@
+"""
+Responses for local files that waitress sends from its I/O thread instead of a worker thread, including byte ranges
+"""
+import mimetypes
+import os
+import secrets
+import time
+import unicodedata
+from urllib.parse import quote
+
+from werkzeug.wrappers import Request, Response
+
+BLOCK_SIZE = 2 ** 16
+
+
+def get_ranges(request: Request, size: int, etag: str, last_modified: float) -> list | None:
+    """
+    :return: [(start, stop), ...] of the satisfiable ranges of the Range header, [] if none are satisfiable,
+        None if the whole file should be sent
+    """
+    if request.range is None or request.range.units != 'bytes':
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None  # the file changed since the client got the first part of it
+    if if_range.date is not None and if_range.date.timestamp() < int(last_modified):
+        return None
+    ranges = []
+    for start, stop in request.range.ranges:
+        if start < 0:  # the last -start bytes
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def file_chunks(file_path, ranges, part_headers=(), end=b''):
+    """ yields the bytes of ranges of file_path, each preceded by its part header if given, and then end """
+    with open(file_path, 'rb') as f:
+        for i, (start, stop) in enumerate(ranges):
+            if part_headers:
+                yield part_headers[i]
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0 and (chunk := f.read(min(BLOCK_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+    if end:
+        yield end
+
+
+def send_local_file(request: Request, file_path, max_age=360000, as_attachment=True) -> Response:
+    """
+    Like flask.send_file(file_path, conditional=True, max_age=max_age, as_attachment=as_attachment)
+    Flask only passes whole files to the server's wsgi.file_wrapper and iterates ranges in Python on a worker thread,
+        even though cast devices request every track as a range
+    Here a single range is also returned as the wsgi.file_wrapper (seeked to its start and limited by Content-Length)
+        which waitress sends from its I/O thread so that the worker thread is free for the next request
+    Multiple ranges are answered with multipart/byteranges
+    """
+    stat = os.stat(file_path)
+    size, last_modified = stat.st_size, stat.st_mtime
+    etag = f'{stat.st_mtime_ns:x}-{size:x}'
+    content_type = mimetypes.guess_type(str(file_path))[0] or 'application/octet-stream'
+    response = Response(mimetype=content_type, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = int(last_modified)
+    response.accept_ranges = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.expires = int(time.time() + max_age)
+    if as_attachment:
+        file_name = os.path.basename(file_path)
+        try:
+            file_name.encode('ascii')
+            response.headers.set('Content-Disposition', 'attachment', filename=file_name)
+        except UnicodeEncodeError:
+            ascii_name = unicodedata.normalize('NFKD', file_name).encode('ascii', 'ignore').decode('ascii')
+            response.headers.set('Content-Disposition', 'attachment', filename=ascii_name,
+                                 **{'filename*': f"UTF-8''{quote(file_name, safe='!#$&+-.^_`|~')}"})
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = request.if_modified_since is not None and int(last_modified) <= request.if_modified_since.timestamp()
+    if not_modified:
+        response.status_code = 304
+        return response
+    ranges = get_ranges(request, size, etag, last_modified)
+    if ranges == []:
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+    if ranges is not None:
+        response.status_code = 206
+    if ranges is not None and len(ranges) > 1:
+        boundary = secrets.token_hex(16)
+        part_headers = [(f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode() for start, stop in ranges]
+        end = f'\r\n--{boundary}--\r\n'.encode()
+        response.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        response.content_length = sum(map(len, part_headers)) + sum(stop - start for start, stop in ranges) + len(end)
+        response.response = file_chunks(file_path, ranges, part_headers, end)
+        return response
+    start, stop = (0, size) if ranges is None else ranges[0]
+    if ranges is not None:
+        response.content_range = f'bytes {start}-{stop - 1}/{size}'
+    response.content_length = stop - start
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if request.method == 'HEAD':
+        response.response = ()
+    elif file_wrapper is not None and (stop == size or request.environ.get('SERVER_SOFTWARE') == 'waitress'):
+        # waitress stops after Content-Length bytes, other servers are only trusted with files that are sent to the end
+        f = open(file_path, 'rb')
+        f.seek(start)
+        response.response = file_wrapper(f, BLOCK_SIZE)
+    else:
+        response.response = file_chunks(file_path, [(start, stop)])
+    return response
@@ -0,0 +1,345 @@
+"""
+Watches music folders for added, modified, moved, and deleted audio files
+Uses inotify on Linux and ReadDirectoryChangesW on Windows,
+    and falls back to comparing snapshots of the folders every poll_interval seconds elsewhere
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import platform
+import select
+import struct
+import time
+from queue import Empty, Queue
+from threading import Event, Thread
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+# https://learn.microsoft.com/en-us/windows/win32/api/winbase/nf-winbase-readdirectorychangesw
+FILE_LIST_DIRECTORY = 0x0001
+FILE_SHARE_ALL = 0x00000001 | 0x00000002 | 0x00000004  # read, write, delete
+OPEN_EXISTING = 3
+FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+FILE_NOTIFY_FILTER = 0x00000001 | 0x00000002 | 0x00000008 | 0x00000010  # file name, dir name, size, last write
+FILE_ACTION_ADDED, FILE_ACTION_REMOVED, FILE_ACTION_MODIFIED = 1, 2, 3
+FILE_ACTION_RENAMED_OLD_NAME, FILE_ACTION_RENAMED_NEW_NAME = 4, 5
+NOTIFY_HEADER = struct.Struct('III')  # NextEntryOffset, Action, FileNameLength
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+app_log = logging.getLogger('music_caster')
+
+
+def load_inotify():
+    """ returns libc if it provides inotify else None """
+    if platform.system() != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def load_kernel32():
+    """ returns kernel32 with the functions to watch folders with ReadDirectoryChangesW on Windows else None """
+    if platform.system() != 'Windows':
+        return None
+    from ctypes import wintypes
+    try:
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p,
+                                         wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        kernel32.ReadDirectoryChangesW.argtypes = [wintypes.HANDLE, ctypes.c_void_p, wintypes.DWORD, wintypes.BOOL,
+                                                   wintypes.DWORD, ctypes.POINTER(wintypes.DWORD), ctypes.c_void_p,
+                                                   ctypes.c_void_p]
+        kernel32.ReadDirectoryChangesW.restype = wintypes.BOOL
+        kernel32.CancelIoEx.argtypes = [wintypes.HANDLE, ctypes.c_void_p]
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        return kernel32
+    except (OSError, AttributeError):
+        return None
+
+
+class FolderWatcher:
+    """
+    Calls on_change(changed: set, deleted: set) once per debounced batch of events
+        paths are absolute and use forward slashes like the rest of the library
+        deleted can contain folders, which means that every file inside of that folder is gone
+    Calls on_overflow() when events were dropped and the folders need to be rescanned
+    Folders are walked like utils.scan_folder does, following symlinks and skipping hidden and excluded folders
+    Polling keeps a snapshot of the folders, so poll_interval (seconds) can be changed while watching
+    """
+
+    def __init__(self, folders, exts, on_change, on_overflow=None, excluded_dir_names=(), debounce=2.0,
+                 poll_interval=1800.0):
+        self.folders = [os.path.abspath(folder).replace('\\', '/') for folder in folders]
+        self.exts = exts
+        self.excluded_dir_names = excluded_dir_names
+        self.on_change = on_change
+        self.on_overflow = on_overflow
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._stop_event = Event()
+        self.thread = Thread(target=self._watch, name='FolderWatcher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def is_audio_file(self, name: str):
+        return os.path.splitext(name)[1].casefold() in self.exts
+
+    def scan(self, folder, on_folder=None) -> dict:
+        """ returns {file_path: (time_modified, size)} of the audio files in folder and calls on_folder for each folder """
+        try:
+            st = os.stat(folder)
+        except OSError:
+            return {}
+        snapshot, folders, visited = {}, [folder], {(st.st_dev, st.st_ino)}
+        while folders:
+            folder = folders.pop()
+            if on_folder is not None:
+                on_folder(folder)
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'):
+                            continue
+                        path = f'{folder}/{entry.name}'
+                        try:
+                            if entry.is_dir():
+                                if entry.name in self.excluded_dir_names:
+                                    continue
+                                # symlinks are followed, but every folder is visited once
+                                st = os.stat(path)
+                                if (st.st_dev, st.st_ino) not in visited:
+                                    visited.add((st.st_dev, st.st_ino))
+                                    folders.append(path)
+                            elif self.is_audio_file(entry.name):
+                                stat = entry.stat()
+                                snapshot[path] = stat.st_mtime, stat.st_size
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return snapshot
+
+    def _watch(self):
+        libc = load_inotify()
+        if libc is not None:
+            try:
+                self._inotify_loop(libc)
+                return
+            except OSError as e:
+                # e.g. ENOSPC if fs.inotify.max_user_watches is too low for the library
+                app_log.info(f'FolderWatcher: inotify unavailable ({e}), polling instead')
+        kernel32 = load_kernel32()
+        if kernel32 is not None:
+            try:
+                self._windows_loop(kernel32)
+                return
+            except OSError as e:
+                app_log.info(f'FolderWatcher: ReadDirectoryChangesW unavailable ({e}), polling instead')
+        self._poll_loop()
+
+    def _inotify_loop(self, libc):
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watches = {}  # wd: folder
+
+        def add_watch(folder):
+            wd = libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK | IN_ONLYDIR)
+            if wd >= 0:
+                watches[wd] = folder
+            elif ctypes.get_errno() == errno.ENOSPC:
+                raise OSError(errno.ENOSPC, 'inotify watch limit reached')
+
+        def remove_watches(folder):
+            prefix = folder + '/'
+            for wd, watched in tuple(watches.items()):
+                if watched == folder or watched.startswith(prefix):
+                    libc.inotify_rm_watch(fd, wd)
+                    watches.pop(wd, None)
+
+        try:
+            for folder in self.folders:
+                self.scan(folder, on_folder=add_watch)
+            changed, deleted = set(), set()
+            flush_at = None
+            while not self._stop_event.is_set():
+                timeout = 1 if flush_at is None else max(0.0, flush_at - time.monotonic())
+                if select.select([fd], [], [], timeout)[0]:
+                    buffer, offset, overflow = os.read(fd, 65536), 0, False
+                    while offset < len(buffer):
+                        wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                        name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                        offset += EVENT_HEADER.size + length
+                        if mask & IN_Q_OVERFLOW:
+                            overflow = True
+                            continue
+                        if mask & IN_IGNORED:
+                            watches.pop(wd, None)
+                            continue
+                        if wd not in watches or not name or name.startswith(b'.'):
+                            continue
+                        path = f'{watches[wd]}/{os.fsdecode(name)}'
+                        if mask & IN_ISDIR:
+                            if mask & (IN_CREATE | IN_MOVED_TO):
+                                if os.fsdecode(name) in self.excluded_dir_names:
+                                    continue
+                                # files could have been added before the new folder was watched
+                                changed.update(self.scan(path, on_folder=add_watch))
+                            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                                remove_watches(path)
+                                deleted.add(path)
+                        elif self.is_audio_file(path):
+                            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                                changed.add(path)
+                                deleted.discard(path)
+                            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                                deleted.add(path)
+                                changed.discard(path)
+                    if overflow and self.on_overflow is not None:
+                        changed.clear()
+                        deleted.clear()
+                        flush_at = None
+                        self.on_overflow()
+                    elif (changed or deleted) and flush_at is None:
+                        flush_at = time.monotonic() + self.debounce
+                if flush_at is not None and time.monotonic() >= flush_at:
+                    self.on_change(changed.copy(), deleted.copy())
+                    changed.clear()
+                    deleted.clear()
+                    flush_at = None
+        finally:
+            os.close(fd)
+
+    def _windows_loop(self, kernel32):
+        """ one thread per folder blocks on ReadDirectoryChangesW of its whole tree and queues the events """
+        events = Queue()  # (folder, action, name) or None when events were dropped
+        handles = []
+
+        def read_changes(folder, handle):
+            from ctypes import wintypes
+            buffer = (ctypes.c_uint32 * 16384)()  # 64 KiB and DWORD aligned, the most that network shares allow
+            bytes_returned = wintypes.DWORD()
+            while not self._stop_event.is_set():
+                if not kernel32.ReadDirectoryChangesW(handle, buffer, ctypes.sizeof(buffer), True, FILE_NOTIFY_FILTER,
+                                                      ctypes.byref(bytes_returned), None, None):
+                    # also fails when the folder is deleted or its drive is removed
+                    if not self._stop_event.is_set():
+                        app_log.info(f'FolderWatcher: stopped watching {folder} ({ctypes.get_last_error()})')
+                    return
+                if not bytes_returned.value:
+                    # the buffer overflowed
+                    events.put(None)
+                    continue
+                data, offset = bytes(buffer)[:bytes_returned.value], 0
+                while True:
+                    next_offset, action, length = NOTIFY_HEADER.unpack_from(data, offset)
+                    name = data[offset + NOTIFY_HEADER.size:offset + NOTIFY_HEADER.size + length].decode('utf-16-le')
+                    events.put((folder, action, name.replace('\\', '/')))
+                    if not next_offset:
+                        break
+                    offset += next_offset
+
+        def add_link(folder):
+            # changes are not reported through symlinks and junctions, so the folders they point to are watched too
+            if folder not in self.folders and (os.path.islink(folder) or os.path.isjunction(folder)):
+                folders.append(folder)
+
+        folders = list(self.folders)
+        for folder in self.folders:
+            self.scan(folder, on_folder=add_link)
+        try:
+            for folder in folders:
+                handle = kernel32.CreateFileW(folder, FILE_LIST_DIRECTORY, FILE_SHARE_ALL, None, OPEN_EXISTING,
+                                              FILE_FLAG_BACKUP_SEMANTICS, None)
+                if handle in {None, INVALID_HANDLE_VALUE}:
+                    app_log.info(f'FolderWatcher: cannot watch {folder} ({ctypes.get_last_error()})')
+                    continue
+                handles.append(handle)
+                Thread(target=read_changes, args=(folder, handle), name='FolderWatcherReader', daemon=True).start()
+            if folders and not handles:
+                raise OSError('none of the folders can be watched')
+            changed, deleted = set(), set()
+            flush_at = None
+            while not self._stop_event.is_set():
+                timeout = 1 if flush_at is None else max(0.0, flush_at - time.monotonic())
+                try:
+                    event = events.get(timeout=timeout)
+                except Empty:
+                    event = False
+                if event is None:
+                    if self.on_overflow is not None:
+                        changed.clear()
+                        deleted.clear()
+                        flush_at = None
+                        self.on_overflow()
+                    continue
+                if event:
+                    folder, action, name = event
+                    path = f'{folder}/{name}'
+                    if any(part.startswith('.') or part in self.excluded_dir_names for part in name.split('/')):
+                        continue
+                    if action in {FILE_ACTION_ADDED, FILE_ACTION_MODIFIED, FILE_ACTION_RENAMED_NEW_NAME}:
+                        if self.is_audio_file(path):
+                            changed.add(path)
+                            deleted.discard(path)
+                        elif action != FILE_ACTION_MODIFIED and os.path.isdir(path):
+                            # a folder moved in only has an event for itself
+                            changed.update(self.scan(path))
+                    elif action in {FILE_ACTION_REMOVED, FILE_ACTION_RENAMED_OLD_NAME}:
+                        # whether a path that is gone was a folder is unknown, deleted can contain folders anyway
+                        deleted.add(path)
+                        changed.discard(path)
+                    if (changed or deleted) and flush_at is None:
+                        flush_at = time.monotonic() + self.debounce
+                if flush_at is not None and time.monotonic() >= flush_at:
+                    self.on_change(changed.copy(), deleted.copy())
+                    changed.clear()
+                    deleted.clear()
+                    flush_at = None
+        finally:
+            for handle in handles:
+                # wakes up the thread blocked on the handle
+                kernel32.CancelIoEx(handle, None)
+                kernel32.CloseHandle(handle)
+
+    def _poll_loop(self):
+        snapshot = {}
+        for folder in self.folders:
+            snapshot.update(self.scan(folder))
+        while not self._stop_event.wait(self.poll_interval):
+            new_snapshot = {}
+            for folder in self.folders:
+                new_snapshot.update(self.scan(folder))
+            changed = {file_path for file_path, stat in new_snapshot.items() if snapshot.get(file_path) != stat}
+            deleted = snapshot.keys() - new_snapshot.keys()
+            snapshot = new_snapshot
+            if changed or deleted:
+                self.on_change(changed, deleted)
@@ -0,0 +1,83 @@
+"""
+The session that every outbound request goes through, so that connections to the same host are reused
+"""
+import logging
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+app_log = logging.getLogger('music_caster')
+
+# (connect, read) seconds, read is the longest wait between two bytes rather than for the whole response
+TIMEOUT = (5, 20)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HostStats:
+    __slots__ = 'requests', 'errors', 'retries', 'seconds', 'max_seconds'
+
+    def __init__(self):
+        self.requests = self.errors = self.retries = 0
+        self.seconds = self.max_seconds = 0.0
+
+    def to_dict(self):
+        return {'requests': self.requests, 'errors': self.errors, 'retries': self.retries,
+                'avg_ms': round(self.seconds / max(self.requests, 1) * 1000), 'max_ms': round(self.max_seconds * 1000)}
+
+
+class HTTPSession(requests.Session):
+    """
+    A requests.Session with a keep-alive connection pool per host, a default timeout,
+        and bounded retries with exponential backoff of idempotent requests that failed to connect or got RETRY_STATUSES
+    Records the number of requests, errors (exceptions and status >= 400), retries, and latency of every host
+        Latency is until the response headers, so streamed bodies (stream=True) are not counted
+    """
+
+    def __init__(self, timeout=TIMEOUT, retries=3, backoff_factor=0.5, pool_maxsize=10):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self._stats = {}
+        self._stats_lock = Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlparse(url).hostname or ''
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException as e:
+            self._record(host, time.perf_counter() - start, error=True)
+            app_log.info(f'{method} {host} failed: {e!r}')
+            raise
+        retries = getattr(response.raw, 'retries', None)
+        self._record(host, time.perf_counter() - start, error=response.status_code >= 400,
+                     retries=len(retries.history) if retries is not None else 0)
+        return response
+
+    def _record(self, host, seconds, error=False, retries=0):
+        with self._stats_lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = self._stats[host] = HostStats()
+            stats.requests += 1
+            stats.errors += error
+            stats.retries += retries
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def stats(self) -> dict:
+        """ :return: {host: {'requests', 'errors', 'retries', 'avg_ms', 'max_ms'}} """
+        with self._stats_lock:
+            return {host: stats.to_dict() for host, stats in self._stats.items()}
+
+
+session = HTTPSession()
@@ -0,0 +1,173 @@
+"""
+Scans the metadata of queued uris with separate pools of workers for urls and for local files
+"""
+import heapq
+import itertools
+import logging
+from collections import Counter
+from threading import Condition, Lock, Thread
+
+URGENT, NORMAL = 0, 1
+app_log = logging.getLogger('music_caster')
+
+
+class ScanQueue:
+    """
+    urls are scanned by network_workers threads and files by disk_workers threads,
+        so that a playlist of 500 urls does not hold up the local files that are being displayed
+    A uri that is already waiting or being scanned is not queued again
+    get_urgent() returns the uris that should be scanned first (e.g. the ones near the head of the music queue),
+        it is called before every scan so it needs to be cheap
+    on_progress() is called after every progress_every scans of a lane and whenever a lane runs out of work
+    group_of(uri) returns the group of a uri (e.g. the extractor of a url) or None,
+        at most group_limits.get(group, default_group_limit) uris of a group are scanned at once
+        and the workers scan the next uri of another group in the meantime
+    """
+
+    def __init__(self, scan_url, scan_file, network_workers=4, disk_workers=2, get_urgent=None, on_progress=None,
+                 progress_every=50, group_of=None, group_limits=None, default_group_limit=2):
+        self.get_urgent = get_urgent
+        self.on_progress = on_progress
+        self.progress_every = progress_every
+        self.group_of = group_of
+        self.group_limits = group_limits or {}
+        self.default_group_limit = default_group_limit
+        self._lock = Lock()
+        self._pending = {}  # uri: priority
+        self._in_flight = set()
+        self._group_counts = Counter()  # group: uris of the group in flight
+        self._scanned_condition = Condition(self._lock)
+        self._waiting = Counter()  # uri: callers of scan_first waiting for the result of uri
+        self._results = {}  # uri: result of scan of the uris in _waiting
+        self._counter = itertools.count()  # keeps uris of the same priority in the order they were put
+        self._lanes = {'network': ([], Condition(self._lock), scan_url, network_workers),
+                       'disk': ([], Condition(self._lock), scan_file, disk_workers)}
+        self._scanned = {lane: 0 for lane in self._lanes}
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            for lane, (_, _, _, workers) in self._lanes.items():
+                for i in range(workers):
+                    Thread(target=self._work, args=(lane,), name=f'Scan{lane.title()}{i}', daemon=True).start()
+        return self
+
+    @staticmethod
+    def lane(uri: str):
+        return 'network' if uri.startswith('http') else 'disk'
+
+    def _push(self, uri, priority):
+        """ caller holds the lock """
+        if uri in self._in_flight or self._pending.get(uri, priority + 1) <= priority:
+            return False
+        self._pending[uri] = priority
+        heap, condition, _, _ = self._lanes[self.lane(uri)]
+        # the entry of the old priority is skipped when popped
+        heapq.heappush(heap, (priority, next(self._counter), uri))
+        condition.notify()
+        return True
+
+    def put(self, uri: str, priority=NORMAL):
+        with self._lock:
+            self._push(uri, priority)
+
+    def prioritize(self, uris):
+        """ scans uris that are waiting before everything else """
+        with self._lock:
+            for uri in uris:
+                if uri in self._pending:
+                    self._push(uri, URGENT)
+
+    def empty(self):
+        with self._lock:
+            return not self._pending and not self._in_flight
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _group(self, uri):
+        return None if self.group_of is None else self.group_of(uri)
+
+    def _next_uri(self, heap):
+        """ caller holds the lock, returns the uri with the highest priority whose group is not at its limit or None """
+        skipped, next_uri = [], None
+        while heap:
+            entry = heapq.heappop(heap)
+            priority, _, uri = entry
+            if self._pending.get(uri) != priority:
+                continue
+            group = self._group(uri)
+            if group is not None and self._group_counts[group] >= self.group_limits.get(group, self.default_group_limit):
+                skipped.append(entry)
+                continue
+            del self._pending[uri]
+            self._in_flight.add(uri)
+            if group is not None:
+                self._group_counts[group] += 1
+            next_uri = uri
+            break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return next_uri
+
+    def scan_first(self, uris, accept=bool):
+        """
+        Scans uris before everything else while keeping their order, and waits for them in that order
+        :return: (uri, result of scanning uri) of the first uri whose result is accepted or (None, None)
+            as soon as it and the uris before it have been scanned, the uris after it keep being scanned
+        Not to be called by a worker, which would wait for itself
+        """
+        uris = list(uris)
+        with self._lock:
+            self._waiting.update(uris)
+            for uri in uris:
+                self._push(uri, URGENT)
+        try:
+            for uri in uris:
+                with self._scanned_condition:
+                    self._scanned_condition.wait_for(lambda: uri in self._results)
+                    result = self._results[uri]
+                if accept(result):
+                    return uri, result
+            return None, None
+        finally:
+            with self._lock:
+                self._waiting.subtract(uris)
+                for uri in uris:
+                    if self._waiting[uri] <= 0:
+                        del self._waiting[uri]
+                        self._results.pop(uri, None)
+
+    def _work(self, lane):
+        heap, condition, scan, _ = self._lanes[lane]
+        while True:
+            with condition:
+                while not heap:
+                    condition.wait()
+            if self.get_urgent is not None:
+                self.prioritize(self.get_urgent())
+            with condition:
+                uri = self._next_uri(heap)
+                if uri is None:
+                    # every uri that is waiting is in a group at its limit, a scan of that group ending notifies
+                    condition.wait()
+                    continue
+            result = None
+            try:
+                result = scan(uri)
+            except Exception as e:
+                app_log.error(f'ScanQueue: could not scan {uri}: {e!r}')
+            with self._lock:
+                self._in_flight.discard(uri)
+                if (group := self._group(uri)) is not None:
+                    self._group_counts[group] -= 1
+                    condition.notify()
+                if uri in self._waiting:
+                    self._results[uri] = result
+                    self._scanned_condition.notify_all()
+                self._scanned[lane] += 1
+                report = self._scanned[lane] % self.progress_every == 0 or not heap
+            if report and self.on_progress is not None:
+                self.on_progress()
@@ -0,0 +1,90 @@
+"""
+Resolves the urls in the queue again before their streams expire
+"""
+import logging
+import time
+from threading import Event, Thread
+
+app_log = logging.getLogger('music_caster')
+
+
+class UrlRefresher:
+    """
+    Refreshes the stream urls of the uris that play next on its own thread,
+        so that a track change neither waits for the url to be resolved again nor casts a url that has expired
+    get_uris() returns the uris that play next in order, get_expiry(uri) returns the time the stream of uri expires,
+        0 if it was never resolved, or None if there is nothing to refresh, and refresh(uri) resolves uri again
+    A uri is refreshed once it expires within margin seconds, or within lead seconds if it is one of the next
+        lookahead uris, since it needs to stay valid until it has played
+    Refreshes of the same group (e.g. the extractor of a url) are at least min_interval seconds apart,
+        and a uri is not refreshed again for retry_after seconds (e.g. if it failed or its stream expires immediately)
+    """
+
+    def __init__(self, get_uris, get_expiry, refresh, group_of=None, margin=120, lookahead=3, lead=900,
+                 min_interval=2, retry_after=300, poll_interval=5):
+        self.get_uris = get_uris
+        self.get_expiry = get_expiry
+        self.refresh = refresh
+        self.group_of = group_of
+        self.margin = margin
+        self.lookahead = lookahead
+        self.lead = lead
+        self.min_interval = min_interval
+        self.retry_after = retry_after
+        self.poll_interval = poll_interval
+        self._last_group_refresh = {}  # group: monotonic time of its last refresh
+        self._last_refresh = {}  # uri: monotonic time of its last refresh
+        self._wake = Event()
+        self._stop_event = Event()
+
+    def start(self):
+        Thread(target=self._run, name='UrlRefresher', daemon=True).start()
+        return self
+
+    def stop(self):
+        """ stops after the refresh in progress, if any """
+        self._stop_event.set()
+        self._wake.set()
+
+    def wake(self):
+        """ checks the uris now instead of after poll_interval, e.g. after the queue changed """
+        self._wake.set()
+
+    def next_uri(self):
+        """ :return: the first uri that is due for a refresh and whose group may be refreshed now, or None """
+        now, monotonic = time.time(), time.monotonic()
+        for i, uri in enumerate(self.get_uris()):
+            expiry = self.get_expiry(uri)
+            if expiry is None or expiry > now + (self.lead if i < self.lookahead else self.margin):
+                continue
+            if monotonic - self._last_refresh.get(uri, -self.retry_after) < self.retry_after:
+                continue
+            group = None if self.group_of is None else self.group_of(uri)
+            if monotonic - self._last_group_refresh.get(group, -self.min_interval) < self.min_interval:
+                continue
+            return uri
+        return None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                uri = self.next_uri()
+            except Exception as e:
+                app_log.error(f'UrlRefresher: {e!r}')
+                uri = None
+            if uri is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            monotonic = time.monotonic()
+            self._last_refresh[uri] = monotonic
+            self._last_group_refresh[None if self.group_of is None else self.group_of(uri)] = monotonic
+            try:
+                self.refresh(uri)
+                app_log.info(f'UrlRefresher: refreshed {uri}')
+            except Exception as e:
+                app_log.error(f'UrlRefresher: could not refresh {uri}: {e!r}')
+            # forget uris that were refreshed long enough ago to be refreshed again anyway
+            if len(self._last_refresh) > 1000:
+                self._last_refresh = {uri: t for uri, t in self._last_refresh.items()
+                                      if monotonic - t < self.retry_after}
@@ -13,6 +13,7 @@ from meta import (
     WAIT_TIMEOUT,
     COVER_MINI,
     COVER_NORMAL,
+    COVER_WEB,
     UPDATE_MESSAGE,
     IMPORTANT_INFORMATION,
     AUDIO_EXTS,
@@ -25,7 +26,7 @@ import time
 
 start_time = time.monotonic()
 from contextlib import suppress
-from itertools import islice, chain
+from itertools import islice, chain, takewhile
 import io
 import multiprocessing as mp
 import os
@@ -182,7 +183,6 @@ if __name__ == '__main__':
     import ctypes
     import encodings.idna  # noqa # DO NOT REMOVE
     from functools import cmp_to_key
-    import glob
     import hashlib
     from copy import deepcopy
     from datetime import datetime, timedelta
@@ -193,9 +193,9 @@ if __name__ == '__main__':
     import pprint
     from random import shuffle
     from shutil import copyfileobj, rmtree
-    from queue import Queue
     import secrets
     import socket
+    import sqlite3
     from threading import Thread
     import tkinter
     from tkinter import filedialog as fd
@@ -206,7 +206,7 @@ if __name__ == '__main__':
     from uuid import UUID
     import zipfile
 
-    from b64_images import PAUSE_BUTTON_IMG, PLAY_BUTTON_IMG, SHUFFLE_OFF, SHUFFLE_ON, VOLUME_IMG, VOLUME_MUTED_IMG, WINDOW_ICON, DEFAULT_ART
+    from b64_images import PAUSE_BUTTON_IMG, PLAY_BUTTON_IMG, SHUFFLE_OFF, SHUFFLE_ON, VOLUME_IMG, VOLUME_MUTED_IMG, WINDOW_ICON
     from audio_player import AudioPlayer
     from modules.win32_media_controls import SystemMediaTransportControlsButton # SystemMediaControls
     from mutagen._util import MutagenError
@@ -219,7 +219,14 @@ if __name__ == '__main__':
         get_album_art,
         get_lan_ip,
         get_metadata,
+        probe,
+        get_metadata_worker,
+        init_metadata_worker,
         Unknown,
+        Track,
+        LibraryIndex,
+        ThumbnailCache,
+        DEFAULT_ART_BYTES,
         get_file_name,
         parse_m3u,
         valid_audio_file,
@@ -229,7 +236,7 @@ if __name__ == '__main__':
         natural_key_file,
         better_shuffle,
         truncate_title,
-        resize_img,
+        resize_art,
         repeat_img_tooltip,
         DiscordPresence,
         get_ipv4,
@@ -238,6 +245,7 @@ if __name__ == '__main__':
         urlparse,
         get_yt_id,
         get_yt_urls,
+        get_url_extractor,
         install_phantomjs,
         add_to_path,
         open_in_browser,
@@ -260,12 +268,23 @@ if __name__ == '__main__':
         InvalidAudioFile,
         get_audio_length,
         get_spotify_tracks,
+        scan_folder,
+        EXCLUDED_DIR_NAMES,
     )
     from modules.resolution_switcher import fmt_res, get_all_resolutions, set_resolution, get_all_refresh_rates, get_initial_res, is_plugged_in, get_initial_dpi_scale
     get_initial_dpi_scale()
     from gui import MainWindow, MiniPlayerWindow, focus_window
     import PySimpleGUI as Sg
-    from modules.db import DatabaseConnection, init_db
+    from modules.db import (ArtworkStore, BatchWriter, DatabaseConnection, UrlMetadataCache, URL_STREAM_KEYS, init_db,
+                            search_library)
+    from modules.compression import StaticAssets, compress_response
+    from modules.dz_cache import DzCache, SEGMENT_SIZE as DZ_SEGMENT_SIZE, decrypt_segment as decrypt_dz_segment
+    from modules.events import EventBroker, EventDispatcher
+    from modules.file_response import send_local_file
+    from modules.http_session import session as http_session
+    from modules.fs_watcher import FolderWatcher
+    from modules.scan_queue import ScanQueue
+    from modules.url_refresher import UrlRefresher
 
     # 0.5 seconds gone to 3rd party imports
     from flask import Flask, jsonify, render_template, request, redirect, send_file, Response, make_response
@@ -320,17 +339,25 @@ if __name__ == '__main__':
     gui_window.close()
 
     WELCOME_MSG = t('Thanks for installing Music Caster.') + '\n' + t('Music Caster is running in the tray.')
-    uris_to_scan = Queue()
     PRESSED_KEYS = set()
     settings_file_lock = threading.Lock()
     last_play_command = settings_last_modified = 0
     update_last_checked = time.time()  # check every hour
     cast: Chromecast = None  # type: ignore
-    all_tracks, url_metadata, all_tracks_sorted = {}, {}, []
+    all_tracks, url_metadata = LibraryIndex(), UrlMetadataCache()
+    artwork_store = ArtworkStore()
+    thumbnail_cache = ThumbnailCache(artwork_store)
+    dz_cache = DzCache()
+    # whether all_tracks has been loaded from the database or a library scan has finished
+    library_loaded = False
     tray_playlists = [t('Playlists Tab')]
     CHECK_MARK = '✓'
     music_folders, device_names = [], [(f'{CHECK_MARK} ' + t('Local device'), 'device:0')]
     music_queue, done_queue, next_queue = deque(), deque(), deque()
+    # set when the upcoming tracks change so that prefetch_upcoming warms them
+    prefetch_event = threading.Event()
+    # seconds that the last track changes took from next_track being called until the track was playing
+    track_change_times = deque(maxlen=50)
     # usage: background_thread sleep(1) if seek_queue, seek_queue.pop(), seek_queue.clear(), call set_pos
     seek_queue = []
     playing_url = deezer_opened = attribute_error_reported = False
@@ -375,14 +402,20 @@ if __name__ == '__main__':
         'track_format': '&artist - &title', 'reversed_play_next': False, 'update_message': '', 'important_message': '',
         'music_folders': [get_default_music_folder()], 'playlists': {}, 'queues': {'done': [], 'music': [], 'next': []},
         'position': 0, 'plugged_in_res': None, 'on_battery_res': None, 'experimental_features': False,
-        'api_key': secrets.token_urlsafe(16)}
+        'api_key': secrets.token_urlsafe(16), 'metadata_workers': 0,  # 0 workers = one per CPU
+        'prefetch_tracks': 3, 'web_threads': 8, 'web_connection_limit': 100, 'dz_cache_mb': 512,
+        'folder_poll_minutes': 30}  # only where the file system cannot report changes (macOS)
     default_settings = deepcopy(settings)
     indexing_tracks_thread = save_queue_thread = Thread()
+    folder_watcher: FolderWatcher | None = None
     playing_status = PlayingStatus()
     sar = SystemAudioRecorder()
-    app = Flask(__name__)
+    # static/ is served by api_static
+    app = Flask(__name__, static_folder=None)
+    static_assets = StaticAssets(Path(app.root_path) / 'static')
 
     app.jinja_env.lstrip_blocks = app.jinja_env.trim_blocks = True
+    app.jinja_env.globals['static_url'] = static_assets.url
     os.environ['WERKZEUG_RUN_MAIN'] = 'true'
     os.environ['FLASK_SKIP_DOTENV'] = '1'
     # if time.time() > SYNC_WITH_CHROMECAST good to sync from chromecast
@@ -393,6 +426,11 @@ if __name__ == '__main__':
     LAST_PLAYED = time.time()
     connection = DatabaseConnection.create_connection()
     init_db()
+    url_metadata.load()
+    for _metadata in url_metadata.values():
+        if 'file_url' in _metadata:
+            # the /dz/ url of a Deezer track has the address of the session that resolved it
+            _metadata['expiry'] = 0
 
     def get_line_number():
         cf = currentframe()
@@ -528,6 +566,8 @@ if __name__ == '__main__':
 
     def save_queues():
         global save_queue_thread
+        publish_events('queue')
+        url_refresher.wake()
 
         def _save_queue():
             settings['queues']['done'] = tuple(done_queue)
@@ -557,6 +597,7 @@ if __name__ == '__main__':
             # exceptions: NotConnected, RequestTimeout, RequestFailed
             set_volume_Thread = Thread(target=cast.set_volume, args=(new_vol,), name='CastSetVolume', daemon=True)
             set_volume_Thread.start()
+        publish_events('volume')
 
 
     def cycle_repeat():
@@ -603,7 +644,7 @@ if __name__ == '__main__':
                    'MAC': hashlib.md5(get_mac().encode()).hexdigest(), 'OS': platform.platform(), 'TIME': current_time}
         if IS_FROZEN:
             with suppress(requests.RequestException):
-                requests.post('https://lenerva.com/telemetry/music-caster/error/', json=payload, timeout=1)
+                http_session.post('https://lenerva.com/telemetry/music-caster/error/', json=payload, timeout=1)
         try:
             with open('error.log', 'r', encoding='utf-8') as _f:
                 content = _f.read()
@@ -634,28 +675,98 @@ if __name__ == '__main__':
             if uri.startswith('http'):
                 if url_metadata.get(uri, {}).get('art') in ('None', None):
                     return custom_art('URL')
-                if 'art_data' in url_metadata[uri]:
-                    return url_metadata[uri]['art_data']
-                # use 'art_data' else download 'art' link and cache to 'art_data'
-                url_metadata[uri]['art_data'] = b64encode(requests.get(url_metadata[uri]['art']).content)
-                return url_metadata[uri]['art_data']
+                # use 'art_hash' else download 'art' link into artwork_store
+                art = artwork_store.get(url_metadata[uri].get('art_hash', ''))
+                return (art or artwork_store.get(store_url_art(url_metadata[uri])))[1]
             return get_album_art(uri, settings['folder_cover_override'])[1]
-        return DEFAULT_ART
+        return DEFAULT_ART_BYTES
 
 
-    def get_metadata_wrapped(file_path: str) -> dict:  # keys: title, artist, album, sort_key
+    def get_current_thumbnail(size=COVER_NORMAL):
+        """ get_current_art() resized to size, the art of files is only resized once thanks to thumbnail_cache """
+        bg = settings['theme']['background']
+        if not sar.alive and playing_status.busy() and music_queue and not music_queue[0].startswith('http'):
+            return thumbnail_cache.get(music_queue[0], size, bg, settings['folder_cover_override'])
+        try:
+            return resize_art(get_current_art(), bg, size, default_art=DEFAULT_ART_BYTES)
+        except OSError as e:
+            handle_exception(e)
+            return resize_art(DEFAULT_ART_BYTES, bg, size)
+
+
+    def get_current_thumbnail_hash(size=COVER_NORMAL):
+        """ the hash of get_current_thumbnail(size) in artwork_store, which serves it at /art/<hash> """
+        bg = settings['theme']['background']
+        if sar.alive:
+            key = f'current:SYS:{tuple(size)}:{bg}'
+        elif playing_status.busy() and music_queue:
+            uri = music_queue[0]
+            if not uri.startswith('http'):
+                return thumbnail_cache.get_hash(uri, size, bg, settings['folder_cover_override'])
+            metadata = url_metadata.get(uri, {})
+            if (art_hash := metadata.get('art_hash')) is not None:
+                key = f'url-thumbnail:{art_hash}:{tuple(size)}:{bg}'
+            elif metadata.get('art') in ('None', None):
+                key = f'current:URL:{tuple(size)}:{bg}'
+            else:
+                # the art is downloaded by get_current_art() and sets art_hash for the next call
+                # keyed so that prune() keeps the thumbnail that is being served
+                return artwork_store.put(get_current_thumbnail(size), 'image/png', key=f'current:{tuple(size)}')
+        else:
+            key = f'current:DEFAULT:{tuple(size)}:{bg}'
+        # every thumbnail but that of a url being downloaded is only resized once per size and background
+        thumbnail_hash = artwork_store.lookup(key)
+        if thumbnail_hash is None or artwork_store.get(thumbnail_hash) is None:
+            thumbnail_hash = artwork_store.put(get_current_thumbnail(size), 'image/png', key=key)
+        return thumbnail_hash
+
+
+    def get_metadata_wrapped(file_path: str) -> Track:  # keys: title, artist, album, sort_key
         try:
             if file_path.startswith('http'):
                 raise ValueError('expected file not http...')
-            m = get_metadata(file_path)
-            return m
+            return Track(**get_metadata(file_path))
         except (MutagenError, ValueError):
-            try:
-                return all_tracks[Path(file_path).as_posix()]
-            except KeyError:
-                # i forget the reason why we have the time_modified so high
-                return {'title': Unknown('Title'), 'artist': Unknown('Artist'), 'explicit': False, 'time_modified': os.path.getmtime(file_path),
-                        'album': Unknown('Title'), 'sort_key': get_file_name(file_path), 'track_number': '1'}
+            return get_fallback_metadata(file_path)
+
+
+    def get_fallback_metadata(file_path: str) -> Track:
+        """ metadata to use for a file whose tags could not be read """
+        try:
+            return all_tracks[Path(file_path).as_posix()]
+        except KeyError:
+            # i forget the reason why we have the time_modified so high
+            stat = os.stat(file_path)
+            return Track(Unknown('Title'), Unknown('Artist'), Unknown('Album'), sort_key=get_file_name(file_path),
+                         time_modified=stat.st_mtime, size=stat.st_size)
+
+
+    def metadata_from_row(row) -> Track:
+        """ converts a file_metadata row back into the record that get_metadata_wrapped returns """
+        return Track(row['title'] or Unknown('Title'), row['artist'] or Unknown('Artist'), row['album'] or Unknown('Album'),
+                     row['explicit'], row['sort_key'], str(row['track_number']), row['time_modified'], row['size'],
+                     row['length'])
+
+
+    def get_metadata_parallel(file_paths: list):
+        """
+        Reads the tags of file_paths using a process pool of settings['metadata_workers'] processes
+        :return: generator of (file_path, metadata) in the same order as file_paths
+        """
+        workers = settings['metadata_workers'] or os.cpu_count() or 1
+        if workers == 1 or len(file_paths) < workers * 8:
+            # not worth the overhead of spawning processes
+            for file_path in file_paths:
+                yield file_path, get_metadata_wrapped(file_path)
+            return
+        chunksize = max(1, min(64, len(file_paths) // (workers * 4)))
+        # spawned rather than forked since a fork could copy a lock held by one of the other threads of this process
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'),
+                                                    initializer=init_metadata_worker,
+                                                    initargs=(State.lang, State.track_format)) as executor:
+            for file_path, metadata in executor.map(get_metadata_worker, file_paths, chunksize=chunksize):
+                # records are built here so that their strings are interned in this process
+                yield file_path, get_fallback_metadata(file_path) if metadata is None else Track(**metadata)
 
 
     def get_uri_metadata(uri, read_file=True):
@@ -690,10 +801,42 @@ if __name__ == '__main__':
         return {'artist': '', 'title': t('Nothing Playing'), 'album': ''}
 
 
+    def get_event_data(event) -> dict:
+        """ the data of an event of /events/, which is the new state of one part of the player """
+        match event:
+            case 'track':
+                metadata = get_current_metadata()
+                return {'title': str(metadata['title']), 'artist': str(metadata['artist']),
+                        'album': str(metadata['album']), 'track_length': track_end - track_start}
+            case 'status':
+                return {'status': str(playing_status), 'track_position': get_track_position(), 'lang': settings['lang']}
+            case 'volume':
+                return {'volume': settings['volume'], 'muted': settings['muted']}
+            case 'queue':
+                return {'queue_length': len(done_queue) + len(music_queue) + len(next_queue),
+                        'playing_index': len(done_queue)}
+            case 'device':
+                return {'device': settings['device']}
+            case 'scan':
+                return {'scanning': len(scan_queue), 'library_size': len(all_tracks), 'library_loaded': library_loaded}
+        raise ValueError(f'unknown event {event}')
+
+
+    def get_event_snapshot() -> dict:
+        return {event: get_event_data(event) for event in ('track', 'status', 'volume', 'queue', 'device', 'scan')}
+
+
+    def publish_events(*events):
+        """ pushes the new data of events to the subscribers of /events/, the data is only read if there are any """
+        if event_broker.subscribers:
+            for event in events:
+                event_broker.publish(event, get_event_data(event))
+
+
     def get_audio_uris(uris: Iterable, scan_uris=True, ignore_m3u=False, parsed_m3us=None, ignore_dir=False):
         """
         :param uris: A list of URIs (urls, folders, m3u files, files)
-        :param scan_uris: whether to add to uris_to_scan
+        :param scan_uris: whether to add to scan_queue
         :param ignore_m3u: whether to ignore .m3u(8) files
         :param parsed_m3us: m3u files that have already been parsed. This is to avoid recursive parsing
         :param ignore_dir: whether to scan uri if it is a dir
@@ -710,10 +853,11 @@ if __name__ == '__main__':
                 yield from get_audio_uris(settings['playlists'][uri], scan_uris=scan_uris, ignore_m3u=ignore_m3u,
                                           parsed_m3us=parsed_m3us)
             elif os.path.isdir(uri) and not ignore_dir:
-                # if scanning a folder,
-                #  ignore playlist files and folders that are named as files as they aren't audio files
-                yield from get_audio_uris(glob.iglob(f'{glob.escape(uri)}/**/*.*', recursive=True), ignore_dir=True,
-                                          scan_uris=scan_uris, ignore_m3u=True, parsed_m3us=parsed_m3us)
+                # if scanning a folder, ignore playlist files as they aren't audio files
+                for file_path in scan_folder(uri):
+                    if scan_uris and file_path not in all_tracks:
+                        scan_queue.put(file_path)
+                    yield file_path
             elif os.path.isfile(uri):
                 uri = Path(uri).absolute().as_posix()
                 if not ignore_m3u and (uri.endswith('.m3u') or uri.endswith('.m3u8')) and uri not in parsed_m3us:
@@ -721,14 +865,25 @@ if __name__ == '__main__':
                     yield from get_audio_uris(parse_m3u(uri), parsed_m3us=parsed_m3us)
                 elif valid_audio_file(uri):
                     if scan_uris and uri not in all_tracks:
-                        uris_to_scan.put(uri)
+                        scan_queue.put(uri)
                     yield uri
             elif uri.startswith('http'):
                 if scan_uris and uri not in url_metadata:
-                    uris_to_scan.put(uri)
+                    scan_queue.put(uri)
                 yield uri
 
 
+    def load_library_from_db():
+        """ populates all_tracks with the file_metadata table """
+        global library_loaded
+        with DatabaseConnection() as conn:
+            tracks = {row['file_path']: metadata_from_row(row) for row in conn.execute('SELECT * FROM file_metadata')}
+        if tracks:
+            all_tracks.replace(tracks)
+            library_loaded = True
+            gui_window.metadata['update_listboxes'] = True
+
+
     def index_all_tracks(update_global=True, ignore_files: set | None = None) -> dict:
         """
         returns the music library dict if update_global is False
@@ -736,7 +891,7 @@ if __name__ == '__main__':
         ignore_files is a list (converted to set) of files to not include in the return value / scan
             usually used with update_global=False (think about it)
         """
-        global indexing_tracks_thread, all_tracks
+        global indexing_tracks_thread
         # make sure ignore_files is a set
         if ignore_files is None:
             ignore_files = set()
@@ -746,50 +901,82 @@ if __name__ == '__main__':
             Scans folders provided in settings and adds them to a dictionary
             Does not ignore the files that in ignore_files by design
             """
-            global all_tracks, all_tracks_sorted
+            global library_loaded
             use_temp = len(all_tracks)  # use temp if all_tracks is not empty
             all_tracks_temp = {}
             dict_to_use = all_tracks_temp if use_temp else all_tracks
             # scan items in queue and library
             with DatabaseConnection() as conn:
-                cur = conn.cursor()
-                for i, uri in enumerate(get_audio_uris((settings['queues'].values(), music_folders), scan_uris=False, ignore_m3u=True)):
+                # only files whose (time_modified, size) changed since the last scan need their tags read again
+                indexed_stats = {row['file_path']: (row['time_modified'], row['size'])
+                                 for row in conn.execute('SELECT file_path, time_modified, size FROM file_metadata')}
+            # this thread is the single writer of the library, metadata workers only parse tags
+            with BatchWriter() as writer:
+                files_to_index, files_to_load, files_seen, urls_used = [], set(), set(), set()
+                for uri in get_audio_uris((settings['queues'].values(), music_folders), scan_uris=False, ignore_m3u=True):
                     if uri.startswith('http'):
-                        url_metadatas = get_url_metadata(uri)
-                        for m in url_metadatas:
-                            values = [uri]
-                            values.extend((int(x) if isinstance(x, bool) else x for x in m.values()))
-                            columns = ','.join(m.keys())
-                            placeholders = ','.join('?' * len(values))
-                            sql = f'INSERT OR REPLACE INTO url_metadata(src,{columns}) VALUES({placeholders})'
-                            cur.execute(sql, values)
-                    else:
-                        m = get_metadata_wrapped(uri)
-                        dict_to_use[uri] = m
-                        values = [uri]
-                        values.extend((int(x) if isinstance(x, bool) else x for x in m.values()))
-                        columns = ','.join(m.keys())
-                        placeholders = ','.join('?' * len(values))
-                        sql = f'INSERT OR REPLACE INTO file_metadata(file_path,{columns}) VALUES({placeholders})'
-                        cur.execute(sql, values)
-                    if i % 20 == 0:
-                        conn.commit()
-                conn.commit()
+                        # written to url_metadata by get_url_metadata
+                        get_url_metadata(uri)
+                        urls_used.add(uri)
+                    elif uri not in files_seen:
+                        files_seen.add(uri)
+                        try:
+                            stat = os.stat(uri)
+                        except OSError:
+                            continue
+                        if indexed_stats.get(uri) != (stat.st_mtime, stat.st_size):
+                            # tags are read in parallel below
+                            files_to_index.append(uri)
+                        elif uri in all_tracks:
+                            dict_to_use[uri] = all_tracks[uri]
+                        else:
+                            files_to_load.add(uri)
+                if files_to_load:
+                    for row in writer.conn.execute('SELECT * FROM file_metadata'):
+                        if row['file_path'] in files_to_load:
+                            dict_to_use[row['file_path']] = metadata_from_row(row)
+                # forget files that were deleted or are no longer in a music folder or queue, but only where the scan
+                # could see, so that a music folder on a drive or share that is offline keeps its metadata
+                folders = tuple(os.path.abspath(folder).replace('\\', '/').rstrip('/') + '/' for folder in music_folders)
+                # a music folder that was walked without finding a single file is likely an empty mount point
+                walked_folders = tuple(folder for folder in folders
+                                       if any(file_path.startswith(folder) for file_path in files_seen))
+                for file_path in indexed_stats.keys() - files_seen:
+                    if file_path.startswith(folders):
+                        if not file_path.startswith(walked_folders):
+                            continue
+                    elif not os.path.isdir(os.path.dirname(file_path)):
+                        # a file that was in a queue whose drive is offline
+                        continue
+                    writer.delete('file_metadata', 'file_path', file_path)
+                for uri, m in get_metadata_parallel(files_to_index):
+                    dict_to_use[uri] = m
+                    writer.upsert('file_metadata', {'file_path': uri, **m})
                 if use_temp:
-                    all_tracks = all_tracks_temp
+                    # only the tracks that changed are re-inserted into the sorted views
+                    all_tracks.replace(all_tracks_temp)
+                library_loaded = True
                 gui_window.metadata['update_listboxes'] = True
-                # TODO
-                # tracks = cur.execute('SELECT * FROM file_metadata ORDER BY sort_key').fetchall()
-                all_tracks_sorted = sorted(all_tracks.items(), key=lambda item: item[1]['sort_key'])
-                # scan items in playlists
-                for _ in get_audio_uris(settings['playlists'].values(), ignore_m3u=True):
-                    # the function scans for us
-                    pass
+                publish_events('scan')
+                # scan items in playlists, the function scans for us
+                for uri in get_audio_uris(settings['playlists'].values(), ignore_m3u=True):
+                    if uri.startswith('http'):
+                        urls_used.add(uri)
+            with suppress(sqlite3.Error):
+                urls_used.update(uri for uri in (*done_queue, *music_queue, *next_queue) if uri.startswith('http'))
+                if deleted_urls := url_metadata.prune(urls_used):
+                    app_log.info(f'deleted the metadata of {deleted_urls} urls that were no longer used')
+                if deleted_art := artwork_store.prune():
+                    app_log.info(f'deleted {deleted_art} images that were no longer used')
         if not update_global:
             temp_tracks = all_tracks.copy()
             for ignore_file in ignore_files:
                 temp_tracks.pop(ignore_file, None)
             return temp_tracks
+        if not all_tracks:
+            # warm start from the last scan, _index_library then verifies it against the file system
+            load_library_from_db()
+        watch_music_folders()
         if indexing_tracks_thread is None:
             indexing_tracks_thread = Thread(target=_index_library, daemon=True, name='IndexLibrary')
             indexing_tracks_thread.start()
@@ -798,9 +985,53 @@ if __name__ == '__main__':
             indexing_tracks_thread.start()
 
 
+    def on_music_folders_change(changed: set, deleted: set):
+        """
+        Applies a batch of file system events from the folder watcher to the library
+        Runs on the thread of the folder watcher, which an exception would stop
+        """
+        try:
+            deleted_folders = tuple(f'{folder}/' for folder in deleted)
+            # the indexer changes all_tracks meanwhile, so a snapshot taken under its lock is searched
+            removed = {uri for uri in all_tracks.copy() if uri in deleted or uri.startswith(deleted_folders)}
+            changed = [uri for uri in changed if os.path.isfile(uri)]
+            removed.difference_update(changed)
+            if not changed and not removed:
+                return
+            updated = dict(get_metadata_parallel(changed))
+            with BatchWriter() as writer:
+                for uri in removed:
+                    writer.delete('file_metadata', 'file_path', uri)
+                for uri, metadata in updated.items():
+                    writer.upsert('file_metadata', {'file_path': uri, **metadata})
+            for uri in removed:
+                all_tracks.pop(uri, None)
+            all_tracks.update(updated)
+            gui_window.metadata['update_library'] = gui_window.metadata['update_listboxes'] = True
+        except Exception as e:
+            app_log.error(f'could not apply {len(changed)} changed and {len(deleted)} deleted files: {e!r}')
+
+
+    def watch_music_folders(stop=False):
+        """ (re)starts watching the music folders for changes unless they are already being watched """
+        global folder_watcher
+        folders = [os.path.abspath(folder).replace('\\', '/') for folder in music_folders]
+        poll_interval = max(settings['folder_poll_minutes'], 1) * 60
+        if folder_watcher is not None:
+            if not stop and folder_watcher.is_alive() and folder_watcher.folders == folders:
+                folder_watcher.poll_interval = poll_interval
+                return
+            folder_watcher.stop()
+            folder_watcher = None
+        if not stop:
+            folder_watcher = FolderWatcher(folders, AUDIO_EXTS, on_change=on_music_folders_change,
+                                           on_overflow=index_all_tracks, excluded_dir_names=EXCLUDED_DIR_NAMES,
+                                           poll_interval=poll_interval).start()
+
+
     def download(url, outfile):
         # throws ConnectionAbortedError
-        r = requests.get(url, stream=True)
+        r = http_session.get(url, stream=True)
         if outfile.endswith('.zip'):
             outfile = outfile.replace('.zip', '')
             z = zipfile.ZipFile(io.BytesIO(r.content))
@@ -872,6 +1103,7 @@ if __name__ == '__main__':
                 settings['device'] = settings.pop('previous_device')
             State.lang = settings['lang']
             State.track_format = settings['track_format']
+            dz_cache.max_bytes = settings['dz_cache_mb'] * 2 ** 20
             fg, bg, accent = theme['text'], theme['background'], theme['accent']
 
             GuiContext.update(fg, bg, accent, settings['experimental_features'])
@@ -959,6 +1191,31 @@ if __name__ == '__main__':
         return {'message': api_msg} if ('is_api' in request.args or request.method == 'POST') else redirect('/')
 
 
+    @app.after_request
+    def compress_after_request(response):
+        return compress_response(response, request.accept_encodings)
+
+
+    @app.get('/static/<path:filename>')
+    def api_static(filename):
+        # index.html links to static_url(filename), which has the hash of the file, so it can be cached forever
+        if (asset := static_assets.get(filename, request.accept_encodings)) is None:
+            return jsonify({'error': 'file not found'}), 404
+        data, mimetype, encoding, etag, immutable = asset
+        response = make_response(data)
+        response.mimetype = mimetype
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        if immutable:
+            response.cache_control.public = response.cache_control.immutable = True
+            response.cache_control.max_age = 31536000
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+
     @app.route('/', methods=['GET', 'POST'])
     def web_index():  # web GUI
         request_data = get_request_data()
@@ -970,23 +1227,12 @@ if __name__ == '__main__':
         # if request_data.get('api_key') != api_key:
         #     return jsonify({'error': 'Unauthorized, api_key=not-provided'}), 401
         metadata = get_current_metadata()
-        art = get_current_art()
-        if isinstance(art, bytes):
-            art = art.decode()
-        art = f'data:image/png;base64,{art}'
+        art = f'/art/{get_current_thumbnail_hash(COVER_WEB)}'
         repeat_option = settings['repeat']
         repeat_enabled = 'repeat-enabled' if settings['repeat'] is not None else ''
         shuffle_enabled = 'shuffle-enabled' if settings['shuffle'] else ''
-        # sort by the formatted title
-        if all_tracks_sorted:
-            sorted_tracks = all_tracks_sorted
-        else:
-            sorted_tracks = sorted(
-                all_tracks.items(), key=lambda item: item[1]['sort_key']
-            )
-        list_of_tracks = [{'text': format_uri(filename),
-                           'filename': pathname2url(filename).strip('/')} for filename, _ in sorted_tracks]
-        _queue = create_track_list()
+        # the library and the queue are fetched a page at a time from /api/library/ and /api/queue/
+        queue_length = len(done_queue) + len(music_queue) + len(next_queue)
         device_index = 0
         for i, devices in enumerate(device_names):
             if devices[0].startswith(CHECK_MARK):
@@ -1007,13 +1253,66 @@ if __name__ == '__main__':
         try:
             return render_template('index.html', device_name=platform.node(), shuffle=shuffle_enabled, version=VERSION,
                                    repeat_enabled=repeat_enabled, playing_status=playing_status, metadata=metadata,
-                                   settings=settings, list_of_tracks=list_of_tracks, repeat_option=repeat_option, gt=t,
-                                   queue=_queue, playing_index=len(done_queue), device_index=device_index, art=art,
+                                   settings=settings, repeat_option=repeat_option, gt=t, queue_length=queue_length,
+                                   playing_index=len(done_queue), device_index=device_index, art=art,
                                    devices=formatted_devices, stream_url=stream_url, stream_time=stream_time)
         except TemplateNotFound:
             return redirect('https://github.com/elibroftw/music-caster/releases/latest')
 
 
+    @app.get('/search/')
+    def api_search():
+        """ ?q=words to search the library with, each word matching as a prefix of a title, artist, album, or file name """
+        request_data = get_request_data()
+        query = request_data.get('q', '')
+        try:
+            limit = min(max(int(request_data.get('limit', 50)), 1), 500)
+        except ValueError:
+            limit = 50
+        return jsonify([{'file_path': file_path, 'title': str(track['title']), 'artist': str(track['artist']),
+                         'album': str(track['album'])} for file_path, track in search_tracks(query, limit)])
+
+
+    def get_page_args(request_data, max_limit=500) -> tuple:
+        """ :return: (offset, limit) from ?offset=&limit= """
+        try:
+            offset = max(int(request_data.get('offset', 0)), 0)
+            limit = min(max(int(request_data.get('limit', 100)), 1), max_limit)
+        except ValueError:
+            offset, limit = 0, 100
+        return offset, limit
+
+
+    @app.get('/api/library/')
+    def api_library():
+        """
+        ?offset=&limit=&sort=&q= a page of the library sorted by sort_key, title, artist, or album
+        descending if sort starts with '-', or of the best matches of q
+        """
+        request_data = get_request_data()
+        offset, limit = get_page_args(request_data)
+        sort = request_data.get('sort', 'sort_key')
+        reverse = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if sort not in LibraryIndex.VIEW_KEYS:
+            return jsonify({'error': f'sort must be one of {", ".join(LibraryIndex.VIEW_KEYS)}'}), 400
+        if query := request_data.get('q', ''):
+            tracks = search_tracks(query, limit=500)
+            total, tracks = len(tracks), tracks[offset:offset + limit]
+        else:
+            total, tracks = len(all_tracks), all_tracks.sorted_items(sort, reverse, offset, offset + limit)
+        items = [{'text': format_uri(file_path), 'filename': pathname2url(file_path).strip('/')} for file_path, _ in tracks]
+        return jsonify({'total': total, 'offset': offset, 'items': items})
+
+
+    @app.get('/api/queue/')
+    def api_queue():
+        """ ?offset=&limit= a page of the queue, playing_index is the index of the track that is playing """
+        offset, limit = get_page_args(get_request_data())
+        return jsonify({'total': len(done_queue) + len(music_queue) + len(next_queue), 'playing_index': len(done_queue),
+                        'offset': offset, 'items': create_track_list(offset, offset + limit)})
+
+
     @app.route('/status/')
     @app.route('/state/')
     def api_state():
@@ -1071,6 +1370,14 @@ if __name__ == '__main__':
                     play_uris([request_data['uri']], queue_uris=queue_only, play_next=play_next, merge_tracks=merge_plays)
                     if settings['queue_library']:
                         queue_all()
+            elif 'query' in request_data:
+                # e.g. "deadmau5 so there i was" from a voice assistant, typos are tolerated
+                matches = all_tracks.fuzzy_search(request_data['query'], limit=1)
+                if not matches:
+                    return jsonify({'error': f'No track matches {request_data["query"]}'}), 404
+                play_uris([matches[0][0]], queue_uris=queue_only, play_next=play_next, merge_tracks=merge_plays)
+                if settings['queue_library']:
+                    queue_all()
         else:
             recent_api_plays['play'] += 1
         return redirect('/') if request.method == 'GET' else api_state()
@@ -1097,7 +1404,10 @@ if __name__ == '__main__':
             return jsonify({'pressed_keys': list(PRESSED_KEYS),
                             'last_traceback': sys.exc_info(),
                             'threads': threads,
-                            'mac': get_mac()})
+                            'mac': get_mac(),
+                            'track_change_ms': [round(seconds * 1000) for seconds in track_change_times],
+                            'event_subscribers': event_broker.subscribers,
+                            'http': http_session.stats()})
         return t('set DEBUG = true in `settings.json` to enable this page')
 
 
@@ -1222,53 +1532,90 @@ if __name__ == '__main__':
             file_path = request.args['path']
             if os.path.isfile(file_path) and valid_audio_file(file_path) or file_path == 'DEFAULT_ART':
                 if request.args.get('thumbnail_only', False) or file_path == 'DEFAULT_ART':
-                    mime_type, img_data = get_album_art(file_path, settings['folder_cover_override'])
-                    img_data = b64decode(img_data)
-                    try:
-                        ext = mime_type.rsplit('/', 1)[1]
-                    except IndexError:
-                        ext = 'png'
-                    return send_file(io.BytesIO(img_data), download_name=f'cover.{ext}',
-                                     mimetype=mime_type, as_attachment=True, max_age=360000, conditional=True)
-                return send_file(file_path, conditional=True, as_attachment=True, max_age=360000)
+                    art_hash = thumbnail_cache.get_hash(file_path, COVER_WEB, settings['theme']['background'],
+                                                        settings['folder_cover_override'])
+                    return redirect(f'/art/{art_hash}')
+                return send_local_file(request, file_path, max_age=360000)
         return '400'
 
 
+    @app.get('/art/<art_hash>')
+    def api_get_art(art_hash):
+        # the url changes whenever the image does, so it can be cached forever
+        if (art := artwork_store.get(art_hash)) is None:
+            return jsonify({'error': 'artwork not found'}), 404
+        mime, data = art
+        response = send_file(io.BytesIO(data), mimetype=mime, etag=art_hash, max_age=31536000, conditional=True)
+        response.cache_control.immutable = True
+        return response
+
+
     @app.route('/dz/')
     def api_get_dz():
-        from Cryptodome.Cipher import Blowfish
-        if 'url' in request.args:
-            # TODO: cache content to prevent extra requests
-            url = request.args['url']
-            metadata = url_metadata[url]
-            file_url = metadata['file_url']
-            range_header = {'Range': request.headers.get('Range', 'bytes=0-')}
-            r = requests.get(file_url, headers=range_header, stream=True)
-            start_bytes = int(range_header['Range'].split('=', 1)[1].split('-', 1)[0])
-            blowfish_key = metadata['bf_key']
-            iv = b'\x00\x01\x02\x03\x04\x05\x06\x07'
-
-            def generate():
-                nonlocal start_bytes
-                # if start_bytes is not a multiple of 2048, first yield will be < 2048 to fix the chunks
-                extra_bytes = start_bytes % 2048
-                if extra_bytes != 0:
-                    extra_bytes = 2048 - extra_bytes
-                    chunk = next(r.iter_content(extra_bytes))
-                    if start_bytes // 2048 == 0:
-                        chunk = Blowfish.new(blowfish_key, Blowfish.MODE_CBC, iv).decrypt(chunk)
-                    yield chunk
-                    start_bytes += extra_bytes
-                for i, chunk in enumerate(r.iter_content(2048), start_bytes // 2048):
-                    if (i % 3) == 0 and len(chunk) == 2048:
-                        chunk = Blowfish.new(blowfish_key, Blowfish.MODE_CBC, iv).decrypt(chunk)
-                    yield chunk
-
-            content_type = r.headers['Content-Type']
-            rv = Response(generate(), 206, mimetype=content_type, content_type=content_type)
-            rv.headers['Content-Range'] = r.headers['Content-Range']
-            return rv
-        return '400'
+        """
+        Decrypts a Deezer stream for a cast device, serving the byte ranges that were streamed before from dz_cache
+        Upstream is only requested from the first segment that is not cached,
+            and is closed as soon as the next segment is cached
+        """
+        if 'url' not in request.args:
+            return '400'
+        url = request.args['url']
+        metadata = url_metadata[url]
+        start, stop = 0, None
+        if request.range is not None and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+            start, stop = request.range.ranges[0]
+        upstream, upstream_index = None, max(start, 0) // DZ_SEGMENT_SIZE
+
+        def open_upstream(index):
+            r = http_session.get(metadata['file_url'], headers={'Range': f'bytes={index * DZ_SEGMENT_SIZE}-'},
+                                 stream=True)
+            r.raise_for_status()
+            return r
+
+        if (info := dz_cache.get_info(url)) is None:
+            upstream = open_upstream(upstream_index)
+            info = int(upstream.headers['Content-Range'].rsplit('/', 1)[1]), upstream.headers['Content-Type']
+            dz_cache.set_info(url, *info)
+        size, content_type = info
+        if start < 0:  # the last -start bytes
+            start, stop = max(size + start, 0), size
+        stop = size if stop is None else min(stop, size)
+        if start >= stop:
+            if upstream is not None:
+                upstream.close()
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+        def generate():
+            nonlocal upstream, upstream_index
+            try:
+                for index in range(start // DZ_SEGMENT_SIZE, (stop - 1) // DZ_SEGMENT_SIZE + 1):
+                    data = dz_cache.get(url, index)
+                    if data is None:
+                        if upstream is None or upstream_index != index:
+                            if upstream is not None:
+                                upstream.close()
+                            upstream, upstream_index = open_upstream(index), index
+                        data = upstream.raw.read(DZ_SEGMENT_SIZE, decode_content=True)
+                        upstream_index += 1
+                        data = decrypt_dz_segment(metadata['bf_key'], data)
+                        # a segment cut short by upstream is sent but not cached
+                        if len(data) == min(DZ_SEGMENT_SIZE, size - index * DZ_SEGMENT_SIZE):
+                            dz_cache.put(url, index, data)
+                    elif upstream is not None:
+                        # reopened at the next segment that is not cached, if there is one
+                        upstream.close()
+                        upstream = None
+                    segment_start = index * DZ_SEGMENT_SIZE
+                    yield data[max(start - segment_start, 0):stop - segment_start]
+            finally:
+                if upstream is not None:
+                    upstream.close()
+
+        rv = Response(generate(), 206, mimetype=content_type, content_type=content_type)
+        rv.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        rv.headers['Accept-Ranges'] = 'bytes'
+        rv.content_length = stop - start
+        return rv
 
 
     @app.route('/system-audio/')
@@ -1278,7 +1625,7 @@ if __name__ == '__main__':
         send system audio to chromecast
         """
         if get_thumb:
-            return send_file(io.BytesIO(b64decode(custom_art('SYS'))), download_name='thumbnail.png',
+            return send_file(io.BytesIO(custom_art('SYS')), download_name='thumbnail.png',
                              mimetype='image/png', as_attachment=True, max_age=360000, conditional=True)
         return Response(sar.get_audio_data(settings['sys_audio_delay']))
 
@@ -1446,6 +1793,7 @@ if __name__ == '__main__':
         playing_status.stop()
         cast = new_device
         update_settings('device', None if cast is None else str(cast.uuid))
+        publish_events('device')
         refresh_tray(True)
         if was_busy and (music_queue or sar.alive):
             app_log.info('continuing playback on new device')
@@ -1574,31 +1922,31 @@ if __name__ == '__main__':
             return os.path.splitext(os.path.basename(uri))[0]
 
 
-    def create_track_list():
-        """Return usable list for queue listbox """
+    def create_track_list(start=0, stop=None):
+        """Return usable list for queue listbox, [start:stop] of the queue if given """
         try:
             max_digits = int(log10(max(len(music_queue) - 1 + len(next_queue), len(done_queue) * 10))) + 2
         except ValueError:
             max_digits = 0
-        i = -len(done_queue)
+        i = start - len(done_queue)
         tracks = []
         # format: Index | Artists - Title
         try:
-            for items in (done_queue, islice(music_queue, 0, 1), next_queue, islice(music_queue, 1, None)):
-                for uri in items:
-                    formatted_track = format_uri(uri, _for='queue')
-                    if settings['show_queue_index']:
-                        if i < 0:
-                            pre = f'\u2012{abs(i)} '.center(max_digits, '\u2000')
-                        else:
-                            pre = f'{i} '.center(max_digits, '\u2000')
-                        formatted_track = f'\u2004{pre}|\u2000{formatted_track}'
-                        i += 1
-                    tracks.append(formatted_track)
+            items = chain(done_queue, islice(music_queue, 0, 1), next_queue, islice(music_queue, 1, None))
+            for uri in islice(items, start, stop):
+                formatted_track = format_uri(uri, _for='queue')
+                if settings['show_queue_index']:
+                    if i < 0:
+                        pre = f'\u2012{abs(i)} '.center(max_digits, '\u2000')
+                    else:
+                        pre = f'{i} '.center(max_digits, '\u2000')
+                    formatted_track = f'\u2004{pre}|\u2000{formatted_track}'
+                    i += 1
+                tracks.append(formatted_track)
             return tracks
         except RuntimeError:
             # deque mutated during iteration
-            return create_track_list()
+            return create_track_list(start, stop)
 
 
     def update_gui():
@@ -1628,13 +1976,7 @@ if __name__ == '__main__':
             image_data = PAUSE_BUTTON_IMG if playing_status.playing() else PLAY_BUTTON_IMG
             gui_window['pause/resume'].update(image_data=image_data)
             if settings['show_album_art']:
-                size = COVER_MINI if settings['mini_mode'] else COVER_NORMAL
-                bg = settings['theme']['background']
-                try:
-                    album_art_data = resize_img(get_current_art(), bg, size, default_art=DEFAULT_ART)
-                except OSError as e:
-                    handle_exception(e)
-                    album_art_data = resize_img(DEFAULT_ART, bg, size)
+                album_art_data = b64encode(get_current_thumbnail(COVER_MINI if settings['mini_mode'] else COVER_NORMAL))
                 gui_window['artwork'].update(data=album_art_data)
             repeat_button: Sg.Button = gui_window['repeat']
             repeat_img, new_tooltip = repeat_img_tooltip(settings['repeat'])
@@ -1664,25 +2006,20 @@ if __name__ == '__main__':
             # system_media_controls.set_paused()
         refresh_tray()
         save_queues()
+        publish_events('track', 'status')
         DiscordPresence.update(settings['discord_rpc'], state=t('By') + f': {artists}', details=title,
                                large_text=t('Listening'))
         # update metadata of the player
         # if platform.system() == 'Windows':
-            # bg = settings['theme']['background']
-            # # base64
-            # try:
-            #     album_art_data = resize_img(get_current_art(), bg, COVER_NORMAL, default_art=DEFAULT_ART)
-            # except OSError as e:
-            #     handle_exception(e)
-            #     album_art_data = resize_img(DEFAULT_ART, bg, COVER_NORMAL)
-            # img_data = io.BytesIO(b64decode(album_art_data))
-            # album_art: Image.Image = Image.open(img_data)
+            # album_art_data = get_current_thumbnail(COVER_NORMAL)
+            # album_art: Image.Image = Image.open(io.BytesIO(album_art_data))
             # thumb_path = Path('thumb.jpg').absolute()
             # TODO: convert to mode RGB in case RGBA
             # album_art.save(thumb_path)
             # system_media_controls.set_metadata(title, artists, album, thumb_path.as_uri())
             # system_media_controls.update_time()
 
+        prefetch_event.set()
         if not gui_window.was_closed():
             gui_window.metadata['update_listboxes'] = True
             daemon_commands.put('__UPDATE_GUI__')
@@ -1786,20 +2123,22 @@ if __name__ == '__main__':
             metadata['art'] = item['thumbnail']
         return metadata
 
-    def get_url_metadata(url, fetch_art=True) -> list:
-        # TODO: cache in the database for persistence
+    def get_url_metadata(url, fetch_art=True, refresh=False) -> list:
         # TODO: move to utils.py and add parameter url_metadata_cache
         """
         Tries to parse url and set url_metadata[url] to parsed metadata
         Supports: YouTube, Soundcloud, any url ending with a valid audio extension
+        url_metadata is persisted, so once url has expired only its URL_STREAM_KEYS are taken from the new metadata
+        refresh: resolve url again even if it has not expired yet
         """
         from yt_dlp.utils import YoutubeDLError
         global deezer_opened, attribute_error_reported
         ytsearch = 'ytsearch1'
         metadata_list = []
         app_log.info('get_url_metadata: ' + url)
-        if url in url_metadata and not url_expired(url):
-            return [url_metadata[url]]
+        cached = url_metadata.get(url)
+        if cached is not None and not refresh and not url_expired(url):
+            return [cached]
         if url.startswith('www'):
             url = f'http://{url}'
         # short-circuit
@@ -1876,7 +2215,8 @@ if __name__ == '__main__':
                             metadata['ytid'] = entry['id']
                             # if duration > 10 minutes, try to parse out timestamps for track from comment section
                             if entry.get('duration', 0) > 600:
-                                metadata['timestamps'] = get_video_timestamps(entry)
+                                timestamps = url_metadata.get(entry['webpage_url'], {}).get('timestamps')
+                                metadata['timestamps'] = timestamps or get_video_timestamps(entry)
                             for webpage_url in get_yt_urls(entry['id']):
                                 url_metadata[webpage_url] = metadata
                             metadata_list.append(metadata)
@@ -1886,7 +2226,8 @@ if __name__ == '__main__':
                         metadata['ytid'] = r['id']
                         # if duration > 10 minutes, try to parse out timestamps for track from comment section
                         if r.get('duration', 0) > 600:
-                            metadata['timestamps'] = get_video_timestamps(r)
+                            timestamps = cached.get('timestamps') if cached is not None else None
+                            metadata['timestamps'] = timestamps or get_video_timestamps(r)
                         for webpage_url in get_yt_urls(r['id']):
                             url_metadata[webpage_url] = metadata
                         url_metadata[url] = metadata
@@ -1954,7 +2295,7 @@ if __name__ == '__main__':
                         metadata_list.append(metadata)
                         for spotify_track in islice(spotify_tracks, 1, None):
                             url_metadata[spotify_track['src']] = spotify_track
-                            uris_to_scan.put(spotify_track['src'])
+                            scan_queue.put(spotify_track['src'])
                             metadata_list.append(spotify_track)
         elif url.startswith('https://deezer.page.link') or url.startswith('https://www.deezer.com'):
             try:
@@ -1987,7 +2328,7 @@ if __name__ == '__main__':
                         metadata_list.append(metadata)
                         for deezer_track in islice(deezer_tracks, 1, None):
                             url_metadata[deezer_track['src']] = deezer_track
-                            uris_to_scan.put(deezer_track['src'])
+                            scan_queue.put(deezer_track['src'])
                             metadata_list.append(deezer_track)
         else:
             with suppress(IOError, TypeError, AttributeError, YoutubeDLError):
@@ -1999,19 +2340,35 @@ if __name__ == '__main__':
                 else:
                     url_metadata[url] = url_metadata[r['webpage_url']] = metadata = ydl_get_metadata(r)
                     metadata_list.append(metadata)
+        if (cached is not None and cached.get('url') and metadata_list
+                and metadata_list[0].get('src') == cached.get('src')):
+            # refreshed the stream of a url that was resolved before, its other metadata (e.g. art_hash) is kept
+            metadata_list[0].update({k: v for k, v in cached.items() if k not in URL_STREAM_KEYS and v is not None})
         if metadata_list and fetch_art:
             # fetch and cache artwork for first url
             metadata = metadata_list[0]
-            if metadata.get('art') is not None and 'art_data' not in metadata:
-                art_url = metadata['art']
+            if metadata.get('art') is not None and artwork_store.get(metadata.get('art_hash', '')) is None:
                 try:
-                    url_metadata[metadata['src']]['art_data'] = b64encode(requests.get(art_url).content)
+                    store_url_art(metadata)
                 except requests.RequestException as e:
-                    app_log.info(f'Could not fetch art url {art_url}')
+                    app_log.info(f'Could not fetch art url {metadata["art"]}')
                     handle_exception(e)
+        url_metadata.flush()
         return metadata_list
 
 
+    def store_url_art(metadata) -> str:
+        """ downloads metadata['art'] into artwork_store and sets metadata['art_hash'] """
+        r = http_session.get(metadata['art'])
+        r.raise_for_status()
+        metadata['art_hash'] = artwork_store.put(r.content, r.headers.get('content-type', 'image/jpeg'),
+                                                 key=f'url:{metadata["art"]}')
+        if metadata.get('src') in url_metadata:
+            url_metadata.touch(metadata['src'])
+            url_metadata.flush()
+        return metadata['art_hash']
+
+
     def play_url(position=0, autoplay=True, switching_device=False, show_error=False) -> bool:
         global cast, playing_url, track_length, track_start, track_end, track_position
         url = music_queue[0]
@@ -2030,11 +2387,15 @@ if __name__ == '__main__':
                 music_queue.popleft()
             music_queue.extendleft((metadata['src'] for metadata in reversed(metadata_list)))
         metadata = metadata_list[0]
+        # so that url_metadata.prune() keeps the urls that are played
+        url_metadata.touch(metadata['src'])
         title, artist, album = metadata['title'], metadata['artist'], metadata['album']
         ext = metadata['ext']
         url = metadata['audio_url'] if cast is None and 'audio_url' in metadata else metadata['url']
-        api_key = settings['api_key']
-        thumbnail = metadata['art'] if 'art' in metadata else f'{get_ipv4()}/file?path=DEFAULT_ART&api_key={api_key}'
+        if 'art' in metadata:
+            thumbnail = metadata['art']
+        else:
+            thumbnail = f'http://{get_ipv4()}:{State.PORT}/art/{get_current_thumbnail_hash(COVER_WEB)}'
         track_length = metadata['length']
         try:
             app_log.info(f'cast.socket_client.is_alive(): {cast.socket_client.is_alive()}')
@@ -2085,7 +2446,43 @@ if __name__ == '__main__':
         after_play(title, artist, album, autoplay, switching_device)
         return True
 
-    # up to 4 seconds!
+    def get_upcoming_uris(n) -> list:
+        """ the next n uris that next_track will play """
+        with suppress(RuntimeError):  # deque mutated during iteration
+            return [*islice(next_queue, n), *islice(music_queue, 1, n + 1)][:n]
+        return []
+
+
+    def prefetch_upcoming():
+        """
+        While a track plays, reads the tags and resizes the art of the next files and resolves the next urls
+        so that play() finds them in probe's cache, thumbnail_cache, and url_metadata
+        """
+        while True:
+            prefetch_event.wait()
+            prefetch_event.clear()
+            bg, folder_cover_override = settings['theme']['background'], settings['folder_cover_override']
+            sizes = [COVER_MINI if settings['mini_mode'] else COVER_NORMAL]
+            if cast is not None:
+                sizes.append(COVER_WEB)  # the size of the thumbnail that play() sends to cast devices
+            prefetch_tracks = settings['prefetch_tracks']
+            for uri in get_upcoming_uris(prefetch_tracks):
+                if prefetch_event.is_set():
+                    break  # the queue changed again
+                try:
+                    if uri.startswith('http'):
+                        # refreshes expired stream urls and fetches the art
+                        get_url_metadata(uri)
+                    elif os.path.isfile(uri):
+                        probe(uri, prefetch=prefetch_tracks)
+                        if settings['show_album_art'] or cast is not None:
+                            for size in sizes:
+                                thumbnail_cache.get(uri, size, bg, folder_cover_override)
+                except Exception as e:
+                    app_log.info(f'prefetch_upcoming: could not prefetch {uri}: {e!r}')
+
+
+    # up to 4 seconds without prefetch_upcoming
     def play(position=0, autoplay=True, switching_device=False, show_error=False, from_set_pos=False):
         global cast, track_start, track_end, track_length, track_position, music_queue, playing_url, cast_browser, zconf, LAST_PLAYED
         uri = music_queue[0]
@@ -2136,8 +2533,10 @@ if __name__ == '__main__':
                 metadata = {'title': str(metadata['title']), 'artist': str(metadata['artist']),
                             'albumName': str(metadata['album']), 'metadataType': 3}
                 ext = uri.split('.')[-1]
-                mc.play_media(url, f'audio/{ext}', current_time=position,
-                              metadata=metadata, thumb=f'{url}&thumbnail_only=true', autoplay=autoplay)
+                art_hash = thumbnail_cache.get_hash(uri, COVER_WEB, settings['theme']['background'],
+                                                    settings['folder_cover_override'])
+                mc.play_media(url, f'audio/{ext}', current_time=position, autoplay=autoplay,
+                              metadata=metadata, thumb=f'http://{get_ipv4()}:{State.PORT}/art/{art_hash}')
                 mc.block_until_active(WAIT_TIMEOUT)
                 app_log.info(f'mc.status.player_state={mc.status.player_state}')
             except (NotConnected, AttributeError) as e:
@@ -2189,6 +2588,32 @@ if __name__ == '__main__':
         return (m['album'].casefold() if album_sort else ''), tn, m['artist'].casefold(), m['title'].casefold()
 
 
+    def skip_unplayable_urls(count, gui_event=None):
+        """
+        Resolves the urls among the first count uris of music_queue concurrently with scan_queue,
+            and moves the ones before the first playable url to done_queue as soon as it is known,
+            instead of play() resolving one url after another until one is playable
+        The urls after the first playable url are resolved in the background
+        gui_event is posted to gui_window once done, for when this runs on a thread instead of the GUI's
+        """
+        try:
+            urls = list(islice(takewhile(lambda uri: uri.startswith('http'), music_queue), count))
+            if len(urls) < 2:
+                return
+            playable_url, _ = scan_queue.scan_first(urls)
+            for url in urls:
+                if url == playable_url:
+                    break
+                app_log.info(f'{url} is unplayable')
+                if settings['notifications']:
+                    tray_notify(t('ERROR') + ': ' + t('Could not play $URL').replace('$URL', url))
+                with suppress(IndexError):
+                    done_queue.append(music_queue.popleft())
+        finally:
+            if gui_event is not None:
+                gui_window.write_event_value(gui_event, None)
+
+
     def play_uris(uris: Iterable, return_if_empty=True, queue_uris=False,
                   play_next=False, merge_tracks=0, natural_sort=True):
         """
@@ -2259,6 +2684,7 @@ if __name__ == '__main__':
         else:  # API play command with history (merge_tracks > 0)
             music_queue.extendleft(reversed(temp_queue))
         if not queue_uris:
+            skip_unplayable_urls(len(temp_queue))
             if music_queue:
                 play()
                 return True
@@ -2283,7 +2709,8 @@ if __name__ == '__main__':
             done_queue.clear()
         music_queue.extend(starting_files)
         ignore_files = set(starting_files).union(music_queue).union(done_queue).union(next_queue)
-        if indexing_tracks_thread is not None and indexing_tracks_thread.is_alive() and settings['notifications']:
+        if (indexing_tracks_thread is not None and indexing_tracks_thread.is_alive() and not library_loaded
+                and settings['notifications']):
             info = t('INFO')
             tray_notify(f'{info}: ' + t('Library indexing incomplete, only scanned files have been added'))
         start_shuffle_from = len(music_queue)
@@ -2446,6 +2873,7 @@ if __name__ == '__main__':
             if not gui_window.was_closed():
                 daemon_commands.put('__UPDATE_GUI__')
             refresh_tray()
+            publish_events('status')
             LAST_PLAYED = time.time()
             return True
         return False
@@ -2485,6 +2913,7 @@ if __name__ == '__main__':
                 if not gui_window.was_closed():
                     daemon_commands.put('__UPDATE_GUI__')
                 refresh_tray()
+                publish_events('status')
             except (PyChromecastError, AssertionError) as e:
                 print('error', e)
                 if music_queue:
@@ -2525,6 +2954,7 @@ if __name__ == '__main__':
         if not gui_window.was_closed():
             daemon_commands.put('__UPDATE_GUI__')
         refresh_tray()
+        publish_events('track', 'status')
 
 
     def set_pos(new_position):
@@ -2578,6 +3008,7 @@ if __name__ == '__main__':
             track_position = new_position
             track_start = time.monotonic() - track_position
             track_end = track_start + track_length
+        publish_events('status')
 
 
     def next_track(from_timeout=False, times=1, forced=False, ignore_timestamps=False):
@@ -2589,6 +3020,7 @@ if __name__ == '__main__':
         :return:
         """
         app_log.info(f'(from_timeout={from_timeout})')
+        change_started = time.monotonic()
         if cast is not None and cast.app_id != APP_MEDIA_RECEIVER and not forced:
             # clicked next track when connected to cast and the app is not the media receiver app
             playing_status.stop()
@@ -2639,7 +3071,10 @@ if __name__ == '__main__':
                 elif times > 1:  # reset skip counter because user explicitly selected the track to play
                     settings['skips'].pop(music_queue[0], None)
                     save_settings()
-                return play()
+                played = play()
+                track_change_times.append(time.monotonic() - change_started)
+                app_log.info(f'track change took {track_change_times[-1] * 1000:.0f} ms')
+                return played
             # repeat is off (from timeout) or skip resulted in exhaustion of queue
             stop('next track queue exhaustion', stop_cast=not from_timeout)
 
@@ -2765,6 +3200,41 @@ if __name__ == '__main__':
                         tray_notify('update_available', context=latest_ver)
             State.installing_update = False
 
+    def scan_file(file_path):
+        file_path = Path(file_path).as_posix()
+        all_tracks[file_path] = get_metadata_wrapped(file_path)
+
+
+    def get_urgent_scans():
+        """ the uris that are next to play, which are also the ones visible below the current track """
+        with suppress(RuntimeError):  # deque mutated during iteration
+            return [*islice(next_queue, 20), *islice(music_queue, 20)]
+        return []
+
+
+    def get_refresh_uris():
+        """ the uris that play after the current track, in order """
+        with suppress(RuntimeError):  # deque mutated during iteration
+            return [*islice(next_queue, 20), *islice(music_queue, 1, 21)]
+        return []
+
+
+    def get_url_expiry(uri):
+        """ :return: when the stream of uri expires, 0 if it was never resolved, None if there is nothing to refresh """
+        metadata = url_metadata.get(uri) if uri.startswith('http') else None
+        return None if metadata is None else metadata.get('expiry', 0)
+
+
+    def refresh_url(url):
+        get_url_metadata(url, fetch_art=False, refresh=True)
+        gui_window.metadata['update_listboxes'] = True
+
+
+    def on_scan_progress():
+        gui_window.metadata['update_listboxes'] = True
+        publish_events('scan')
+
+
     def background_thread():
         """
         Startup tasks:
@@ -2774,7 +3244,7 @@ if __name__ == '__main__':
         - starts keyboard listener
         - connect Discord presence
         While True tasks:
-        - scans files
+        - seeks
         """
         global SYNC_WITH_CHROMECAST
 
@@ -2796,22 +3266,6 @@ if __name__ == '__main__':
         p.name = 'pynputListener'
         p.start()
         while True:
-            scanned = 0
-            while not uris_to_scan.empty():
-                uri = uris_to_scan.get()
-                if uri.startswith('http'):
-                    get_url_metadata(uri)
-                else:
-                    uri = Path(uri).as_posix()
-                    all_tracks[uri] = get_metadata_wrapped(uri)
-                uris_to_scan.task_done()
-                scanned += 1
-                if scanned >= 50:
-                    scanned = 0
-                    gui_window.metadata['update_listboxes'] = True
-            if scanned:
-                gui_window.metadata['update_listboxes'] = True
-
             if seek_queue and time.time() > SYNC_WITH_CHROMECAST:
                 time_to_seek = seek_queue.pop()
                 seek_queue.clear()
@@ -2884,12 +3338,11 @@ if __name__ == '__main__':
             gui_window['metadata_track_num'].update(value=file_metadata['track_number'])
             gui_window['metadata_explicit'].update(value=file_metadata['explicit'])
             mime, artwork = get_album_art(file)
-            artwork = None if artwork == DEFAULT_ART else artwork
+            artwork = None if artwork == DEFAULT_ART_BYTES else artwork
             if artwork is not None:
                 gui_window['metadata_art'].metadata = (mime, artwork)
-                with suppress(OSError):
-                    display_art = resize_img(artwork, settings['theme']['background'], COVER_MINI)
-                    gui_window['metadata_art'].update(data=display_art)
+                display_art = b64encode(thumbnail_cache.get(file, COVER_MINI, settings['theme']['background']))
+                gui_window['metadata_art'].update(data=display_art)
             return True
         except InvalidAudioFile:
             error = t('ERROR') + ': ' + t('Invalid audio file selected')
@@ -2898,6 +3351,29 @@ if __name__ == '__main__':
             return False
 
 
+    def search_tracks(query: str, limit=50) -> list:
+        """ :return: [(file_path, track)] of the library tracks that best match query, best first """
+        with DatabaseConnection() as conn:
+            rows = search_library(conn, query, limit)
+        return [(row['file_path'], all_tracks[row['file_path']]) for row in rows if row['file_path'] in all_tracks]
+
+
+    def get_library_rows() -> list:
+        """
+        rows of the library table in the order chosen by clicking on its headings (artist by default)
+        or the best matches of the filter box if it is not empty
+        """
+        library_metadata = gui_window.metadata['library']
+        if library_metadata['filter']:
+            tracks = search_tracks(library_metadata['filter'], limit=500)
+        else:
+            sort_by = library_metadata['sort_by']
+            view = ('artist', 'title', 'artist', 'album')[sort_by]
+            reverse = sort_by != 0 and not library_metadata['ascending']
+            tracks = all_tracks.sorted_items(view, reverse=reverse)
+        return [[track['title'], get_first_artist(track['artist']), track['album'], uri] for uri, track in tracks]
+
+
     def add_music_folder(folders):
         added_folders = set(music_folders)
         for folder in folders:
@@ -3033,13 +3509,7 @@ if __name__ == '__main__':
             mini_mode = settings['mini_mode']
             window_location = get_window_location()
             if settings['show_album_art']:
-                size = COVER_MINI if mini_mode else COVER_NORMAL
-                bg = settings['theme']['background']
-                try:
-                    album_art_data = resize_img(get_current_art(), bg, size, default_art=DEFAULT_ART)
-                except OSError as e:
-                    handle_exception(e)
-                    album_art_data = resize_img(DEFAULT_ART, bg, size)
+                album_art_data = b64encode(get_current_thumbnail(COVER_MINI if mini_mode else COVER_NORMAL))
             else:
                 album_art_data = None
             metadata = get_current_metadata()
@@ -3049,10 +3519,11 @@ if __name__ == '__main__':
                 window_layout = MiniPlayerWindow(playing_status, settings, title, artist, album_art_data, track_length, _track_position)
             else:
                 window_layout = MainWindow(playing_status, settings, title, artist, album, album_art_data, track_length, _track_position,
-                                           lb_tracks, selected_value, timer, all_tracks, get_devices(),
+                                           lb_tracks, selected_value, timer, dict(all_tracks.sorted_items('artist')), get_devices(),
                                            f"http://{get_ipv4()}:{State.PORT}?api_key={settings['api_key']}")
             window_metadata: dict = {'last_event': None, 'update_listboxes': False, 'update_volume_slider': False,
-                                     'library': {'sort_by': 0, 'ascending': True, 'region': 'cell', 'column': 1},
+                                     'library': {'sort_by': 0, 'ascending': True, 'region': 'cell', 'column': 1,
+                                                 'filter': ''},
                                      'mouse_hover': '', 'url_input': '', 'pl_url_input': ''}
             pl_name = window_metadata['pl_name'] = next(iter(settings['playlists']), '')
             pl_tracks = window_metadata['pl_tracks'] = settings['playlists'].get(pl_name, []).copy()
@@ -3602,18 +4073,19 @@ if __name__ == '__main__':
         elif main_event == 'play_all':
             if not any(filter(lambda thread: thread.name == 'PlayAll', threading.enumerate())):
                 Thread(target=play_all, name='PlayAll', daemon=True).start()
+        elif main_event == 'library_filter':
+            gui_window.metadata['library']['filter'] = main_values['library_filter'].strip()
+            gui_window['library'].update(values=get_library_rows())
         elif main_event in {'library', 'Play::library', 'Play Next::library', 'Queue::library', 'Locate::library'}:
             library_metadata = gui_window.metadata['library']
             if library_metadata['region'] == 'heading':
                 col_index = library_metadata['column']
                 if col_index == library_metadata['sort_by']:
-                    reverse = library_metadata['ascending'] = not library_metadata['ascending']
+                    library_metadata['ascending'] = not library_metadata['ascending']
                 else:
                     library_metadata['sort_by'] = col_index
-                    reverse = library_metadata['ascending'] = True
-                library_items = gui_window['library'].Values
-                library_items.sort(key=lambda row: row[col_index - 1].casefold(), reverse=not reverse)
-                gui_window['library'].update(library_items)
+                    library_metadata['ascending'] = True
+                gui_window['library'].update(get_library_rows())
             elif main_event == 'Locate::library':
                 for index in main_values['library']:
                     locate_uri(uri=gui_window['library'].Values[index][-1])
@@ -3681,16 +4153,13 @@ if __name__ == '__main__':
                 activate_gui('tab_settings')
             elif main_event in {'show_track_number', 'show_queue_index'}:
                 gui_window.metadata['update_listboxes'] = True
-            elif main_event == 'scan_folders' and main_value:
-                index_all_tracks()
+            elif main_event == 'scan_folders':
+                if main_value:
+                    index_all_tracks()
+                else:
+                    watch_music_folders(stop=True)
             elif main_event == 'folder_cover_override':
-                size = COVER_MINI if settings['mini_mode'] else COVER_NORMAL
-                bg = settings['theme']['background']
-                try:
-                    album_art_data = resize_img(get_current_art(), bg, size, default_art=DEFAULT_ART)
-                except OSError as e:
-                    handle_exception(e)
-                    album_art_data = resize_img(DEFAULT_ART, bg, size)
+                album_art_data = b64encode(get_current_thumbnail(COVER_MINI if settings['mini_mode'] else COVER_NORMAL))
                 gui_window['artwork'].update(data=album_art_data)
             elif main_event == 'lang':
                 State.lang = main_value
@@ -3730,6 +4199,10 @@ if __name__ == '__main__':
         # url tab
         elif main_event == 'url_input':
             gui_window.metadata['url_input'] = main_value
+        elif main_event == 'url_resolved':
+            if music_queue:
+                play()
+            gui_window['url_msg'].update('')
         elif main_event == 'url_input_cut':
             cut_text = get_cut_text(gui_window, 'url_input')
             if cut_text:
@@ -3749,9 +4222,9 @@ if __name__ == '__main__':
             if main_values['url_play'] or not music_queue:
                 music_queue.extendleft(reversed(urls_to_insert))
                 gui_window['url_msg'].update(t('Loading URL(s)'), text_color='yellow')
-                gui_window.read(1)
-                play()
-                gui_window['url_msg'].update('')
+                # resolving the urls would freeze the window, the url_resolved event plays the first playable one
+                Thread(target=skip_unplayable_urls, args=(len(urls_to_insert), 'url_resolved'),
+                       name='SkipUnplayableUrls', daemon=True).start()
                 urls_to_insert.pop(0)
             elif main_values['url_queue']:
                 music_queue.extend(urls_to_insert)
@@ -3765,7 +4238,7 @@ if __name__ == '__main__':
                 gui_window['url_msg'].update(t('Added URL(s)'), text_color='green')
                 gui_window.TKroot.after(2000, lambda: gui_window['url_msg'].update(value=''))
             for inserted_url in urls_to_insert:
-                uris_to_scan.put(inserted_url)
+                scan_queue.put(inserted_url)
             gui_window['url_input'].set_focus()
             gui_window.metadata['update_listboxes'] = True
         # video tab
@@ -3908,7 +4381,7 @@ if __name__ == '__main__':
                 links = links.split(';')
             for link in links:
                 if link.startswith('http://') or link.startswith('https://'):
-                    uris_to_scan.put(link)
+                    scan_queue.put(link)
                     pl_tracks = gui_window.metadata['pl_tracks']
                     pl_tracks.append(link)
                     new_values, pl_length = format_pl_lb(pl_tracks)
@@ -3972,11 +4445,11 @@ if __name__ == '__main__':
                     img = Image.open(selected_file).convert('RGB')
                     data = io.BytesIO()
                     img.save(data, format='jpeg', quality=95)
-                    mime, artwork = 'image/jpeg', b64encode(data.getvalue()).decode()
-                artwork = None if artwork == DEFAULT_ART else artwork
+                    mime, artwork = 'image/jpeg', data.getvalue()
+                artwork = None if artwork == DEFAULT_ART_BYTES else artwork
                 if artwork is not None:
                     try:
-                        display_art = resize_img(artwork, settings['theme']['background'], COVER_MINI)
+                        display_art = b64encode(resize_art(artwork, settings['theme']['background'], COVER_MINI))
                         gui_window['metadata_art'].metadata = (mime, artwork)
                         gui_window['metadata_art'].update(data=display_art)
                     except OSError as e:
@@ -3992,13 +4465,13 @@ if __name__ == '__main__':
                 if artist:
                     url += f'+artist:{artist}'
                 url += f'&type=track&market={mkt}'
-                r = requests.get(url, headers=get_spotify_headers()).json()
+                r = http_session.get(url, headers=get_spotify_headers()).json()
                 if 'tracks' in r:
                     for art_link in (item['album']['images'][0]['url'] for item in r['tracks']['items']):
-                        original_art = b64encode(requests.get(art_link).content).decode()
+                        original_art = http_session.get(art_link).content
                         found_artwork = True
                         try:
-                            display_art = resize_img(original_art, settings['theme']['background'], COVER_MINI)
+                            display_art = b64encode(resize_art(original_art, settings['theme']['background'], COVER_MINI))
                             gui_window['metadata_art'].metadata = ('image/jpeg', original_art)
                             gui_window['metadata_art'].update(data=display_art)
                         except OSError as e:
@@ -4046,20 +4519,10 @@ if __name__ == '__main__':
             pl_values, pl_length = format_pl_lb(pl_tracks)
             gui_window['pl_length'].update(value=pl_length)
             gui_window['pl_tracks'].update(values=pl_values)
-            if len(all_tracks) != len(gui_window['library'].Values):
-                lib_data = sorted(
-                    (
-                        [
-                            track['title'],
-                            get_first_artist(track['artist']),
-                            track['album'],
-                            uri,
-                        ]
-                        for uri, track in index_all_tracks(False).items()
-                    ),
-                    key=lambda cols: cols[1],
-                )
-                gui_window['library'].update(values=lib_data)
+            # update_library is set when tracks were modified without changing the size of the library
+            library_changed = gui_window.metadata.pop('update_library', False)
+            if library_changed or not gui_window.metadata['library']['filter'] and len(all_tracks) != len(gui_window['library'].Values):
+                gui_window['library'].update(values=get_library_rows())
         if gui_window.metadata['update_volume_slider']:
             gui_window['mute'].update(image_data=VOLUME_MUTED_IMG if settings['muted'] else VOLUME_IMG)
             gui_window['mute'].set_tooltip(t('unmute') if settings['muted'] else t('mute'))
@@ -4204,6 +4667,12 @@ if __name__ == '__main__':
         }
         actions.get(action, lambda: other_tray_actions(action))()
     update_checker = UpdateChecker()
+    # yt-dlp mostly waits on the network, so threads resolve urls concurrently despite the GIL
+    scan_queue = ScanQueue(get_url_metadata, scan_file, network_workers=8, get_urgent=get_urgent_scans,
+                           on_progress=on_scan_progress, group_of=get_url_extractor,
+                           group_limits={'youtube': 4, 'soundcloud': 2, 'deezer': 2, 'spotify': 2}).start()
+    url_refresher = UrlRefresher(get_refresh_uris, get_url_expiry, refresh_url, group_of=get_url_extractor).start()
+    event_broker = EventBroker(get_event_snapshot)
     try:
         start_time = time.monotonic()
         load_settings(True)  # starts indexing all tracks
@@ -4234,6 +4703,7 @@ if __name__ == '__main__':
 
         rmtree('Update', ignore_errors=True)
         Thread(target=background_thread, daemon=True, name='BackgroundTasks').start()
+        Thread(target=prefetch_upcoming, daemon=True, name='Prefetcher').start()
         zconf = zeroconf.Zeroconf()
         cast_browser = pychromecast.discovery.CastBrowser(MyCastListener(), zconf)
         cast_browser.start_discovery()
@@ -4255,10 +4725,15 @@ if __name__ == '__main__':
                     with suppress(OSError, PermissionError):
                         # try to start server and bind it to PORT
                         # Linux auto-maps ipv4 to ipv6 however Windows keep them seperate
+                        # every cast device streaming a file and every page of the web GUI takes a connection
+                        limits = {'connection_limit': settings['web_connection_limit']}
+                        # /events/ is streamed by event_broker on the I/O loop, so every thread is left for requests
                         if platform.system() == 'Windows':
-                            server_kwargs = {'host': '0.0.0.0', 'port': State.PORT}
+                            server_kwargs = {'host': '0.0.0.0', 'port': State.PORT, **limits,
+                                             '_dispatcher': EventDispatcher(event_broker, settings['web_threads'])}
                             Thread(target=waitress.serve, name='WaitressServe', daemon=True, args=(app,), kwargs=server_kwargs).start()
-                        server_kwargs = {'host': '::', 'port': State.PORT}
+                        server_kwargs = {'host': '::', 'port': State.PORT, **limits,
+                                         '_dispatcher': EventDispatcher(event_broker, settings['web_threads'])}
                         Thread(target=waitress.serve, name='WaitressServe', daemon=True, args=(app,), kwargs=server_kwargs).start()
                         break
                 State.PORT += 1  # port in use or failed to bind to port
@@ -4302,7 +4777,7 @@ if __name__ == '__main__':
                 for file_or_url in settings['queues'].get(queue_name, []):
                     if valid_audio_file(file_or_url) or file_or_url.startswith('http'):
                         queue.append(file_or_url)
-                        uris_to_scan.put(file_or_url)
+                        scan_queue.put(file_or_url)
             # position = args.position || previous session's position
             track_position = args.position
             if track_position == 0 and settings['position'] > 0:
@@ -4321,7 +4796,8 @@ if __name__ == '__main__':
                 play(position=track_position, autoplay=False)
         elif settings['populate_queue_startup'] or args.start_playing:
             try:
-                indexing_tracks_thread.join()
+                if not library_loaded:
+                    indexing_tracks_thread.join()
                 play_all(queue_only=not args.start_playing or args.queue)
             except RuntimeError:
                 tray_notify(t('ERROR') + ':' + t('Could not populate queue because library scan is disabled'))
@@ -4336,7 +4812,7 @@ if __name__ == '__main__':
         # health check
         if is_debug():
             api_key = settings['api_key']
-            r = requests.get(f'http://127.0.0.1:{State.PORT}/?api_key={api_key}')
+            r = http_session.get(f'http://127.0.0.1:{State.PORT}/?api_key={api_key}')
             assert r.ok
 
         while True:
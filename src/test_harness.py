@@ -1,18 +1,36 @@
 from base64 import b64decode
-from contextlib import suppress
+from contextlib import closing, suppress
+import gzip
 import io
 from itertools import chain
 import os
 import platform
 from pathlib import Path
+import socket
+import sqlite3
+import threading
 import time
+import wave
 
 from mutagen._util import MutagenError
 from PIL import Image
 import pytest
+import requests
+from werkzeug.http import parse_accept_header
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
 
 from b64_images import DEFAULT_ART
-from meta import COVER_MINI, COVER_NORMAL, VERSION
+from meta import AUDIO_EXTS, COVER_MINI, COVER_NORMAL, VERSION
+from modules.compression import StaticAssets
+from modules.db import METADATA_SCHEMA, SEARCH_SCHEMA, ArtworkStore, UrlMetadataCache, search_library
+from modules.dz_cache import DzCache, IV, SEGMENT_SIZE as DZ_SEGMENT_SIZE, decrypt_segment
+from modules.events import EventBroker, EventDispatcher
+from modules.file_response import send_local_file
+from modules.fs_watcher import FolderWatcher
+from modules.http_session import HTTPSession
+from modules.scan_queue import ScanQueue
+from modules.url_refresher import UrlRefresher
 from shared import get_running_processes, is_already_running
 from test_cases.ipconfig import IPCONFIG_ELIBROFTW, IPCONFIG_ERICCHAN1989, IPCONFIG_ERICCHAN1989_ALL
 from utils import (
@@ -22,8 +40,12 @@ from utils import (
     REPEAT_OFF_IMG,
     REPEAT_ONE_IMG,
     InvalidAudioFile,
+    LibraryIndex,
     State,
     SystemAudioRecorder,
+    ThumbnailCache,
+    Track,
+    TrigramIndex,
     Unknown,
     better_shuffle,
     create_progress_bar_texts,
@@ -52,8 +74,11 @@ from utils import (
     get_yt_id,
     natural_key_file,
     parse_m3u,
+    probe,
     repeat_img_tooltip,
+    resize_art,
     resize_img,
+    scan_folder,
     t,
     valid_audio_file,
     valid_color_code,
@@ -277,6 +302,22 @@ def test_audio_length_fail(file):
         get_audio_length(file)
 
 
+def test_probe_prefetch(tmp_path):
+    from utils import _probe
+    files = []
+    for i in range(12):
+        with wave.open(str(tmp_path / f'{i}.wav'), 'wb') as w:
+            w.setnchannels(1), w.setsampwidth(2), w.setframerate(8000), w.writeframes(bytes(1600))
+        files.append(str(tmp_path / f'{i}.wav'))
+    info = probe(files[0], prefetch=2)
+    info['length'] = None
+    for file in files[1:]:
+        probe(file)
+    # the prefetched file outlives the other files probed since, and the cached result was not changed
+    misses = _probe.cache_info().misses
+    assert probe(files[0])['length'] == 0.1 and _probe.cache_info().misses == misses
+
+
 @pytest.mark.skipif(
     platform.system() != 'Windows',
     reason='get_default_output_device only implemented on Windows',
@@ -299,6 +340,45 @@ def test_natural_sort(unsorted, expected):
     assert sorted(unsorted, key=natural_key_file) == expected
 
 
+def test_trigram_index():
+    index = TrigramIndex({'halo': 'Halo Beyoncé', 'so_there': 'So There I Was deadmau5', 'theme': 'Halo Theme'})
+    assert index.search('beyonce halo')[0] == ('halo', 1.0)
+    assert index.search('deadmau so ther i was')[0][0] == 'so_there'
+    assert index.search('zzz') == []
+    index.remove('halo')
+    assert [key for key, _ in index.search('halo')] == ['theme']
+    index.add('theme', 'Halo Theme Song')
+    assert len(index) == 2 and [key for key, _ in index.search('halo theme')] == ['theme']
+
+
+def test_library_index_pages():
+    index = LibraryIndex({f'C:/Music/{i}.mp3': Track(f'{i:02}', 'Artist', 'Album', sort_key=f'{i:02}') for i in range(10)})
+    assert [track['title'] for _, track in index.sorted_items('title', start=2, stop=5)] == ['02', '03', '04']
+    assert [track['title'] for _, track in index.sorted_items('title', True, 2, 5)] == ['07', '06', '05']
+    assert [track['title'] for _, track in index.sorted_items('title', True, 8)] == ['01', '00']
+    assert index.sorted_items(start=20) == []
+    assert len(index.sorted_items()) == 10
+
+
+def test_library_index_replace_during_changes(monkeypatch):
+    tracks = {f'C:/Music/{i}.mp3': Track(f'{i:02}', 'Artist', 'Album', sort_key=f'{i:02}') for i in range(4)}
+    index = LibraryIndex(tracks)
+    fuzzy_text = LibraryIndex.fuzzy_text
+
+    def build_text(file_path, track):
+        # the folder watcher changes the library while replace() builds a new TrigramIndex
+        if file_path == 'C:/Music/new.mp3' and 'C:/Music/added.mp3' not in index:
+            index['C:/Music/added.mp3'] = Track('Added', 'Artist', 'Album', sort_key='added')
+            del index['C:/Music/0.mp3']
+        return fuzzy_text(file_path, track)
+
+    monkeypatch.setattr(index, 'fuzzy_text', build_text)
+    index.replace({'C:/Music/0.mp3': tracks['C:/Music/0.mp3'], 'C:/Music/new.mp3': Track('New', 'Artist', 'Album')})
+    assert set(index) == {'C:/Music/new.mp3', 'C:/Music/added.mp3'}
+    assert index.fuzzy_search('added')[0][0] == 'C:/Music/added.mp3'
+    assert not index.fuzzy_search('00')
+
+
 @pytest.mark.parametrize(
     'color_code',
     (
@@ -349,10 +429,65 @@ def test_get_metadata(file, expected, expected_first_artist):
         metadata = get_metadata(file)
         assert metadata.pop('length') > 0
         assert metadata.pop('time_modified') > 0
+        assert metadata.pop('size') > 0
         assert metadata == expected
         assert get_first_artist(metadata['artist']) == expected_first_artist
 
 
+def test_search_library():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA recursive_triggers = ON')
+    conn.executescript(METADATA_SCHEMA + SEARCH_SCHEMA)
+    insert = 'INSERT OR REPLACE INTO file_metadata (file_path, title, artist, album) VALUES (?, ?, ?, ?)'
+    conn.execute(insert, ('C:/Music/Beyoncé - Halo.mp3', 'Halo', 'Beyoncé', 'I Am... Sasha Fierce'))
+    conn.execute(insert, ('C:/Music/Halo Theme.flac', 'Theme', 'Martin O\'Donnell', 'Halo'))
+    conn.execute(insert, ('C:/Music/untitled.v2.mp3', None, None, None))
+    assert [row['title'] for row in search_library(conn, 'halo')] == ['Halo', 'Theme']
+    assert [row['title'] for row in search_library(conn, 'beyonce ha')] == ['Halo']
+    assert [row['file_path'] for row in search_library(conn, 'untitled v2')] == ['C:/Music/untitled.v2.mp3']
+    assert search_library(conn, '"*') == []
+    # replacing a row replaces its search entry
+    conn.execute(insert, ('C:/Music/Beyoncé - Halo.mp3', 'Single Ladies', 'Beyoncé', 'I Am... Sasha Fierce'))
+    assert [row['title'] for row in search_library(conn, 'halo')] == ['Theme', 'Single Ladies']
+    conn.execute('DELETE FROM file_metadata WHERE file_path = ?', ('C:/Music/Halo Theme.flac',))
+    assert [row['title'] for row in search_library(conn, 'halo')] == ['Single Ladies']
+    # the best match is found even if it is not among the first of many matches
+    conn.executemany(insert, ((f'C:/Music/{i}.mp3', 'Halo Theme Song Extended Mix', 'Artist', 'Album') for i in range(1100)))
+    conn.execute(insert, ('C:/Music/Halo.mp3', 'Halo', 'Artist', 'Album'))
+    assert search_library(conn, 'halo', limit=1)[0]['file_path'] == 'C:/Music/Halo.mp3'
+
+
+def test_url_metadata_cache(tmp_path):
+    database = tmp_path / 'music_caster.db'
+    with sqlite3.connect(database) as conn:
+        conn.executescript(METADATA_SCHEMA)
+    cache = UrlMetadataCache(database)
+    video = {'title': 'Video', 'artist': 'Uploader', 'album': 'YouTube', 'length': 700.0, 'src': 'https://youtu.be/a',
+             'url': 'https://googlevideo.com/a', 'expiry': time.time() + 1800, 'is_live': False, 'ytid': 'a',
+             'timestamps': [[0, 'Intro'], [60, 'Song']]}
+    deezer = {'title': 'Track', 'artist': 'Artist', 'album': 'Album', 'length': 200, 'src': 'https://deezer.com/t/1',
+              'bf_key': b'0123456789abcdef', 'explicit': True}
+    cache['https://youtu.be/a'] = cache['https://www.youtube.com/watch?v=a'] = video
+    cache['https://deezer.com/t/1'] = deezer
+    cache['SYSTEM_AUDIO'] = {'title': 'System Audio'}
+    video['art_hash'] = 'hash'  # changed after it was set
+    cache.flush()
+    loaded = UrlMetadataCache(database)
+    assert loaded.load() == 3
+    assert loaded['https://youtu.be/a'] == loaded['https://www.youtube.com/watch?v=a'] == video
+    # metadata without an expiry is resolved again when it is played
+    assert loaded['https://deezer.com/t/1'] == {**deezer, 'expiry': 0, 'is_live': False}
+    assert 'SYSTEM_AUDIO' not in loaded
+    # urls that were not used for a while are deleted unless they or their playlist are in use
+    loaded['https://youtube.com/watch?v=b'] = {**video, 'src': 'https://youtube.com/watch?v=b', 'pl_src': 'playlist'}
+    loaded.flush()
+    assert loaded.prune(keep={'https://youtu.be/a', 'playlist'}, max_age=-1) == 2
+    reloaded = UrlMetadataCache(database)
+    assert reloaded.load() == 2
+    assert set(reloaded) == set(loaded) == {'https://youtu.be/a', 'https://youtube.com/watch?v=b'}
+
+
 def test_ipv4():
     assert get_ipv4().count('.') == 3
 
@@ -442,6 +577,249 @@ def test_resize_img(size):
     assert img.size == size
 
 
+def test_resize_art():
+    art = resize_art(b64decode(DEFAULT_ART), '#121212', COVER_NORMAL)
+    assert Image.open(io.BytesIO(art)).size == COVER_NORMAL
+    assert art == b64decode(resize_img(DEFAULT_ART, '#121212', COVER_NORMAL))
+    with pytest.raises(OSError):
+        resize_art(b'not an image', '#121212')
+
+
+def test_thumbnail_cache(tmp_path):
+    Image.new('RGB', (300, 200), 'red').save(tmp_path / 'cover.png')
+    for track in ('track1.mp3', 'track2.mp3'):
+        (tmp_path / track).write_bytes(b'')
+    store = ArtworkStore(tmp_path / 'test.db')
+    cache = ThumbnailCache(store, max_items=1)
+    thumbnail = cache.get(str(tmp_path / 'track1.mp3'), COVER_MINI, '#121212', folder_cover_override=True)
+    assert Image.open(io.BytesIO(thumbnail)).size == COVER_MINI
+    # the tracks of an album share one image
+    art_hash = cache.get_hash(str(tmp_path / 'track2.mp3'), COVER_MINI, '#121212', folder_cover_override=True)
+    assert art_hash == ArtworkStore.hash(thumbnail)
+    assert sqlite3.connect(tmp_path / 'test.db').execute('SELECT COUNT(*) FROM artwork').fetchone()[0] == 1
+    # read from the database by a new store
+    new_cache = ThumbnailCache(ArtworkStore(tmp_path / 'test.db'))
+    assert new_cache.get(str(tmp_path / 'track1.mp3'), COVER_MINI, '#121212', True) == thumbnail
+    # a new cover means a new thumbnail
+    Image.new('RGB', (200, 200), 'blue').save(tmp_path / 'cover.png')
+    os.utime(tmp_path / 'cover.png', ns=(1, 1))
+    assert cache.get(str(tmp_path / 'track1.mp3'), COVER_MINI, '#121212', folder_cover_override=True) != thumbnail
+    assert store.get(art_hash) == ('image/png', thumbnail)
+    assert store.get('missing') is None
+
+
+def test_artwork_store_prune(tmp_path):
+    store = ArtworkStore(tmp_path / 'test.db')
+    store.put(b'old thumbnail', 'image/png', key='old')
+    art_hash = store.put(b'thumbnail', 'image/png', key='new')
+    store.put(b'unreferenced', 'image/png')
+    with closing(sqlite3.connect(tmp_path / 'test.db')) as conn, conn:
+        conn.execute("UPDATE artwork_refs SET last_used = 0 WHERE key = 'old'")
+    # keys that were not used for a while are forgotten and so are the images that no key refers to
+    assert store.prune() == 2
+    assert store.lookup('old') is None and store.lookup('new') == art_hash
+    with closing(sqlite3.connect(tmp_path / 'test.db')) as conn:
+        assert conn.execute('SELECT hash FROM artwork').fetchall() == [(art_hash,)]
+
+
+def test_static_assets(tmp_path):
+    (tmp_path / 'style.css').write_text('body { color: white; }\n' * 100)
+    assets = StaticAssets(tmp_path)
+    url = assets.url('style.css')
+    assert url.startswith('/static/style.') and url.endswith('.css') and url != '/static/style.css'
+    data, mimetype, encoding, _, immutable = assets.get(url.removeprefix('/static/'), parse_accept_header('gzip'))
+    assert mimetype == 'text/css' and encoding == 'gzip' and immutable
+    assert gzip.decompress(data) == (tmp_path / 'style.css').read_bytes()
+    data, _, encoding, _, immutable = assets.get('style.css', parse_accept_header(''))
+    assert encoding is None and not immutable and data == (tmp_path / 'style.css').read_bytes()
+    # a changed file gets a new url
+    (tmp_path / 'style.css').write_text('body { color: black; }\n' * 100)
+    os.utime(tmp_path / 'style.css', ns=(1, 1))
+    assert assets.url('style.css') != url and not assets.get(url.removeprefix('/static/'), parse_accept_header(''))[4]
+    assert assets.get('../test_harness.py', parse_accept_header('')) is None
+    assert assets.get('missing.css', parse_accept_header('')) is None
+
+
+def test_send_local_file(tmp_path):
+    file_path = tmp_path / 'track.mp3'
+    file_path.write_bytes(bytes(range(256)) * 4)
+
+    def get(**headers):
+        response = send_local_file(Request(EnvironBuilder(headers=headers).get_environ()), file_path)
+        return response.status_code, response.headers, b''.join(response.response)
+
+    status, headers, data = get()
+    assert status == 200 and data == file_path.read_bytes() and headers['Content-Type'] == 'audio/mpeg'
+    status, headers, data = get(Range='bytes=10-19')
+    assert status == 206 and data == bytes(range(10, 20)) and headers['Content-Range'] == 'bytes 10-19/1024'
+    assert get(Range='bytes=-4')[2] == bytes(range(252, 256))
+    status, headers, data = get(Range='bytes=0-1,1000-')
+    assert status == 206 and headers['Content-Type'].startswith('multipart/byteranges')
+    assert int(headers['Content-Length']) == len(data) and b'Content-Range: bytes 1000-1023/1024' in data
+    assert get(Range='bytes=2000-')[0] == 416
+    assert get(**{'If-None-Match': headers['ETag']})[0] == 304
+    # a range of a file that changed is the whole file
+    assert get(Range='bytes=0-1', **{'If-Range': '"old"'})[0] == 200
+
+
+def test_scan_queue_scan_first():
+    lock, in_flight, max_in_flight = threading.Lock(), {}, {}
+
+    def scan_url(url):
+        group = url.split('/')[2]
+        with lock:
+            in_flight[group] = in_flight.get(group, 0) + 1
+            max_in_flight[group] = max(max_in_flight.get(group, 0), in_flight[group])
+        # the first urls take the longest, so later urls finish first
+        time.sleep(0.05 if url.endswith('/0') else 0.01)
+        with lock:
+            in_flight[group] -= 1
+        return [] if url.endswith('/0') else [url]
+
+    scan_queue = ScanQueue(scan_url, lambda file_path: None, network_workers=6, group_of=lambda url: url.split('/')[2],
+                           group_limits={'youtube': 1}).start()
+    urls = [f'https://{site}/{i}' for i in range(4) for site in ('youtube', 'soundcloud')]
+    # the urls of youtube/0 and soundcloud/0 are not playable
+    assert scan_queue.scan_first(urls) == ('https://youtube/1', ['https://youtube/1'])
+    while not scan_queue.empty():
+        time.sleep(0.01)
+    assert max_in_flight == {'youtube': 1, 'soundcloud': 2}
+
+
+def test_url_refresher():
+    now = time.time()
+    expiries = {'yt/next': now + 600, 'sc/next': now + 1200, 'yt/far': now + 600, 'yt/later': now + 60,
+                'file': None, 'sc/unresolved': 0}
+    uris = ['yt/next', 'sc/next', 'file', 'yt/far', 'yt/later', 'sc/unresolved']
+    refreshed = []
+
+    def refresh(uri):
+        refreshed.append(uri)
+        expiries[uri] = time.time() + 1800
+
+    refresher = UrlRefresher(lambda: uris, expiries.get, refresh, group_of=lambda uri: uri.split('/')[0],
+                             lookahead=3, lead=900, margin=120, min_interval=60, poll_interval=0.01).start()
+    deadline = time.monotonic() + 5
+    while len(refreshed) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    refresher.stop()
+    # yt/next is one of the next 3 and expires within lead but sc/next does not, yt/far does not expire within margin,
+    # yt/later is due but youtube was refreshed less than min_interval ago, and sc/unresolved was never resolved
+    assert refreshed == ['yt/next', 'sc/unresolved']
+
+
+def test_event_broker():
+    import waitress
+    from flask import Flask
+    broker = EventBroker(snapshot=lambda: {'volume': {'volume': 20}}, heartbeat=0.05)
+    app = Flask(__name__)
+    app.add_url_rule('/state/', 'state', lambda: 'state')
+    # one thread for requests, which subscribers of /events/ do not take
+    server = waitress.create_server(app, host='127.0.0.1', port=0, _dispatcher=EventDispatcher(broker, threads=1))
+    threading.Thread(target=server.run, daemon=True).start()
+    clients = [socket.create_connection(('127.0.0.1', server.effective_port), timeout=5) for _ in range(8)]
+
+    def receive(client, until: bytes) -> bytes:
+        data = b''
+        while until not in data:
+            data += client.recv(65536)
+        return data
+
+    try:
+        for client in clients:
+            client.sendall(b'GET /events/ HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        for client in clients:
+            data = receive(client, b'{"volume":20}')
+            assert data.startswith(b'HTTP/1.1 200 OK\r\n') and b'Content-Type: text/event-stream' in data
+        assert requests.get(f'http://127.0.0.1:{server.effective_port}/state/', timeout=5).text == 'state'
+        broker.publish('queue', {'queue_length': 1})
+        for client in clients:
+            assert b'event: queue\ndata: {"queue_length":1}\n\n' in receive(client, b'{"queue_length":1}')
+        assert b': keep-alive\n\n' in receive(clients[0], b'keep-alive')
+        # subscribers that went away are dropped
+        for client in clients[1:]:
+            client.close()
+        deadline = time.monotonic() + 5
+        while broker.subscribers > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert broker.subscribers == 1
+    finally:
+        broker.stop()
+        server.close()
+        clients[0].close()
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason='symlinks need privileges on Windows')
+def test_folder_watcher_scan(tmp_path):
+    for file_path in ('a/1.mp3', 'a/cover.jpg', '.hidden/2.mp3', 'node_modules/3.mp3', 'b/4.flac'):
+        (tmp_path / file_path).parent.mkdir(exist_ok=True)
+        (tmp_path / file_path).write_bytes(b'')
+    (tmp_path / 'a' / 'b').symlink_to(tmp_path / 'b')
+    (tmp_path / 'b' / 'loop').symlink_to(tmp_path)
+    watcher = FolderWatcher([tmp_path], AUDIO_EXTS, on_change=None, excluded_dir_names={'node_modules'})
+    root = watcher.folders[0]
+    # symlinks are followed like scan_folder does, but every folder is only walked once
+    assert set(watcher.scan(root)) == set(scan_folder(root, excluded_dir_names={'node_modules'}))
+    assert len(watcher.scan(root)) == 2
+
+
+def test_dz_cache(tmp_path):
+    from Cryptodome.Cipher import Blowfish
+    bf_key, data = b'0123456789abcdef', os.urandom(DZ_SEGMENT_SIZE + 5000)
+    # every third 2048 byte chunk is encrypted with CBC and the same iv
+    expected = b''.join(Blowfish.new(bf_key, Blowfish.MODE_CBC, IV).decrypt(data[i:i + 2048])
+                        if i % 6144 == 0 and len(data[i:i + 2048]) == 2048 else data[i:i + 2048]
+                        for i in range(0, len(data), 2048))
+    decrypted = decrypt_segment(bf_key, data[:DZ_SEGMENT_SIZE]) + decrypt_segment(bf_key, data[DZ_SEGMENT_SIZE:])
+    assert decrypted == expected
+    cache = DzCache(tmp_path, max_bytes=2 * DZ_SEGMENT_SIZE)
+    assert cache.get_info('dz') is None and cache.get('dz', 0) is None
+    cache.set_info('dz', len(data), 'audio/mpeg')
+    assert cache.get_info('dz') == (len(data), 'audio/mpeg')
+    cache.put('dz', 0, decrypted[:DZ_SEGMENT_SIZE])
+    cache.put('dz', 1, decrypted[:DZ_SEGMENT_SIZE])
+    assert cache.get('dz', 0) == decrypted[:DZ_SEGMENT_SIZE]
+    cache.put('dz', 2, decrypted[:DZ_SEGMENT_SIZE])
+    # the least recently used segment is evicted, which is 1 since 0 was read after it
+    assert cache.get('dz', 1) is None and cache.get('dz', 0) is not None and cache.get('dz', 2) is not None
+    assert cache.size == 2 * DZ_SEGMENT_SIZE == DzCache(tmp_path).size
+    # writers of the same segment do not share a temporary file
+    threads = [threading.Thread(target=cache.put, args=('dz', 3, decrypted[:DZ_SEGMENT_SIZE])) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert cache.get('dz', 3) == decrypted[:DZ_SEGMENT_SIZE] and not list(tmp_path.glob('*/*.tmp'))
+
+
+def test_http_session():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    statuses = [503, 200]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(statuses.pop(0) if len(statuses) > 1 else statuses[0])
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        session = HTTPSession(backoff_factor=0)
+        url = f'http://127.0.0.1:{server.server_port}/'
+        # the 503 is retried
+        assert session.get(url).text == session.get(url).text == 'ok'
+        stats = session.stats()['127.0.0.1']
+        assert stats['requests'] == 2 and stats['retries'] == 1 and stats['errors'] == 0
+    finally:
+        server.shutdown()
+
+
 @pytest.mark.parametrize(
     'url',
     (
@@ -3,6 +3,7 @@ import audioop
 import base64
 import ctypes
 import glob
+import hashlib
 import io
 import locale
 import logging
@@ -18,7 +19,10 @@ import tempfile
 import time
 import unicodedata
 import webbrowser
+from array import array
 from base64 import b64decode, b64encode
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, MutableMapping
 from contextlib import suppress
 from functools import lru_cache, wraps
 from itertools import chain, cycle, repeat
@@ -27,7 +31,7 @@ from pathlib import Path
 from queue import Empty, LifoQueue
 from random import getrandbits
 from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, check_output
-from threading import Thread, Timer
+from threading import RLock, Thread, Timer
 from urllib.parse import parse_qs, urlencode, urlparse
 from uuid import getnode
 from zipfile import ZipFile
@@ -47,11 +51,13 @@ import mutagen.id3
 import pyaudio
 import pypresence
 import requests
+from sortedcontainers import SortedKeyList
 from meta import AUDIO_EXTS, AUDIO_HANDLER_EXTS, COVER_NORMAL, USER_AGENT, State
+from modules.http_session import session as http_session
 from mutagen._util import MutagenError
 from mutagen.aac import AAC
 from mutagen.id3._util import ID3NoHeaderError
-from mutagen.mp3 import MP3, EasyMP3, HeaderNotFoundError
+from mutagen.mp3 import MP3, HeaderNotFoundError
 from mutagen.mp4 import MP4, MP4Cover
 from mutagen.oggopus import OggOpus
 from mutagen.oggvorbis import OggVorbis
@@ -66,6 +72,8 @@ IS_FROZEN = getattr(sys, 'frozen', False)
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 yt_comment_downloader = YoutubeCommentDownloader()
 SPOTIFY_API = 'https://api.spotify.com/v1'
+# art is passed around as bytes and only base64 encoded for Tk and HTML
+DEFAULT_ART_BYTES = b64decode(DEFAULT_ART)
 # for stealing focus when bring window to front
 
 class SystemAudioRecorder:
@@ -212,6 +220,267 @@ class Unknown(str):
         return len(str(self))
 
 
+UNKNOWNS = {}
+
+
+def intern_str(string):
+    """ returns a shared instance of string, Unknown placeholders are shared per property """
+    if type(string) is str:
+        return sys.intern(string)
+    if isinstance(string, Unknown):
+        return UNKNOWNS.setdefault(string.property, string)
+    return string
+
+
+class Track(Mapping):
+    """
+    Compact read-only record for the metadata of a local file, usable like the dict that get_metadata returns
+    artist, album, and track_number are interned since they repeat across the library
+    'length' is only a key if the length is known
+    """
+    __slots__ = 'title', 'artist', 'album', 'explicit', 'sort_key', 'track_number', 'time_modified', 'size', 'length'
+
+    def __init__(self, title, artist, album, explicit=False, sort_key='', track_number='1', time_modified=None,
+                 size=None, length=None):
+        self.title = intern_str(title)
+        self.artist = intern_str(artist)
+        self.album = intern_str(album)
+        self.explicit = bool(explicit)
+        self.sort_key = sort_key
+        self.track_number = intern_str(track_number)
+        self.time_modified = time_modified
+        self.size = size
+        self.length = length
+
+    def __getitem__(self, key):
+        if key in Track.__slots__ and (key != 'length' or self.length is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key in Track.__slots__ if key != 'length' or self.length is not None)
+
+    def __len__(self):
+        return len(Track.__slots__) - (self.length is None)
+
+    def __repr__(self):
+        return f'Track({dict(self)!r})'
+
+
+class TrigramIndex:
+    """
+    Typo tolerant lookup of keys by the trigrams of the casefolded, accent stripped words of their text
+    Removed keys stay in the postings until more than half of the entries are stale
+    """
+    # rarest postings of the query that are counted when finding candidates
+    MAX_POSTINGS = 20_000
+    CANDIDATES = 100
+
+    def __init__(self, texts=None):
+        self._ids = {}  # key: doc id
+        self._docs = []  # doc id: (key, folded text) or None if removed
+        self._postings = {}  # trigram: array of doc ids
+        self._stale = 0
+        for key, text in (texts or {}).items():
+            self.add(key, text)
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def word_trigrams(word) -> tuple:
+        """ trigrams of word padded like pg_trgm does, so short words and word starts count """
+        word = f'  {word} '
+        return tuple(word[i:i + 3] for i in range(len(word) - 2))
+
+    @staticmethod
+    def trigrams(folded_text) -> set:
+        # artists and common words repeat throughout a library, so the trigrams of words are cached
+        return set().union(*map(TrigramIndex.word_trigrams, re.findall(r'\w+', folded_text)))
+
+    def add(self, key, text: str):
+        if key in self._ids:
+            self.remove(key)
+        folded_text = fold_text(text)
+        doc_id = self._ids[key] = len(self._docs)
+        self._docs.append((key, folded_text))
+        postings = self._postings
+        for trigram in self.trigrams(folded_text):
+            try:
+                postings[trigram].append(doc_id)
+            except KeyError:
+                postings[trigram] = array('I', (doc_id,))
+
+    def remove(self, key):
+        doc_id = self._ids.pop(key, None)
+        if doc_id is not None:
+            self._docs[doc_id] = None
+            self._stale += 1
+            if self._stale > len(self._ids):
+                self.__init__({key: text for key, text in filter(None, self._docs)})
+
+    def __len__(self):
+        return len(self._ids)
+
+    def search(self, text: str, limit=10, min_score=0.5) -> list:
+        """
+        :param min_score: fraction of the trigrams of text that a match needs to contain
+        :return: [(key, score), ...] best first, ties are broken by how little else the key's text contains
+        """
+        query = self.trigrams(fold_text(text))
+        if not query:
+            return []
+        counts, counted = Counter(), 0
+        for postings in sorted((self._postings[trigram] for trigram in query if trigram in self._postings), key=len):
+            if counted + len(postings) > TrigramIndex.MAX_POSTINGS:
+                if counted:
+                    break
+                postings = postings[:TrigramIndex.MAX_POSTINGS]
+            counts.update(postings)
+            counted += len(postings)
+        matches = []
+        for doc_id, _ in counts.most_common(TrigramIndex.CANDIDATES):
+            if (doc := self._docs[doc_id]) is not None:
+                trigrams = self.trigrams(doc[1])
+                common = len(query & trigrams)
+                score = common / len(query)
+                if score >= min_score:
+                    matches.append((score, common / len(query | trigrams), doc[0]))
+        matches.sort(reverse=True)
+        return [(key, score) for score, _, key in matches[:limit]]
+
+
+class LibraryIndex(MutableMapping):
+    """
+    The music library as {file_path: Track} that keeps sorted views of itself up to date
+    Adding, replacing, or removing a track is O(log n) per view instead of sorting the library again
+    Views (sort_key, title, artist (first artist), album) are built the first time they are used
+    Unknown values sort first in every view, keys must not depend on the language as they are used for removal
+    Also keeps a TrigramIndex of the title (or file name) and artist of every track for fuzzy_search
+    """
+    VIEW_KEYS = {
+        'sort_key': lambda track: track['sort_key'],
+        'title': lambda track: '' if isinstance(track['title'], Unknown) else track['title'].casefold(),
+        'artist': lambda track: '' if isinstance(track['artist'], Unknown) else get_first_artist(track['artist']).casefold(),
+        'album': lambda track: '' if isinstance(track['album'], Unknown) else track['album'].casefold(),
+    }
+
+    def __init__(self, tracks=None):
+        self._tracks = {}
+        self._views = {}
+        self._fuzzy = TrigramIndex()
+        self._lock = RLock()
+        self._rebuild_changes = None  # file paths set or deleted while replace() builds a new TrigramIndex
+        self.replace(tracks or {})
+
+    @staticmethod
+    def fuzzy_text(file_path, track) -> str:
+        title = get_file_name(file_path) if isinstance(track['title'], Unknown) else track['title']
+        return title if isinstance(track['artist'], Unknown) else f'{title} {track["artist"]}'
+
+    def _view(self, name):
+        """ returns the view of name, building it if needed. Caller holds the lock """
+        try:
+            return self._views[name]
+        except KeyError:
+            get_key, tracks = LibraryIndex.VIEW_KEYS[name], self._tracks
+            # file path breaks ties so that every element has a unique key
+            view = SortedKeyList(tracks, key=lambda file_path: (get_key(tracks[file_path]), file_path))
+            self._views[name] = view
+            return view
+
+    def __getitem__(self, file_path):
+        return self._tracks[file_path]
+
+    def __setitem__(self, file_path, track):
+        with self._lock:
+            if file_path in self._tracks:
+                # the old key is needed to find the file path in the views
+                for view in self._views.values():
+                    view.remove(file_path)
+            self._tracks[file_path] = track
+            for view in self._views.values():
+                view.add(file_path)
+            self._fuzzy.add(file_path, self.fuzzy_text(file_path, track))
+            if self._rebuild_changes is not None:
+                self._rebuild_changes.add(file_path)
+
+    def __delitem__(self, file_path):
+        with self._lock:
+            if file_path in self._tracks:
+                for view in self._views.values():
+                    view.remove(file_path)
+                self._fuzzy.remove(file_path)
+            del self._tracks[file_path]
+            if self._rebuild_changes is not None:
+                self._rebuild_changes.add(file_path)
+
+    def __contains__(self, file_path):
+        return file_path in self._tracks
+
+    def __iter__(self):
+        # a snapshot, since other threads change the library while it is iterated
+        with self._lock:
+            return iter(tuple(self._tracks))
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def copy(self) -> dict:
+        with self._lock:
+            return self._tracks.copy()
+
+    def items(self):
+        return self.copy().items()
+
+    def values(self):
+        return self.copy().values()
+
+    def replace(self, tracks: dict):
+        """ makes the library equal to tracks, only updating what changed unless most of the library changed """
+        with self._lock:
+            removed = self._tracks.keys() - tracks.keys()
+            changed = [file_path for file_path, track in tracks.items() if self._tracks.get(file_path) is not track]
+            if len(removed) + len(changed) <= len(self._tracks) // 4:
+                for file_path in removed:
+                    del self[file_path]
+                for file_path in changed:
+                    self[file_path] = tracks[file_path]
+                return
+            self._rebuild_changes = set()
+        # takes seconds for large libraries, so it is built without blocking readers
+        fuzzy = TrigramIndex({file_path: self.fuzzy_text(file_path, track) for file_path, track in tracks.items()})
+        with self._lock:
+            tracks = dict(tracks)
+            # tracks set or deleted during the build (e.g. by the folder watcher) are newer than tracks
+            for file_path in self._rebuild_changes:
+                if file_path in self._tracks:
+                    tracks[file_path] = self._tracks[file_path]
+                    fuzzy.add(file_path, self.fuzzy_text(file_path, tracks[file_path]))
+                else:
+                    tracks.pop(file_path, None)
+                    fuzzy.remove(file_path)
+            self._rebuild_changes = None
+            self._tracks = tracks
+            views = tuple(self._views)
+            self._views = {}
+            for name in views:
+                self._view(name)
+            self._fuzzy = fuzzy
+
+    def sorted_items(self, view='sort_key', reverse=False, start=0, stop=None) -> list:
+        """ :return: [(file_path, track), ...] sorted by view, sliced [start:stop] in O(log n + stop - start) """
+        with self._lock:
+            file_paths, tracks = self._view(view), self._tracks
+            start, stop, _ = slice(start, stop).indices(len(file_paths))
+            if reverse:
+                start, stop = len(file_paths) - stop, len(file_paths) - start
+            return [(file_path, tracks[file_path]) for file_path in file_paths.islice(start, stop, reverse=reverse)]
+
+    def fuzzy_search(self, text: str, limit=10, min_score=0.5) -> list:
+        """ :return: [(file_path, score), ...] of the tracks whose title and artist best match text, see TrigramIndex """
+        with self._lock:
+            return self._fuzzy.search(text, limit, min_score)
+
+
 def exception_wrapper(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -404,9 +673,16 @@ def t(string, as_title=False):
     return get_translation(string, lang=State.lang, as_title=as_title)
 
 
+def fold_text(text: str) -> str:
+    """ casefolds text and strips its accents so that Beyoncé and BEYONCE are equal """
+    if text.isascii():
+        return text.casefold()
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join([c for c in text if not unicodedata.combining(c)])
+
+
 def natural_key_file(filename):
-    filename = unicodedata.normalize('NFKD', get_file_name(filename).casefold())
-    filename = u''.join([c for c in filename if not unicodedata.combining(c)])
+    filename = fold_text(get_file_name(filename))
     return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', filename)]
 
 
@@ -420,25 +696,12 @@ def get_audio_length(file_path) -> int:
     :param file_path:
     :return: length in seconds """
     try:
-        if file_path.casefold().endswith('.wav'):
-            a = WavInfoReader(file_path)
-            length = a.data.frame_count / a.fmt.sample_rate # type:ignore
-        elif file_path.casefold().endswith('.wma'):
-            try:
-                audio_info = mutagen.File(file_path).info  # type:ignore
-                length = audio_info.length
-            except AttributeError:
-                audio_info = AAC(file_path).info
-                length = audio_info.length
-        elif file_path.casefold().endswith('.opus'):
-            audio_info = mutagen.File(file_path).info  # type:ignore
-            length = audio_info.length
-        else:
-            audio_info = mutagen.File(file_path).info  # type:ignore
-            length = audio_info.length
-        return length
-    except (AttributeError, HeaderNotFoundError, MutagenError, WavInfoEOFError, StopIteration) as e:
+        length = probe(file_path)['length']
+    except MutagenError as e:
         raise InvalidAudioFile(f'{file_path} is an invalid audio file') from e
+    if length is None:
+        raise InvalidAudioFile(f'{file_path} is an invalid audio file')
+    return length
 
 
 def valid_audio_file(uri) -> bool:
@@ -449,6 +712,56 @@ def valid_audio_file(uri) -> bool:
     return Path(uri).suffix.casefold() in AUDIO_EXTS
 
 
+# folders that never contain a user's music
+EXCLUDED_DIR_NAMES = {'$RECYCLE.BIN', 'System Volume Information', '__MACOSX', 'node_modules'}
+
+
+def scan_folder(folder: str, exts=AUDIO_EXTS, excluded_dir_names=EXCLUDED_DIR_NAMES):
+    """
+    Walks folder with os.scandir and yields the absolute posix paths of files with an extension in exts
+    Hidden files and folders are skipped like glob does
+    Each folder is visited once even if symlinks point to it, folders are de-duplicated by (st_dev, st_ino)
+    Files are filtered by name so that on most systems no stat calls are made for files
+    """
+    root = os.path.abspath(folder).replace('\\', '/')
+    try:
+        st = os.stat(root)
+    except OSError:
+        return
+    visited, folders = {(st.st_dev, st.st_ino)}, [root]
+    while folders:
+        folder = folders.pop()
+        sub_folders = []
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.'):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if name in excluded_dir_names:
+                    continue
+                path = f'{folder}/{name}'
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) not in visited:
+                    visited.add((st.st_dev, st.st_ino))
+                    sub_folders.append(path)
+            elif os.path.splitext(name)[1].casefold() in exts:
+                yield f'{folder}/{name}'
+        # depth-first in name order
+        folders.extend(reversed(sub_folders))
+
+
 def set_metadata(file_path: str, metadata: dict):
     ext = os.path.splitext(file_path)[1].casefold()
     audio: mutagen._file.FileType = mutagen.File(file_path) # type: ignore
@@ -458,9 +771,9 @@ def set_metadata(file_path: str, metadata: dict):
     track_place = metadata['track_number']      # X/Y
     track_number = track_place.split('/')[0]    # X
     rating = '1' if metadata['explicit'] else '0'
-    # b64 album art data should be b64 as a string not as bytes
-    if isinstance(metadata.get('art'), bytes):
-        metadata['art'] = metadata['art'].decode()
+    # art is the image itself, base64 is still accepted as a string
+    if isinstance(metadata.get('art'), str):
+        metadata['art'] = b64decode(metadata['art'])
     if '/' not in track_place:
         tracks = max(1, int(track_place))
         track_place = f'{track_place}/{tracks}'
@@ -481,7 +794,7 @@ def set_metadata(file_path: str, metadata: dict):
         audio['TXXX:RATING'] = mutagen.id3._frames.TXXX(text=rating, desc='RATING')
         audio['TXXX:ITUNESADVISORY'] = mutagen.id3._frames.TXXX(text=rating, desc='ITUNESADVISORY')
         if metadata.get('art') is not None:
-            img_data = b64decode(metadata['art'])
+            img_data = metadata['art']
             audio['APIC:'] = mutagen.id3._frames.APIC(encoding=0, mime=metadata['mime'], type=3, data=img_data)
         else:  # remove all album art
             for k in tuple(audio.keys()):
@@ -498,7 +811,7 @@ def set_metadata(file_path: str, metadata: dict):
         audio['rtng'] = [int(rating)]
         if metadata.get('art') is not None:
             image_format = 14 if metadata['mime'].endswith('png') else 13
-            img_data = b64decode(metadata['art'])
+            img_data = metadata['art']
             audio['covr'] = [MP4Cover(img_data, imageformat=image_format)]
         elif 'covr' in audio:
             del audio['covr']
@@ -512,7 +825,7 @@ def set_metadata(file_path: str, metadata: dict):
         audio['rtng'] = [rating]
         audio['trkn'] = track_place
         if metadata.get('art') is not None:
-            img_data = metadata['art']  # b64 data
+            img_data = b64encode(metadata['art']).decode()
             audio['metadata_block_picture'] = img_data
             audio['mime'] = metadata['mime']
         else:
@@ -530,7 +843,7 @@ def set_metadata(file_path: str, metadata: dict):
         audio['ITUNESADVISORY'] = rating  # type: ignore
         if metadata.get('art') is not None:
             if ext == '.flac':
-                img_data = b64decode(metadata['art'])
+                img_data = metadata['art']
                 pic = mutagen.flac.Picture()
                 pic.mime = metadata['mime']
                 pic.data = img_data
@@ -538,7 +851,7 @@ def set_metadata(file_path: str, metadata: dict):
                 audio.clear_pictures() # type: ignore
                 audio.add_picture(pic) # type: ignore
             else:
-                audio['APIC:'] = metadata['art'] # type: ignore
+                audio['APIC:'] = b64encode(metadata['art']).decode() # type: ignore
                 audio['mime'] = metadata['mime'] # type: ignore
         else:
             # remove existing album art
@@ -552,33 +865,74 @@ def set_metadata(file_path: str, metadata: dict):
     audio.save()
 
 
-def get_metadata(file_path: str):
-    title = unknown_title = Unknown('Title')
-    artist = unknown_artist = Unknown('Artist')
-    album = unknown_album = Unknown('Album')
-    length = None
+_prefetched, _prefetched_lock = OrderedDict(), RLock()  # see probe(prefetch=...)
+
+
+def probe(file_path: str, prefetch: int = 0) -> dict:
+    """
+    Parses an audio file once and returns everything Music Caster reads from it
+    keys: title, artist, album, track_number, explicit, length, art_mime, art (bytes), time_modified, size
+        title, artist, album, track_number, length, art_mime, and art are None if not found
+    The last few results are cached by (file_path, mtime, size) so that play() does not open the file several times
+    prefetch > 0 also keeps the result among the last prefetch files probed that way,
+        so that the tracks prefetched for play() are not evicted by the files that a scan reads meanwhile
+    raises MutagenError if the file could not be read and InvalidAudioFile if it is not an audio file
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError as e:
+        raise MutagenError(e) from e
+    key = file_path, st.st_mtime_ns, st.st_size
+    with _prefetched_lock:
+        info = _prefetched.get(key)
+    if info is None:
+        info = _probe(file_path, st.st_mtime_ns, st.st_size, st.st_mtime)
+    if prefetch > 0:
+        with _prefetched_lock:
+            _prefetched[key] = info
+            _prefetched.move_to_end(key)
+            while len(_prefetched) > prefetch:
+                _prefetched.popitem(last=False)
+    # a copy, so that callers cannot change the cached result, its values are immutable
+    return dict(info)
+
+
+@lru_cache(maxsize=8)
+def _probe(file_path: str, _mtime_ns: int, size: int, time_modified: float) -> dict:
+    a = length = art_mime = art = None
     try:
         a = mutagen.File(file_path)
         with suppress(AttributeError):
             length = a.info.length
         if isinstance(a, MP3):
-            audio = dict(EasyMP3(file_path))
+            # what EasyMP3 would return without opening the file a second time
+            tags = a.tags or {}
+            audio = {key: tags[frame].text for key, frame in
+                     (('title', 'TIT2'), ('artist', 'TPE1'), ('album', 'TALB'), ('tracknumber', 'TRCK')) if frame in tags}
             audio['rating'] = a.get('TXXX:RATING', a.get('TXXX:ITUNESADVISORY', ['0']))
         elif isinstance(a, MP4):
-            audio = dict(mutagen.File(file_path))
+            audio = dict(a)
             audio['rating'] = audio.get('rtng', [0])
             for (tag, normalized) in (('©nam', 'title'), ('©alb', 'album'), ('©ART', 'artist')):
                 if tag in audio:
                     audio[normalized] = audio.pop(tag)
             audio['tracknumber'] = audio.get('trkn', [('1', '1')])[0]
+            with suppress(KeyError, IndexError):
+                cover = a['covr'][0]
+                art_mime, art = 'image/png' if cover.imageformat == 14 else 'image/jpeg', bytes(cover)
         elif isinstance(a, (OggOpus, OggVorbis)):
             audio = dict(a)
             if 'rtng' in audio:
                 audio['rating'] = audio.pop('rtng')
             if 'trkn' in audio:
                 audio['tracknumber'] = audio.pop('trkn')
+            with suppress(KeyError, IndexError, ValueError):
+                art = base64.b64decode(a['metadata_block_picture'][0])
+                art_mime = a.get('mime', ['image/jpeg'])[0]
         elif isinstance(a, WAVE) or file_path.endswith('.wav'):
-            audio = WavInfoReader(file_path).info.to_dict()
+            wav_info = WavInfoReader(file_path)
+            length = wav_info.data.frame_count / wav_info.fmt.sample_rate  # type: ignore
+            audio = wav_info.info.to_dict()
             audio = {'title': [audio['title']], 'artist': [audio['artist']], 'album': [audio['product']]}
         elif a is not None:
             audio = dict(a)
@@ -594,27 +948,50 @@ def get_metadata(file_path: str):
     except (ID3NoHeaderError, HeaderNotFoundError, AttributeError, WavInfoEOFError, StopIteration):
         logging.getLogger('music_caster').info(f'Metadata not found for {file_path}')
         audio = {}
-    title = str(audio.get('title', [title])[0])
-    album = str(audio.get('album', [album])[0])
+    with suppress(AttributeError, KeyError, IndexError):
+        if isinstance(a, mutagen.flac.FLAC):
+            art_mime, art = a.pictures[0].mime, a.pictures[0].data
+        elif a is not None and art is None:
+            # ID3 (MP3, WAVE) or something else
+            for tag in a.keys():
+                if 'APIC' in tag:
+                    try:
+                        art_mime, art = a[tag].mime, a[tag].data
+                    except AttributeError:
+                        art_mime = a['mime'][0].value if 'mime' in a else 'image/jpeg'
+                        art = a[tag][0].value
+                    break
+    if length is None and file_path.casefold().endswith('.wma'):
+        with suppress(MutagenError, AttributeError):
+            length = AAC(file_path).info.length
     try:
         is_explicit = audio.get('rating', audio.get('itunesadvisory', ['0']))[0] not in {'C', 'T', '0', 0}
     except IndexError:
         is_explicit = False
-    track_number = str(audio['tracknumber'][0]).split('/', 1)[0] if 'tracknumber' in audio else None
+    artist = None
     with suppress(KeyError, TypeError):
         if len(audio['artist']) == 1:
             # in case the sep char is a slash
             try:
                 audio['artist'] = audio['artist'][0].split('/')
             except AttributeError:
-                audio['artist'] = [unknown_artist]
+                audio['artist'] = []
         artist = ', '.join(audio['artist'])
-    if not title:
-        title = unknown_title
-    if not artist:
-        artist = unknown_artist
-    if not album:
-        album = unknown_album
+    return {'title': str(audio['title'][0]) if audio.get('title') else None,
+            'artist': artist or None,
+            'album': str(audio['album'][0]) if audio.get('album') else None,
+            'track_number': str(audio['tracknumber'][0]).split('/', 1)[0] if 'tracknumber' in audio else None,
+            'explicit': is_explicit, 'length': length, 'art_mime': art_mime, 'art': art,
+            'time_modified': time_modified, 'size': size}
+
+
+def get_metadata(file_path: str):
+    unknown_title, unknown_artist, unknown_album = Unknown('Title'), Unknown('Artist'), Unknown('Album')
+    info = probe(file_path)
+    title = info['title'] or unknown_title
+    artist = info['artist'] or unknown_artist
+    album = info['album'] or unknown_album
+    track_number = info['track_number']
     if title == unknown_title or artist == unknown_artist:
         # if title or artist are unknown, use the basename of the URI (excluding extension)
         sort_key = get_file_name(file_path)
@@ -622,55 +999,56 @@ def get_metadata(file_path: str):
         sort_key = State.track_format.replace('&title', title).replace('&artist', artist)
         sort_key.replace('&album', album if album != unknown_album else '')
         sort_key = sort_key.replace('&trck', track_number or '')
-    metadata = {'title': title, 'artist': artist, 'album': album, 'explicit': is_explicit,
+    metadata = {'title': title, 'artist': artist, 'album': album, 'explicit': info['explicit'],
                 'sort_key': sort_key.casefold(), 'track_number': '1' if track_number is None else track_number,
                 # float works with sqlite REAL
-                'time_modified': os.path.getmtime(file_path)}
-    if length is not None:
-        metadata['length'] = length
+                'time_modified': info['time_modified'], 'size': info['size']}
+    if info['length'] is not None:
+        metadata['length'] = info['length']
     return metadata
 
 
+def init_metadata_worker(lang: str, track_format: str):
+    """ process pool initializer so that sort keys are built the same way as in the main process """
+    State.lang = lang
+    State.track_format = track_format
+
+
+def get_metadata_worker(file_path: str) -> tuple:
+    """
+    picklable wrapper of get_metadata for process pools
+    :return: (file_path, metadata) where metadata is None if the tags could not be read
+    """
+    try:
+        return file_path, get_metadata(file_path)
+    except (MutagenError, ValueError, InvalidAudioFile, OSError):
+        return file_path, None
+
+
 def open_in_browser(url):
     t = Thread(target=webbrowser.open, daemon=True, args=(url,))
     t.start()
     return t
 
 
-def get_album_art(file_path: str, folder_cover_override=False) -> tuple:  # mime: str, data: str
-    with suppress(MutagenError, AttributeError):
-        folder = os.path.dirname(file_path)
-        if folder_cover_override:
-            for ext in ('png', 'jpg', 'jpeg'):
-                folder_cover = os.path.join(folder, f'cover.{ext}')
-                if os.path.exists(folder_cover):
-                    with open(folder_cover, 'rb') as f:
-                        return ext, base64.b64encode(f.read())
-        audio = mutagen.File(file_path)
-        if isinstance(audio, mutagen.flac.FLAC):
-            pics = mutagen.flac.FLAC(file_path).pictures
-            with suppress(IndexError):
-                return pics[0].mime, base64.b64encode(pics[0].data).decode()
-        elif isinstance(audio, MP4):
-            with suppress(KeyError, IndexError):
-                cover = audio['covr'][0]
-                image_format = cover.imageformat
-                mime = 'image/png' if image_format == 14 else 'image/jpeg'
-                return mime, base64.b64encode(cover).decode()
-        elif isinstance(audio, (OggOpus, OggVorbis)):
-            with suppress(KeyError, IndexError):
-                return audio.get('mime', ['image/jpeg'])[0], audio['metadata_block_picture'][0]
-        else:
-            # ID3 or something else
-            if audio is not None:
-                for tag in audio.keys():
-                    if 'APIC' in tag:
-                        try:
-                            return audio[tag].mime, base64.b64encode(audio[tag].data).decode()
-                        except AttributeError:
-                            mime = audio['mime'][0].value if 'mime' in audio else 'image/jpeg'
-                            return mime, base64.b64encode(audio[tag][0].value).decode()
-    return 'image/jpeg', DEFAULT_ART
+def get_folder_cover(folder) -> str | None:
+    """ :return: path of the cover.* image of folder if there is one """
+    for ext in ('png', 'jpg', 'jpeg'):
+        folder_cover = os.path.join(folder, f'cover.{ext}')
+        if os.path.exists(folder_cover):
+            return folder_cover
+    return None
+
+
+def get_album_art(file_path: str, folder_cover_override=False) -> tuple:  # mime: str, data: bytes
+    with suppress(MutagenError, InvalidAudioFile):
+        if folder_cover_override and (folder_cover := get_folder_cover(os.path.dirname(file_path))) is not None:
+            with open(folder_cover, 'rb') as f:
+                return folder_cover.rsplit('.', 1)[1], f.read()
+        info = probe(file_path)
+        if info['art'] is not None:
+            return info['art_mime'], info['art']
+    return 'image/jpeg', DEFAULT_ART_BYTES
 
 
 def fix_path(path, by_os=True): return str(Path(path)) if by_os else path.replace('\\', '/')
@@ -795,6 +1173,10 @@ def ydl_extract_info(url, quiet=False):
         raise IOError from e
 
 
+URL_EXTRACTORS = {'youtube': ('youtube.com', 'youtu.be'), 'soundcloud': ('soundcloud.com',),
+                  'deezer': ('deezer.com', 'deezer.page.link'), 'spotify': ('spotify.com',), 'twitch': ('twitch.tv',)}
+
+
 @lru_cache(maxsize=1)
 def get_yt_id(url, ignore_playlist=False):
     query = urlparse(url)
@@ -814,6 +1196,19 @@ def get_yt_id(url, ignore_playlist=False):
             return query.path.split('/')[2]
 
 
+def get_url_extractor(url) -> str | None:
+    """ :return: the site that resolves url (e.g. youtube for youtu.be links and ytsearch queries) or None """
+    if url.startswith('ytsearch'):
+        return 'youtube'
+    if not url.startswith('http'):
+        return None
+    hostname = urlparse(url).hostname or ''
+    for extractor, domains in URL_EXTRACTORS.items():
+        if any(hostname == domain or hostname.endswith(f'.{domain}') for domain in domains):
+            return extractor
+    return hostname.removeprefix('www.')
+
+
 def get_yt_urls(video_id):
     """
     Returns possible youtube URL's for a single video id
@@ -969,15 +1364,18 @@ def get_default_output_device():
 
 def resize_img(base64data, bg, new_size=COVER_NORMAL, default_art=None) -> bytes:
     """ Resize and return b64 img data to new_size (w, h). (use .decode() on return statement for str) """
+    default_art = None if default_art is None else b64decode(default_art)
+    return b64encode(resize_art(b64decode(base64data), bg, new_size, default_art))
 
+
+def resize_art(img_data: bytes | memoryview, bg, new_size=COVER_NORMAL, default_art=None) -> bytes:
+    """ Resize image data to new_size (w, h) and return it as a PNG, like resize_img without base64 """
     try:
-        img_data = io.BytesIO(b64decode(base64data))
-        art_img: Image.Image = Image.open(img_data)
+        art_img: Image.Image = Image.open(io.BytesIO(img_data))
     except UnidentifiedImageError as e:
         if default_art is None:
             raise OSError from e
-        img_data = io.BytesIO(b64decode(default_art))
-        art_img: Image.Image = Image.open(img_data)
+        art_img: Image.Image = Image.open(io.BytesIO(default_art))
     w, h = art_img.size
     if w == h:
         # resize a square
@@ -995,7 +1393,58 @@ def resize_img(base64data, bg, new_size=COVER_NORMAL, default_art=None) -> bytes
     if img.mode == 'CMYK':
         img = img.convert('RGB')
     img.save(data, format='png')
-    return b64encode(data.getvalue())
+    return data.getvalue()
+
+
+class ThumbnailCache:
+    """
+    Album art of files resized by resize_art, stored once per distinct image in an ArtworkStore
+    Thumbnails are keyed by the file the art comes from (the audio file or its cover.*), its mtime and size,
+        the thumbnail size and the background colour, so an edited file or cover gets a new thumbnail
+        while every track of an album shares the hash of the same thumbnail
+    """
+
+    def __init__(self, store, max_items=1024):
+        self.store = store
+        self.max_items = max_items
+        self._hashes = OrderedDict()  # key: hash
+        self._lock = RLock()
+
+    def get_hash(self, file_path, size=COVER_NORMAL, bg='#121212', folder_cover_override=False) -> str:
+        """ :return: the hash of resize_art(get_album_art(file_path, folder_cover_override)[1], bg, size) in store """
+        source = folder_cover_override and get_folder_cover(os.path.dirname(file_path)) or file_path
+        try:
+            stat = os.stat(source)
+            stat = stat.st_mtime_ns, stat.st_size
+        except OSError:
+            stat = 0, 0
+        key = hashlib.sha1(repr((source, *stat, tuple(size), bg)).encode()).hexdigest()
+        with self._lock:
+            with suppress(KeyError):
+                self._hashes.move_to_end(key)
+                return self._hashes[key]
+        art_hash = self.store.lookup(key)
+        if art_hash is None or self.store.get(art_hash) is None:
+            try:
+                thumbnail = resize_art(get_album_art(file_path, folder_cover_override)[1], bg, size, DEFAULT_ART_BYTES)
+            except OSError:
+                thumbnail = resize_art(DEFAULT_ART_BYTES, bg, size)
+            art_hash = self.store.put(thumbnail, 'image/png', key=key)
+        with self._lock:
+            self._hashes[key] = art_hash
+            if len(self._hashes) > self.max_items:
+                self._hashes.popitem(last=False)
+        return art_hash
+
+    def get(self, file_path, size=COVER_NORMAL, bg='#121212', folder_cover_override=False) -> bytes:
+        """ :return: resize_art(get_album_art(file_path, folder_cover_override)[1], bg, size) """
+        art_hash = self.get_hash(file_path, size, bg, folder_cover_override)
+        art = self.store.get(art_hash)
+        if art is None:  # removed from the store after its hash was remembered
+            with self._lock:
+                self._hashes.clear()
+            art = self.store.get(self.get_hash(file_path, size, bg, folder_cover_override))
+        return art[1]
 
 
 def export_playlist(playlist_name, uris):
@@ -1029,9 +1478,9 @@ def get_latest_release(ver, this_version, force=False):
     if force: return latest release even if latest version <= VERSION """
     releases_url = 'https://api.github.com/repos/elibroftw/music-caster/releases/latest'
     with suppress(requests.RequestException):
-        release = requests.get(releases_url)
+        release = http_session.get(releases_url)
         if release.status_code >= 400:
-            release = requests.get(releases_url, proxies=get_proxy(False))
+            release = http_session.get(releases_url, proxies=get_proxy(False))
         release = release.json()
         latest_ver = release.get('tag_name', f'v{this_version}')[1:]
         _version = [int(x) for x in ver.split('.')]
@@ -1050,7 +1499,7 @@ def get_proxies(add_local=True):
         BeautifulSoup,  # 0.32 seconds if at top level, here it is 0.1 seconds
     )
     try:
-        response = requests.get('https://free-proxy-list.net/', headers={'user-agent': USER_AGENT})
+        response = http_session.get('https://free-proxy-list.net/', headers={'user-agent': USER_AGENT})
         scraped_proxies = set()
         soup = BeautifulSoup(response.text, 'lxml')
         table = soup.find('table')
@@ -1085,7 +1534,7 @@ def get_proxy(add_local=True):
 @time_cache(max_age=3500, maxsize=1)
 def get_spotify_headers():
     # access token key expires in ~1 hour
-    r = requests.get('https://open.spotify.com/', headers={'user-agent': USER_AGENT})
+    r = http_session.get('https://open.spotify.com/', headers={'user-agent': USER_AGENT})
     access_token = re.search('"accessToken":"([^"]*)', r.text).group(1)
     return {'Authorization': f'Bearer {access_token}'}
 
@@ -1097,11 +1546,10 @@ def search_album_art_spotify(title, artist, mkt):
         if artist:
             url += f'+artist:{artist}'
         url += f'&type=track&market={mkt}'
-        r = requests.get(url, headers=get_spotify_headers()).json()
+        r = http_session.get(url, headers=get_spotify_headers()).json()
         if 'tracks' in r:
             for art_link in (item['album']['images'][0]['url'] for item in r['tracks']['items']):
-                original_art = base64.b64encode(requests.get(art_link).content).decode()
-                return original_art
+                return http_session.get(art_link).content
 
 
 def parse_spotify_track(track_obj, parent_url='') -> dict:
@@ -1136,7 +1584,7 @@ def get_spotify_track(url):
     except IndexError:
         # e.g. */album/*?highlight=spotify:track:587w9pOR9UNvFJOwkW7NgD
         track_id = re.search(r'track:.*', url).group()[6:]
-    track = requests.get(f'{SPOTIFY_API}/tracks/{track_id}', headers=get_spotify_headers()).json()
+    track = http_session.get(f'{SPOTIFY_API}/tracks/{track_id}', headers=get_spotify_headers()).json()
     return {**parse_spotify_track(track), 'src': url}
 
 
@@ -1144,17 +1592,17 @@ def get_spotify_track(url):
 def get_spotify_album(url):
     album_id = urlparse(url).path.split('/album/', 1)[1]
     api_url = f'{SPOTIFY_API}/albums/{album_id}'
-    r = requests.get(api_url, headers=get_spotify_headers()).json()
+    r = http_session.get(api_url, headers=get_spotify_headers()).json()
     return [parse_spotify_track({**track, 'album': r}, parent_url=url) for track in r['tracks']['items']]
 
 
 def get_spotify_playlist(url):
     playlist_id = urlparse(url).path.split('/playlist/', 1)[1]
     api_url = f'{SPOTIFY_API}/playlists/{playlist_id}/tracks'
-    response = requests.get(api_url, headers=get_spotify_headers()).json()
+    response = http_session.get(api_url, headers=get_spotify_headers()).json()
     results = response['items']
     while response['next'] is not None:
-        response = requests.get(response['next'], headers=get_spotify_headers()).json()
+        response = http_session.get(response['next'], headers=get_spotify_headers()).json()
         results.extend(response['items'])
     return [parse_spotify_track(result['track'], url) for result in results if isinstance(result['track'], dict)]
 
@@ -1200,7 +1648,7 @@ def get_cookies(domain_contains, cookie_name='', return_first=True, return_value
 @lru_cache
 def parse_deezer_page(url):
     if 'page.link' in url:
-        r = requests.get(url)
+        r = http_session.get(url)
         url = r.url
     if '/track/' in url:
         _type = 'track'
@@ -1310,8 +1758,9 @@ def get_deezer_tracks(url, login=True):
 
 
 @lru_cache
-def custom_art(text):
-    img_data = io.BytesIO(b64decode(DEFAULT_ART))
+def custom_art(text) -> bytes:
+    """ :return: PNG of the default art labelled with text """
+    img_data = io.BytesIO(DEFAULT_ART_BYTES)
     art_img: Image.Image = Image.open(img_data)
     size = art_img.size
     x1 = y1 = size[0] * 0.95
@@ -1338,7 +1787,7 @@ def custom_art(text):
     d.text(((x0 + x1) / 2, (y0 + y1) / 2 + shift), text, fill='#fff', font=fnt, align='center', anchor='mm')
     data = io.BytesIO()
     art_img.save(data, format='png', quality=95)
-    return b64encode(data.getvalue())
+    return data.getvalue()
 
 
 def get_youtube_comments(url, limit=-1):  # -> generator
@@ -1506,7 +1955,7 @@ def install_phantomjs(install_directory):
         install_directory (Pathlike): path to extract phantomjs to
     """
     # download phantomJS
-    tags = requests.get('https://api.github.com/repos/ariya/phantomjs/tags').json()
+    tags = http_session.get('https://api.github.com/repos/ariya/phantomjs/tags').json()
     latest_tag = tags[0]['name']
 
     if platform.system() == 'Windows':
@@ -1518,7 +1967,7 @@ def install_phantomjs(install_directory):
     elif platform.system() == 'Darwin':  # Mac OSX
         dir_name = f'phantomjs-{latest_tag}-windows'
         dl_link = f'https://bitbucket.org/ariya/phantomjs/downloads/phantomjs-{latest_tag}-macosx.zip'
-    r = requests.get(dl_link, stream=True)
+    r = http_session.get(dl_link, stream=True)
     temp_dir = tempfile.mkdtemp()
     if dl_link.endswith('zip'):
         with ZipFile(io.BytesIO(r.content)) as zf: